@@ -2,6 +2,8 @@
 ASGI config for Sched project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
+Requests to ``[/f/<facility>]/schedule/events`` are served by the Server-Sent Events stream
+of appointments, everything else goes to Django.
 
 For more information on this file, see
 https://docs.djangoproject.com/en/4.0/howto/deployment/asgi/
@@ -13,4 +15,12 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'Sched.settings')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+from sched_api.sse import sse_application, match_events_path  # noqa: E402 (needs configured Django)
+
+
+async def application(scope, receive, send):
+    if scope['type'] == 'http' and match_events_path(scope['path']):
+        return await sse_application(scope, receive, send)
+    return await django_application(scope, receive, send)
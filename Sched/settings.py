@@ -48,7 +48,12 @@ INSTALLED_APPS = [
 AUTH_USER_MODEL = "sched_api.Users"
 
 MIDDLEWARE = [
+    'sched_api.metrics.MetricsMiddleware',
+    'sched_api.profiling.ProfilingMiddleware',
+    'sched_api.compression.CompressionMiddleware',
     'django.middleware.security.SecurityMiddleware',
+    'sched_api.tenancy.FacilityMiddleware',
+    'sched_api.refcache.ReferenceCacheMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -76,6 +81,11 @@ TEMPLATES = [
 ]
 
 WSGI_APPLICATION = 'Sched.wsgi.application'
+ASGI_APPLICATION = 'Sched.asgi.application'
+
+# Directory for sockets of the local channel layer, set it when several
+# ASGI processes serve the live schedule events (None - in-process only)
+SCHED_EVENTS_CHANNEL_DIR = None
 
 
 # Database
@@ -88,6 +98,96 @@ DATABASES = {
     }
 }
 
+# Facilities (clinics) of the deployment, each one has its own database.
+# Requests choose the facility by URL prefix /f/<facility>/ or by the
+# X-Facility-Token header, e.g.
+#     'north': {'DATABASE': 'facility_north', 'TOKEN': 'secret-token'},
+SCHED_FACILITIES = {}
+
+for facility in SCHED_FACILITIES.values():
+    DATABASES.setdefault(facility['DATABASE'], {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': BASE_DIR / 'facilities' / (facility['DATABASE'] + '.sqlite3'),
+    })
+
+DATABASE_ROUTERS = ['sched_api.tenancy.ReplicaRouter', 'sched_api.tenancy.FacilityRouter']
+
+# Read replicas of databases for read only views {alias: replica alias}
+# and pragmas of SQLite connections, see Sched/settings_production.py
+SCHED_READ_REPLICAS = {}
+SCHED_SQLITE_PRAGMAS = {}
+
+# The default cache must be shared by the worker processes: it keeps the
+# versions of the reference data and of the feeds, the list of specialities
+# and the built feeds. Files are shared by the processes of one host; use
+# memcached or redis when the processes run on several hosts.
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': BASE_DIR / 'cache',
+    }
+}
+
+# the tests use a memory cache, see Sched/test_runner.py
+TEST_RUNNER = 'Sched.test_runner.TestRunner'
+
+# Entries of the process cache of workers, places, specialities and form choices,
+# seconds the list of specialities stays in the shared cache (changes drop it earlier)
+SCHED_REFCACHE_SIZE = 1024
+SCHED_SPECIALITY_CACHE_SECONDS = 5 * 60
+
+# Directory for the snapshot of weekly schedules shared by the worker processes
+# (memory-mapped file), None to read schedules from the database
+SCHED_SNAPSHOT_DIR = None
+
+# Directory shared by the worker processes for the metrics (gunicorn), None for one process
+SCHED_METRICS_DIR = None
+
+# Profiling of requests with the X-Profile: <SCHED_PROFILE_TOKEN> header or of the part
+# SCHED_PROFILE_RATE of all requests into SCHED_PROFILE_DIR, None to turn off
+SCHED_PROFILE_DIR = None
+SCHED_PROFILE_TOKEN = None
+SCHED_PROFILE_RATE = 0
+SCHED_PROFILE_KEEP = 100
+# Queries longer than that (milliseconds) are logged to sched_api.slow_queries, None to turn off
+SCHED_SLOW_QUERY_MS = None
+
+# Days ahead for which occurrences of recurring appointments are created,
+# later ones are added daily by the materialize_series command
+SCHED_BOOKING_HORIZON = 62
+
+# New appointments of the process are written by one thread in groups: bookings
+# queued while the previous group is written (and within SCHED_GROUP_COMMIT_WAIT_MS),
+# up to SCHED_GROUP_COMMIT_SIZE, share one commit
+SCHED_GROUP_COMMIT = False
+SCHED_GROUP_COMMIT_WAIT_MS = 0
+SCHED_GROUP_COMMIT_SIZE = 100
+
+# API responses longer than that are compressed (gzip, or brotli if installed)
+SCHED_COMPRESS_MIN_BYTES = 1024
+
+# iCalendar feeds (feeds/worker/<id>/<token>.ics): days before and after today, seconds
+# in the cache and the key of the tokens in the URLs (SECRET_KEY if None, a new one
+# changes all URLs)
+SCHED_FEED_PAST_DAYS = 7
+SCHED_FEED_DAYS = 31
+SCHED_FEED_CACHE_SECONDS = 15 * 60
+SCHED_FEED_SECRET = None
+
+# Reminders of appointments (python manage.py send_reminders): hours before the start,
+# the delivery backend (LocalBackend - e-mail through EMAIL_BACKEND, StubBackend - memory)
+# and messages per delivery
+SCHED_REMINDER_HOURS = (24,)
+SCHED_REMINDER_BACKEND = 'sched_api.reminders.LocalBackend'
+SCHED_REMINDER_BATCH = 100
+EMAIL_BACKEND = 'django.core.mail.backends.console.EmailBackend'
+
+# Seconds the time stays held while the booking form is filled
+SCHED_HOLD_TTL = 5 * 60
+
+# Seconds to keep responses of the requests with the Idempotency-Key header
+SCHED_IDEMPOTENCY_TTL = 24 * 60 * 60
+
 
 # Password validation
 # https://docs.djangoproject.com/en/4.0/ref/settings/#auth-password-validators
@@ -0,0 +1,26 @@
+"""
+Settings of API-only workers (api/* JSON endpoints and /metrics).
+
+Run them with DJANGO_SETTINGS_MODULE=Sched.settings_api: the admin, html
+tables, filters, crispy forms and the browsable API are not loaded, so
+the workers start faster and take less memory.
+"""
+
+from .settings import *  # noqa: F401,F403
+
+HTML_APPS = ('django.contrib.admin', 'django.contrib.messages', 'django.contrib.staticfiles',
+             'crispy_forms', 'django_tables2', 'django_filters')
+
+INSTALLED_APPS = [x for x in INSTALLED_APPS if x not in HTML_APPS]
+
+MIDDLEWARE = [x for x in MIDDLEWARE if x != 'django.contrib.messages.middleware.MessageMiddleware']
+
+TEMPLATES = [dict(TEMPLATES[0], OPTIONS={'context_processors': [
+    x for x in TEMPLATES[0]['OPTIONS']['context_processors'] if 'messages' not in x]})]
+
+ROOT_URLCONF = 'Sched.urls_api'
+
+REST_FRAMEWORK = {
+    'DEFAULT_RENDERER_CLASSES': ['rest_framework.renderers.JSONRenderer'],
+    'DEFAULT_PARSER_CLASSES': ['rest_framework.parsers.JSONParser'],
+}
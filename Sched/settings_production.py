@@ -0,0 +1,29 @@
+"""
+Production settings: SQLite in WAL mode with tuned pragmas, persistent
+connections and read only replicas of the databases for list views.
+
+Run with DJANGO_SETTINGS_MODULE=Sched.settings_production; the secret key
+and the hosts are taken from the environment.
+"""
+
+import os
+
+from .settings import *  # noqa: F401,F403
+from sched_api.sqlite import PRODUCTION_PRAGMAS
+
+DEBUG = False
+SECRET_KEY = os.environ.get('SCHED_SECRET_KEY', SECRET_KEY)
+ALLOWED_HOSTS = os.environ.get('SCHED_ALLOWED_HOSTS', 'localhost').split(',')
+
+SCHED_SQLITE_PRAGMAS = PRODUCTION_PRAGMAS
+
+# every database gets the persistent connection and a read only replica
+# (second connection pool on the same file, WAL lets it read while the primary writes)
+for alias in list(DATABASES):
+    database = DATABASES[alias]
+    database['CONN_MAX_AGE'] = 600
+    database.setdefault('OPTIONS', {})['timeout'] = 5 # seconds, the same as busy_timeout
+    replica = alias + '_replica' if alias != 'default' else 'replica'
+    DATABASES[replica] = dict(database, NAME='file:%s?mode=ro' % database['NAME'], 
+                              OPTIONS=dict(database['OPTIONS']), TEST={'MIRROR': alias})
+    SCHED_READ_REPLICAS[alias] = replica
@@ -0,0 +1,35 @@
+"""
+Test runner: the tests use a memory cache of the process, the shared file
+cache of the settings would keep rows of the previous test databases.
+The second database 'facility' is a real database of a facility for the
+tests of data in several databases (migrations, commands).
+"""
+
+from django.conf import settings
+from django.db import connections
+from django.test.runner import DiscoverRunner
+from django.test.utils import override_settings
+
+FACILITY_DATABASE = 'facility'
+
+
+class TestRunner(DiscoverRunner):
+
+    def setup_test_environment(self, **kwargs):
+        super().setup_test_environment(**kwargs)
+        self.caches = override_settings(CACHES={
+            'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+        self.caches.enable()
+
+    def setup_databases(self, **kwargs):
+        if FACILITY_DATABASE not in connections.settings:
+            connections.settings[FACILITY_DATABASE] = dict(connections.settings['default'], 
+                                                           NAME=FACILITY_DATABASE, TEST={})
+            connections.ensure_defaults(FACILITY_DATABASE)
+            connections.prepare_test_settings(FACILITY_DATABASE)
+            settings.DATABASES[FACILITY_DATABASE] = connections.settings[FACILITY_DATABASE]
+        return super().setup_databases(**kwargs)
+
+    def teardown_test_environment(self, **kwargs):
+        self.caches.disable()
+        super().teardown_test_environment(**kwargs)
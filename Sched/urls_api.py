@@ -0,0 +1,6 @@
+"""Sched URL Configuration of API-only workers (Sched.settings_api)"""
+from django.urls import path, include
+
+urlpatterns = [
+    path('', include('sched_api.urls_api'), name='api_index'),
+]
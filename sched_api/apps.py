@@ -4,3 +4,6 @@ from django.apps import AppConfig
 class SchedApiConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'sched_api'
+
+    def ready(self):
+        from . import signals  # noqa: F401 (connect signal handlers)
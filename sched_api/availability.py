@@ -0,0 +1,151 @@
+'''
+Working hours of workers for concrete dates.
+
+The weekly Schedule segments are merged with ScheduleException rows
+(closures and extra shifts) through operations on sorted lists of
+intervals. Any range of dates is resolved with two queries, or with one
+when the weekly segments are read from the shared snapshot.
+'''
+
+import datetime
+from collections import defaultdict
+
+from django.db.models import Q
+
+from .models import Schedule, ScheduleException, Appointments
+from .snapshot import get_snapshot
+
+DAY_START = datetime.time.min
+DAY_END = datetime.time.max
+
+
+def merge(intervals):
+    '''
+    Union of the intervals
+
+            Parameters:
+                    intervals (iterable): pairs (start, end)
+
+            Returns:
+                    sorted list of not overlapping intervals
+    '''
+    merged = []
+    for start, end in sorted(intervals):
+        if merged and start <= merged[-1][1]:
+            if end > merged[-1][1]: merged[-1] = (merged[-1][0], end)
+        else: merged.append((start, end))
+    return merged
+
+
+def subtract(intervals, removed):
+    '''
+    Difference of the sorted lists of not overlapping intervals
+    '''
+    result = []
+    removed = merge(removed)
+    i = 0
+    for start, end in intervals:
+        while i < len(removed) and removed[i][1] <= start: i += 1
+        j = i
+        while j < len(removed) and removed[j][0] < end:
+            if removed[j][0] > start: result.append((start, removed[j][0]))
+            start = max(start, removed[j][1])
+            j += 1
+        if start < end: result.append((start, end))
+    return result
+
+
+def covers(intervals, start, end):
+    # the interval (start, end) is inside one of the intervals
+    return any(x <= start and end <= y for x, y in intervals)
+
+
+def overlaps(intervals, start, end):
+    return any(x < end and start < y for x, y in intervals)
+
+
+def dates(date_from, date_to):
+    for i in range((date_to - date_from).days + 1):
+        yield date_from + datetime.timedelta(days=i)
+
+
+class Availability:
+    '''
+    Resolved working hours of workers and closures of places for a range of dates
+    '''
+
+    def __init__(self, worker_ids, date_from, date_to, place_ids=()):
+        self.worker_ids = set(worker_ids)
+        self.place_ids = set(place_ids)
+        self.date_from = date_from
+        self.date_to = date_to
+
+        self._weekly = defaultdict(list) # (worker, day of the week): segments
+        weekdays = {x.isoweekday() for x in dates(date_from, min(date_to, date_from + datetime.timedelta(days=6)))}
+        snapshot = get_snapshot()
+        if snapshot is not None: # shared memory instead of the query
+            for worker_id in self.worker_ids:
+                for day in weekdays: self._weekly[(worker_id, day)] = snapshot.segments_of(worker_id, day)
+        else:
+            schedule = Schedule.objects.filter(worker_id__in=self.worker_ids)
+            if len(weekdays) < 7: schedule = schedule.filter(day__in=weekdays)
+            for worker_id, day, time_in, time_out in schedule.values_list(
+                    'worker_id', 'day', 'time_in', 'time_out'):
+                self._weekly[(worker_id, day)].append((time_in, time_out))
+
+        self._extra = defaultdict(list) # (worker, date): extra shifts
+        self._closed = defaultdict(list) # (worker or None for all, date): closures
+        self._place_closed = defaultdict(list) # (place, date): closures
+        exceptions = ScheduleException.objects.filter(day__range=(date_from, date_to)).filter(
+            Q(worker_id__in=self.worker_ids) | Q(place_id__in=self.place_ids) |
+            Q(worker__isnull=True, place__isnull=True))
+        for kind, worker_id, place_id, day, time_in, time_out in exceptions.values_list(
+                'kind', 'worker_id', 'place_id', 'day', 'time_in', 'time_out'):
+            interval = (time_in or DAY_START, time_out or DAY_END)
+            if kind == ScheduleException.EXTRA:
+                if worker_id is not None: self._extra[(worker_id, day)].append(interval)
+            elif worker_id is not None: self._closed[(worker_id, day)].append(interval)
+            elif place_id is not None: self._place_closed[(place_id, day)].append(interval)
+            else: self._closed[(None, day)].append(interval)
+
+    def hours(self, worker_id, day):
+        '''
+        Working hours of the worker
+
+                Parameters:
+                        worker_id (int): id of the Worker
+                        day (date): date inside the resolved range
+
+                Returns:
+                        sorted list of intervals (time_in, time_out)
+        '''
+        segments = merge(self._weekly[(worker_id, day.isoweekday())] + self._extra[(worker_id, day)])
+        return subtract(segments, self._closed[(worker_id, day)] + self._closed[(None, day)])
+
+    def place_closures(self, place_id, day):
+        return merge(self._place_closed[(place_id, day)] + self._closed[(None, day)])
+
+    def all_hours(self):
+        # {(worker id, date): working hours} for the whole range
+        return {(worker_id, day): self.hours(worker_id, day)
+                for worker_id in self.worker_ids for day in dates(self.date_from, self.date_to)}
+
+
+def free_intervals(worker_ids, date_from, date_to):
+    '''
+    Free time of workers: working hours without booked appointments
+
+            Parameters:
+                    worker_ids (iterable): ids of Worker
+                    date_from, date_to (date): range of dates
+
+            Returns:
+                    {(worker id, date): sorted list of free intervals}
+    '''
+    availability = Availability(worker_ids, date_from, date_to)
+    booked = defaultdict(list)
+    for worker_id, day, time_in, time_out in Appointments.objects.filter(
+            worker_id__in=availability.worker_ids, day__range=(date_from, date_to)
+            ).values_list('worker_id', 'day', 'time_in', 'time_out'):
+        booked[(worker_id, day)].append((time_in, time_out))
+    return {key: subtract(hours, booked[key]) for key, hours in availability.all_hours().items()}
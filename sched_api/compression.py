@@ -0,0 +1,82 @@
+'''
+Compression of large API responses.
+
+Responses of the API formats (JSON, columnar JSON, MessagePack, iCalendar) longer than
+settings.SCHED_COMPRESS_MIN_BYTES are compressed with brotli (when the brotli
+package is installed) or gzip, whichever the client prefers in its
+Accept-Encoding. HTML pages are not compressed, they carry CSRF tokens.
+'''
+
+import gzip
+
+from django.conf import settings
+from django.utils.cache import patch_vary_headers
+
+try:
+    import brotli
+except ImportError: # optional
+    brotli = None
+
+CONTENT_TYPES = ('application/json', 'application/vnd.sched.columnar+json', 'application/msgpack', 'text/calendar')
+
+
+def accepted_encodings(header):
+    '''
+    Encodings of the Accept-Encoding header
+
+            Returns:
+                    {encoding: quality} without refused ones (q=0)
+    '''
+    encodings = {}
+    for item in header.split(','):
+        name, _, parameters = item.strip().partition(';')
+        quality = 1.0
+        if parameters.strip().startswith('q='):
+            try:
+                quality = float(parameters.strip()[2:])
+            except ValueError:
+                continue
+        if name and quality > 0: encodings[name.strip().lower()] = quality
+    return encodings
+
+
+def choose_encoding(header):
+    encodings = accepted_encodings(header)
+    available = ['br', 'gzip'] if brotli is not None else ['gzip']
+    # the highest quality, brotli first among equal ones
+    candidates = [x for x in available if x in encodings or '*' in encodings]
+    if not candidates: return None
+    return max(candidates, key=lambda x: (encodings.get(x, encodings.get('*')), x == 'br'))
+
+
+def compress(content, encoding):
+    if encoding == 'br': return brotli.compress(content, quality=5)
+    return gzip.compress(content, compresslevel=6, mtime=0)
+
+
+class CompressionMiddleware:
+    '''
+    Compresses large responses of the API
+    '''
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.min_bytes = getattr(settings, 'SCHED_COMPRESS_MIN_BYTES', 1024)
+
+    def __call__(self, request):
+        response = self.get_response(request)
+        if response.streaming or response.has_header('Content-Encoding'): return response
+        if response.get('Content-Type', '').split(';')[0].strip() not in CONTENT_TYPES: return response
+        patch_vary_headers(response, ('Accept-Encoding',))
+        if len(response.content) < self.min_bytes: return response
+        encoding = choose_encoding(request.META.get('HTTP_ACCEPT_ENCODING', ''))
+        if encoding is None: return response
+
+        compressed = compress(response.content, encoding)
+        if len(compressed) >= len(response.content): return response
+        response.content = compressed
+        response['Content-Length'] = str(len(compressed))
+        response['Content-Encoding'] = encoding
+        if response.has_header('ETag') and response['ETag'].startswith('"'): # not the same bytes
+            response['ETag'] = 'W/' + response['ETag']
+        return response
@@ -0,0 +1,94 @@
+'''
+Batched conflict checks of many new appointments (solver, group commit, moves of orphans).
+
+Occupancy reads the busy time of the workers and places on the days of the
+batch with four queries: appointments, active holds, series with occurrences
+not created yet and the weekly shifts which own a room. The bookings of the
+batch are then checked one by one in memory, each accepted booking is added
+to the occupancy, so the batch is checked against itself too. The rules are
+the ones of Appointments.clean; working hours and closures are not read
+again, the bookings of the batch have been checked against them already.
+'''
+
+from collections import defaultdict
+
+from django.db.models import Q
+from django.utils import timezone
+
+from .models import Appointments, AppointmentSeries, Schedule, SlotHold
+from .availability import covers, overlaps
+from .series import virtual
+
+MESSAGES = {
+    'overlap': 'There is an overlap with another event',
+    'held': 'The time is held by another booking',
+    'series': 'There is an overlap with the series',
+    'room': 'The place is the room of another shift',
+}
+
+
+class Occupancy:
+    '''
+    Busy time of workers and places on the days
+    '''
+
+    def __init__(self, days, worker_ids, place_ids, using='default'):
+        days, worker_ids, place_ids = set(days), set(worker_ids), set(place_ids)
+        self.busy = defaultdict(list) # ('worker' or 'place', id, date): [(time_in, time_out, reason, id)]
+        self.holds = defaultdict(list) # ('worker' or 'place', id, date): [(time_in, time_out, holder id)]
+        self.shifts = defaultdict(list) # (worker id, day of the week): [(place id, time_in, time_out)]
+        self.rooms = defaultdict(list) # (place id, day of the week): [(worker id, time_in, time_out)]
+        if not days: return
+        who = Q(worker_id__in=worker_ids) | Q(place_id__in=place_ids)
+
+        for pk, worker_id, place_id, day, time_in, time_out in Appointments.objects.using(using).filter(
+                who, day__in=days).values_list('pk', 'worker_id', 'place_id', 'day', 'time_in', 'time_out'):
+            self.add(worker_id, place_id, day, time_in, time_out, pk=pk)
+        for worker_id, place_id, day, time_in, time_out, holder_id in SlotHold.objects.using(using).filter(
+                who, day__in=days, expires_at__gt=timezone.now()).values_list(
+                'worker_id', 'place_id', 'day', 'time_in', 'time_out', 'holder_id'):
+            self.holds[('worker', worker_id, day)].append((time_in, time_out, holder_id))
+            self.holds[('place', place_id, day)].append((time_in, time_out, holder_id))
+        last = max(days)
+        for series in AppointmentSeries.objects.using(using).filter(who, first_day__lte=last).filter(
+                Q(materialized_until__isnull=True) | Q(materialized_until__lt=last)):
+            for day in days:
+                if virtual(series, day):
+                    self.add(series.worker_id, series.place_id, day, series.time_in, series.time_out, 'series')
+        for worker_id, place_id, weekday, time_in, time_out in Schedule.objects.using(using).filter(
+                who, place__isnull=False, day__in={x.isoweekday() for x in days}).values_list(
+                'worker_id', 'place_id', 'day', 'time_in', 'time_out'):
+            self.shifts[(worker_id, weekday)].append((place_id, time_in, time_out))
+            self.rooms[(place_id, weekday)].append((worker_id, time_in, time_out))
+
+    def add(self, worker_id, place_id, day, time_in, time_out, reason='overlap', pk=None):
+        # pk of the appointment, which does not conflict with itself when it is moved
+        self.busy[('worker', worker_id, day)].append((time_in, time_out, reason, pk))
+        self.busy[('place', place_id, day)].append((time_in, time_out, reason, pk))
+
+    def room_of(self, worker_id, day, time_in, time_out):
+        # room of the shift of the worker covering the time, None without a room
+        return next((place_id for place_id, x, y in self.shifts[(worker_id, day.isoweekday())]
+                     if covers([(x, y)], time_in, time_out)), None)
+
+    def room_taken(self, worker_id, place_id, day, time_in, time_out):
+        # the place is the room of a shift in that time, and not of the shift of the worker
+        if self.room_of(worker_id, day, time_in, time_out) == place_id: return False
+        return overlaps([(x, y) for _, x, y in self.rooms[(place_id, day.isoweekday())]], time_in, time_out)
+
+    def conflict(self, worker_id, place_id, day, time_in, time_out, creator_id=None, exclude=None):
+        '''
+        Reason why the booking (or the appointment exclude moved there) can not be made
+
+                Returns:
+                        key of MESSAGES or None
+        '''
+        if self.room_taken(worker_id, place_id, day, time_in, time_out): return 'room'
+        for key in (('worker', worker_id, day), ('place', place_id, day)):
+            for x, y, reason, pk in self.busy[key]:
+                if x < time_out and time_in < y and (pk is None or pk != exclude): return reason
+        for key in (('worker', worker_id, day), ('place', place_id, day)):
+            if overlaps([(x, y) for x, y, holder_id in self.holds[key]
+                         if holder_id is None or holder_id != creator_id], time_in, time_out):
+                return 'held'
+        return None
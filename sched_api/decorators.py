@@ -1,6 +1,19 @@
+from functools import wraps
+import datetime
+import hashlib
+import json
+
+from django.conf import settings
 from django.contrib.auth import REDIRECT_FIELD_NAME
 from django.contrib.auth.decorators import user_passes_test
-from .models import Users
+from django.db import IntegrityError, transaction
+from django.http import HttpResponse, JsonResponse
+from django.utils import timezone
+from .models import Users, IdempotencyRecord
+from . import metrics
+from .tenancy import use_replica
+
+IDEMPOTENCY_HEADER = 'HTTP_IDEMPOTENCY_KEY'
 
 def serviceman_required(function=None, redirect_field_name=REDIRECT_FIELD_NAME, login_url='login'):
     '''
@@ -29,4 +42,87 @@ def admin_required(function=None, redirect_field_name=REDIRECT_FIELD_NAME, login
     )
     if function:
         return actual_decorator(function)
-    return actual_decorator
\ No newline at end of file
+    return actual_decorator
+
+def stored_response(response):
+    # responses kept for retries: successful ones, no errors caught by the views
+    if not 200 <= response.status_code < 300 or getattr(response, 'streaming', False): return False
+    if not response.get('Content-Type', '').startswith('application/json'): return True
+    try:
+        content = json.loads(response.content)
+    except ValueError:
+        return True
+    return not (isinstance(content, dict) and 'error' in content)
+
+def replay(record):
+    response = HttpResponse(bytes(record.content), status=record.status, 
+                            content_type=record.content_type)
+    response['Idempotent-Replayed'] = 'true'
+    return response
+
+def idempotent(function):
+    '''
+    Decorator for write views: the response of the request with the 
+    Idempotency-Key header is stored, retries with the same key get it back
+    in one lookup without running the view again. The key is reserved before
+    the view runs, a retry coming while the first request is running gets 409,
+    the same key with another body gets 422. Put it above @api_view: the body
+    is hashed before DRF parses it (the CSRF check of the session reads the
+    form data, the raw body can not be read after it).
+    '''
+    @wraps(function)
+    def wrapper(request, *args, **kwargs):
+        key = request.META.get(IDEMPOTENCY_HEADER)
+        if request.method != 'POST' or not key or not request.user.is_authenticated:
+            return function(request, *args, **kwargs)
+
+        body_hash = hashlib.sha256(request.body).hexdigest()
+        lookup = {'key': key, 'user': request.user, 'path': request.path}
+        now = timezone.now()
+        record = IdempotencyRecord.objects.filter(expires_at__gt=now, **lookup).first()
+        metrics.cache_lookup('idempotency', record is not None)
+        if record is None:
+            ttl = getattr(settings, 'SCHED_IDEMPOTENCY_TTL', 24 * 60 * 60)
+            IdempotencyRecord.objects.filter(expires_at__lte=now).delete() # eviction by index
+            try:
+                with transaction.atomic():
+                    reserved = IdempotencyRecord.objects.create(
+                        body_hash=body_hash, content=b'', content_type='',
+                        expires_at=now + datetime.timedelta(seconds=ttl), **lookup)
+            except IntegrityError: # reserved by the parallel request
+                record = IdempotencyRecord.objects.filter(**lookup).first() or IdempotencyRecord(
+                    body_hash=body_hash) # released by it meanwhile, retry later
+        if record is not None:
+            if record.body_hash != body_hash:
+                return JsonResponse({'error': 'The key is used with another request'}, status=422)
+            if record.status is None:
+                response = JsonResponse({'error': 'The request with the key is in progress'}, status=409)
+                response['Retry-After'] = '1'
+                return response
+            return replay(record)
+
+        try:
+            response = function(request, *args, **kwargs)
+            if hasattr(response, 'render') and not response.is_rendered: response.render()
+        except BaseException:
+            reserved.delete()
+            raise
+        if stored_response(response):
+            IdempotencyRecord.objects.filter(pk=reserved.pk).update(
+                status=response.status_code, content=response.content,
+                content_type=response.get('Content-Type', 'text/html'))
+        else: # e.g. "database is locked", the retry runs the view again
+            reserved.delete()
+        return response
+    return wrapper
+
+
+def replica_reads(function):
+    '''
+    Decorator for read only views: schedules and appointments are read from the replica
+    '''
+    @wraps(function)
+    def wrapper(request, *args, **kwargs):
+        with use_replica():
+            return function(request, *args, **kwargs)
+    return wrapper
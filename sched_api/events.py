@@ -0,0 +1,212 @@
+'''
+Live events of appointments and of the weekly schedule (schedule page).
+
+One Broadcaster per process fans events out to every connected SSE
+listener. Idle listeners are only an asyncio queue waiting for data, so
+thousands of open pages cost almost nothing compared with polling.
+When several processes serve the site, LocalChannelLayer forwards events
+between them through unix datagram sockets in a shared directory.
+'''
+
+import asyncio
+import json
+import os
+import socket
+import threading
+
+from django.conf import settings
+
+from .tenancy import facility_for_database
+
+QUEUE_SIZE = 100 # events kept for a slow listener, newer events are dropped while it is full
+
+
+class Subscription:
+    '''
+    Listener of the events stream, filtered by facility, workers, places and days
+    '''
+
+    def __init__(self, loop, workers=None, places=None, days=None, facility=None):
+        self.loop = loop
+        self.facility = facility
+        self.queue = asyncio.Queue(maxsize=QUEUE_SIZE)
+        self.workers = set(workers or ())
+        self.places = set(places or ())
+        self.days = set(days or ())
+
+    def match(self, event):
+        # empty filter means "everything"
+        if event.get('facility') != self.facility: return False
+        if self.workers and event.get('worker') not in self.workers: return False
+        if self.places and event.get('place') not in self.places: return False
+        if self.days and event.get('day') not in self.days: return False
+        return True
+
+    def push(self, event):
+        # called in the event loop of the listener
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull: # the listener stays, it gets the events after it catches up
+            pass
+
+
+class Broadcaster:
+    '''
+    In-process fan out of the events
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscriptions = set()
+        self.layer = None
+
+    def subscribe(self, workers=None, places=None, days=None, facility=None):
+        '''
+        Register a new listener in the running event loop
+
+                Parameters:
+                        workers, places (iterable): ids of Worker and Location to follow
+                        days (iterable): days in ISO format to follow
+                        facility (str): facility of the listener, None without facilities
+
+                Returns:
+                        Subscription with the queue of the events
+        '''
+        subscription = Subscription(asyncio.get_running_loop(), workers, places, days, facility)
+        with self._lock:
+            self._subscriptions.add(subscription)
+        if self.layer is not None: self.layer.start(self)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._subscriptions.discard(subscription)
+
+    def listeners(self):
+        with self._lock:
+            return len(self._subscriptions)
+
+    def publish(self, event):
+        '''
+        Send the event to the local listeners and to the other processes
+        '''
+        self.dispatch(event)
+        if self.layer is not None: self.layer.send(event)
+
+    def dispatch(self, event):
+        # can be called from any thread, queues are fed in their own loop
+        with self._lock:
+            subscriptions = [s for s in self._subscriptions if s.match(event)]
+        for subscription in subscriptions:
+            try:
+                subscription.loop.call_soon_threadsafe(subscription.push, event)
+            except RuntimeError: # loop is closed, listener is gone
+                self.unsubscribe(subscription)
+
+
+class LocalChannelLayer:
+    '''
+    Delivery of the events between processes on the same host.
+    Every process binds a datagram socket in the directory and sends
+    each event to the sockets of the others.
+    '''
+
+    def __init__(self, directory):
+        self.directory = str(directory)
+        self.path = os.path.join(self.directory, '%d.sock' % os.getpid())
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def start(self, broadcaster):
+        # receiver is started only in processes with listeners
+        with self._lock:
+            if self._thread is not None: return
+            os.makedirs(self.directory, exist_ok=True)
+            if os.path.exists(self.path): os.unlink(self.path)
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            sock.bind(self.path)
+            self._thread = threading.Thread(target=self._receive, args=(sock, broadcaster),
+                                            name='sched-events', daemon=True)
+            self._thread.start()
+
+    def _receive(self, sock, broadcaster):
+        while True:
+            data = sock.recv(65536)
+            try:
+                broadcaster.dispatch(json.loads(data))
+            except ValueError:
+                continue
+
+    def send(self, event):
+        if not os.path.isdir(self.directory): return
+        data = json.dumps(event).encode()
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        try:
+            for name in os.listdir(self.directory):
+                path = os.path.join(self.directory, name)
+                if not name.endswith('.sock') or path == self.path: continue
+                try:
+                    sock.sendto(data, path)
+                except (ConnectionRefusedError, FileNotFoundError):
+                    try: # socket of the dead process
+                        os.unlink(path)
+                    except OSError:
+                        pass
+                except OSError:
+                    continue
+        finally:
+            sock.close()
+
+
+def appointment_event(appointment, kind):
+    '''
+    Data of the appointment for the events stream
+
+            Parameters:
+                    appointment (Appointments): changed appointment
+                    kind (str): 'created', 'updated' or 'cancelled'
+
+            Returns:
+                    dict ready for JSON
+    '''
+    return {
+        'type': kind,
+        'facility': facility_for_database(appointment._state.db),
+        'id': appointment.pk,
+        'number': appointment.number,
+        'worker': appointment.worker_id,
+        'place': appointment.place_id,
+        'day': str(appointment.day),
+        'time_in': str(appointment.time_in),
+        'time_out': str(appointment.time_out),
+    }
+
+
+def schedule_event(schedule, kind):
+    '''
+    Data of the weekly segment for the events stream, 'day' is not set
+    (the segment is not a date), so listeners filtered by days skip it
+
+            Parameters:
+                    schedule (Schedule): changed segment
+                    kind (str): 'updated' or 'deleted'
+
+            Returns:
+                    dict ready for JSON with the type 'schedule'
+    '''
+    return {
+        'type': 'schedule',
+        'kind': kind,
+        'facility': facility_for_database(schedule._state.db),
+        'id': schedule.pk,
+        'worker': schedule.worker_id,
+        'place': schedule.place_id,
+        'weekday': schedule.day,
+        'time_in': str(schedule.time_in),
+        'time_out': str(schedule.time_out),
+    }
+
+
+broadcaster = Broadcaster()
+if getattr(settings, 'SCHED_EVENTS_CHANNEL_DIR', None):
+    broadcaster.layer = LocalChannelLayer(settings.SCHED_EVENTS_CHANNEL_DIR)
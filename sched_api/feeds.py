@@ -0,0 +1,219 @@
+'''
+iCalendar feeds of workers, places and specialities for calendar apps.
+
+A feed has the working hours (weekly Schedule merged with exceptions) and
+the appointments from settings.SCHED_FEED_PAST_DAYS ago to SCHED_FEED_DAYS
+ahead. It is built by a generator and streamed line by line; the built
+text is kept in the Django cache under the version of the feed, so the
+apps polling the same feed every few minutes are served from the cache.
+Changes of appointments, schedules, workers and places increment the
+versions of the feeds they appear in (signals.feed_changed); the versions
+are kept in the default cache shared by the processes.
+
+The URL of a feed has its secret token (HMAC of the feed and its database,
+settings.SCHED_FEED_SECRET or SECRET_KEY), calendar apps can not send
+other credentials. Admins get the URL from api_admin_feed.
+'''
+
+import datetime
+import hashlib
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import router, transaction
+from django.utils import timezone
+from django.utils.crypto import constant_time_compare, salted_hmac
+
+from .availability import Availability, dates
+from .models import AppointmentRow, Location, Speciality, Worker
+from .tenancy import keep_context, primary_database
+from . import metrics, refcache
+
+VERSION_KEY = 'sched_api:feed_version:'
+CONTENT_KEY = 'sched_api:feed:'
+ALL = ('all', 0) # version of all feeds of the database, e.g. after a holiday is added
+KINDS = {'worker': Worker, 'place': Location, 'speciality': Speciality}
+CONTENT_TYPE = 'text/calendar; charset=utf-8'
+
+
+def version_key(using, kind, pk):
+    return '%s%s:%s:%s' % (VERSION_KEY, using, kind, pk)
+
+
+def bump(using, feeds):
+    '''
+    New versions of the feeds, their cached texts are not used any more
+
+            Parameters:
+                    using (str): database alias
+                    feeds (iterable): (kind, id) pairs, ALL for every feed
+    '''
+    # a new random value, incr of the shared backends is not atomic and could lose a change
+    cache.set_many({version_key(using, kind, pk): uuid.uuid4().hex for kind, pk in feeds}, None)
+
+
+def invalidate(using, worker_ids=(), place_ids=(), everything=False):
+    '''
+    Bump the feeds of the workers (with their specialities) and places after commit
+
+            Parameters:
+                    using (str): database alias
+                    worker_ids, place_ids (iterable): ids of changed workers and places
+                    everything (bool): all feeds of the database
+    '''
+    worker_ids, place_ids = set(worker_ids) - {None}, set(place_ids) - {None}
+    if not (worker_ids or place_ids or everything): return
+
+    def bump_feeds():
+        if everything: return bump(using, [ALL])
+        specialities = Worker.objects.using(using).filter(pk__in=worker_ids).values_list('speciality_id', flat=True)
+        bump(using, [('worker', x) for x in worker_ids] + [('place', x) for x in place_ids] +
+             [('speciality', x) for x in set(specialities) if x is not None])
+
+    transaction.on_commit(bump_feeds, using=using)
+
+
+def database(kind):
+    # primary database of the feeds of the request (facility)
+    return primary_database(router.db_for_read(KINDS[kind]) or 'default')
+
+
+def token(kind, pk, using=None):
+    '''
+    Secret part of the URL of the feed
+
+            Parameters:
+                    kind (str): 'worker', 'place' or 'speciality'
+                    pk (int): id of the object
+                    using (str): database alias, of the current facility by default
+
+            Returns:
+                    str of 32 hex digits
+    '''
+    message = '%s:%s:%s' % (using or database(kind), kind, pk)
+    return salted_hmac('sched_api.feeds', message, secret=getattr(settings, 'SCHED_FEED_SECRET', None),
+                       algorithm='sha256').hexdigest()[:32]
+
+
+def check_token(kind, pk, value):
+    return constant_time_compare(value, token(kind, pk))
+
+
+def content_key(using, kind, pk):
+    # key of the text of the feed: versions of the feed and of all feeds, the current day
+    keys = [version_key(using, kind, pk), version_key(using, *ALL)]
+    versions = cache.get_many(keys)
+    return '%s%s:%s:%s:%s:%s:%s' % (CONTENT_KEY, using, kind, pk, versions.get(keys[0], 0),
+                                    versions.get(keys[1], 0), timezone.localdate())
+
+
+def escape(text):
+    return (str(text).replace('\\', '\\\\').replace(';', '\\;').replace(',', '\\,')
+            .replace('\r\n', '\\n').replace('\n', '\\n'))
+
+
+def fold(line):
+    # lines longer than 75 octets go on with a space on the next line
+    data = line.encode()
+    if len(data) <= 75: return line + '\r\n'
+    parts = []
+    while data:
+        size = 75 if not parts else 74
+        while size < len(data) and (data[size] & 0xC0) == 0x80: size -= 1 # not inside a character
+        parts.append(data[:size].decode())
+        data = data[size:]
+    return '\r\n '.join(parts) + '\r\n'
+
+
+def stamp(day, time):
+    moment = timezone.make_aware(datetime.datetime.combine(day, time))
+    return moment.astimezone(datetime.timezone.utc).strftime('%Y%m%dT%H%M%SZ')
+
+
+def event(uid, day, time_in, time_out, summary, location='', now=''):
+    lines = ['BEGIN:VEVENT', 'UID:%s@sched' % uid, 'DTSTAMP:' + now, 'DTSTART:' + stamp(day, time_in),
+             'DTEND:' + stamp(day, time_out), 'SUMMARY:' + escape(summary)]
+    if location: lines.append('LOCATION:' + escape(location))
+    lines.append('END:VEVENT')
+    return ''.join(fold(x) for x in lines)
+
+
+def feed_workers(kind, pk):
+    # workers whose working hours are in the feed
+    if kind == 'worker': return [pk]
+    if kind == 'speciality': return list(Worker.objects.filter(speciality_id=pk).values_list('pk', flat=True))
+    return []
+
+
+def events(kind, obj):
+    '''
+    Lines of the feed
+
+            Parameters:
+                    kind (str): 'worker', 'place' or 'speciality'
+                    obj (Model): Worker, Location or Speciality
+
+            Returns:
+                    generator of text chunks, one VEVENT each
+    '''
+    today = timezone.localdate()
+    date_from = today - datetime.timedelta(days=getattr(settings, 'SCHED_FEED_PAST_DAYS', 7))
+    date_to = today + datetime.timedelta(days=getattr(settings, 'SCHED_FEED_DAYS', 31))
+    now = timezone.now().astimezone(datetime.timezone.utc).strftime('%Y%m%dT%H%M%SZ')
+    yield ''.join(fold(x) for x in ('BEGIN:VCALENDAR', 'VERSION:2.0', 'PRODID:-//Sched//Schedule feed//EN',
+                                    'CALSCALE:GREGORIAN', 'X-WR-CALNAME:' + escape(obj)))
+
+    worker_ids = feed_workers(kind, obj.pk)
+    if worker_ids:
+        names = dict(Worker.objects.filter(pk__in=worker_ids).values_list('pk', 'name'))
+        availability = Availability(worker_ids, date_from, date_to)
+        for day in dates(date_from, date_to):
+            for worker_id in worker_ids:
+                for i, (time_in, time_out) in enumerate(availability.hours(worker_id, day)):
+                    yield event('hours-%d-%s-%d' % (worker_id, day.isoformat(), i), day, time_in, time_out,
+                                'Working hours: ' + names[worker_id], now=now)
+
+    rows = AppointmentRow.objects.filter(day__range=(date_from, date_to)).order_by('day', 'time_in')
+    rows = rows.filter(place_id=obj.pk) if kind == 'place' else rows.filter(worker_id__in=worker_ids)
+    for row in rows.iterator():
+        summary = row.title if kind == 'worker' else row.title + ' (' + row.worker_name + ')'
+        yield event('appointment-%d' % row.appointment_id, row.day, row.time_in, row.time_out, summary,
+                    row.place_name, now)
+    yield fold('END:VCALENDAR')
+
+
+def feed(kind, pk):
+    '''
+    Text of the feed from the cache or the generator which builds and caches it
+
+            Parameters:
+                    kind (str): 'worker', 'place' or 'speciality'
+                    pk (int): id of the object
+
+            Returns:
+                    (bytes or None, generator or None), (None, None) if there is no such object
+    '''
+    model = KINDS[kind]
+    key = content_key(database(kind), kind, pk)
+    content = cache.get(key)
+    metrics.cache_lookup('feed', content is not None)
+    if content is not None: return content, None
+    obj = refcache.instance(model, pk)
+    if obj is None: return None, None
+
+    def build():
+        chunks = []
+        for chunk in events(kind, obj):
+            chunk = chunk.encode()
+            chunks.append(chunk)
+            yield chunk
+        # the key has the versions read before the build, a change meanwhile makes it unused
+        cache.set(key, b''.join(chunks), getattr(settings, 'SCHED_FEED_CACHE_SECONDS', 15 * 60))
+
+    # the response is streamed after the request has left its facility
+    return None, keep_context(build())
+
+
+def etag(content):
+    return '"%s"' % hashlib.md5(content).hexdigest()
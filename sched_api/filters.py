@@ -1,21 +1,36 @@
-from django_filters.rest_framework import FilterSet, ModelChoiceFilter
-from django_tables2 import Table, Column
-from.models import Schedule, Worker
+from django_filters.rest_framework import FilterSet, ChoiceFilter
+from django_tables2 import Table, Column, RequestConfig, LazyPaginator
+from.models import Schedule, Worker, AppointmentRow, Speciality
 
 from django.forms import Select
+from . import refcache
+
+PER_PAGE = 25 # rows on one page of html tables
+
+def speciality_choices():
+    # names of specialities from the cache, values of the filter stay the same
+    return [(name, name) for name in sorted(Speciality.objects.cached_map())]
+
+def worker_choices():
+    # workers from the process cache of reference data
+    return refcache.choices(Worker)
 
 class ScheduleFilter(FilterSet):
     '''
     For filter in schedule table
     '''
-    worker__speciality = ModelChoiceFilter(label='Speciality', queryset= Worker.objects.
-                                values_list('speciality', flat=True).distinct(), 
-                                widget=Select, to_field_name = 'speciality')
+    worker = ChoiceFilter(label='Worker', choices=worker_choices, widget=Select)
+    worker__speciality = ChoiceFilter(label='Speciality', choices=speciality_choices, 
+                                widget=Select, method='filter_speciality')
 
     class Meta:
         model = Schedule
         fields = ('worker', 'worker__speciality', 'day', 'time_in', 'time_out' )
 
+    def filter_speciality(self, queryset, name, value):
+        # compare integer ids of specialities instead of the names
+        return queryset.filter(worker__speciality_id=Speciality.objects.id_for_name(value))
+
 
 class ScheduleTable(Table):  
     '''
@@ -23,12 +38,51 @@ class ScheduleTable(Table):
     '''
     id = Column()
     worker = Column()
-    worker__speciality = Column()
+    worker__speciality = Column(accessor='worker__speciality', verbose_name='Speciality')
     day = Column()
     time_in = Column()
     time_out = Column()
     
     class Meta:
-        ordering = 'description'
-        #model = Schedule
-        
+        model = Schedule
+        fields = ('id', 'worker', 'worker__speciality', 'day', 'time_in', 'time_out')
+        order_by = ('day', 'time_in') # indexed columns
+
+class WorkerTable(Table):
+    '''
+    Table for the list of workers
+    '''
+    class Meta:
+        model = Worker
+        fields = ('id', 'name', 'speciality')
+        order_by = ('name', )
+
+class AppointmentsTable(Table):
+    '''
+    Table for the list of appointments, rows are read without joins
+    '''
+    id = Column(accessor='appointment_id', verbose_name='ID')
+    worker = Column(accessor='worker_name', verbose_name='Worker')
+    place = Column(accessor='place_name', verbose_name='Place')
+    creator = Column(accessor='creator_username', verbose_name='Creator')
+
+    class Meta:
+        model = AppointmentRow
+        fields = ('id', 'number', 'worker', 'place', 'day', 'time_in', 'time_out', 
+                  'title', 'creator', 'orphaned')
+        order_by = ('day', 'time_in')
+
+def paginate_table(request, table):
+    '''
+    Sort the table in the database and cut one page of rows from it
+
+            Parameters:
+                    request (Request): Request with 'sort' and 'page' parameters
+                    table (Table): Table with queryset data
+
+            Returns:
+                    Configured table, only the rows of the page are loaded
+    '''
+    RequestConfig(request, paginate={'per_page': PER_PAGE, 
+                                     'paginator_class': LazyPaginator}).configure(table)
+    return table
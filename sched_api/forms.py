@@ -1,9 +1,13 @@
-from django.forms import ChoiceField, ModelForm, TimeInput, DateInput
+from django.forms import ChoiceField, CharField, ModelForm, TimeInput, DateInput, ModelChoiceField
+from django.core.exceptions import ValidationError
+from django.core.validators import EMPTY_VALUES
 from django.contrib.auth.forms import UserCreationForm, AuthenticationForm
+from django.conf import settings
 from django.db import transaction
-from django.db.models import Max
 
-from .models import Worker, Location, Users, Schedule, Appointments
+from .models import Worker, Location, Users, Schedule, Appointments, Speciality, ScheduleException
+from .models import WaitlistRequest, SlotHold, AppointmentSeries
+from . import refcache
 
 class SignUpForm(UserCreationForm):
     '''
@@ -27,6 +31,38 @@ class SignUpForm(UserCreationForm):
         return user
 
 
+class CachedChoiceIterator:
+    '''
+    Choices of the model from the process cache, read when the field is rendered
+    '''
+    def __init__(self, field):
+        self.field = field
+
+    def __iter__(self):
+        if self.field.empty_label is not None: yield ('', self.field.empty_label)
+        yield from refcache.choices(self.field.queryset.model)
+
+    def __len__(self):
+        return len(refcache.choices(self.field.queryset.model)) + (self.field.empty_label is not None)
+
+    def __bool__(self):
+        return self.field.empty_label is not None or bool(refcache.choices(self.field.queryset.model))
+
+class CachedModelChoiceField(ModelChoiceField):
+    '''
+    Choices and the chosen object are taken from the process cache of reference data
+    '''
+    iterator = CachedChoiceIterator
+
+    def to_python(self, value):
+        if value in EMPTY_VALUES: return None
+        if isinstance(value, self.queryset.model): value = value.pk
+        chosen = refcache.instance(self.queryset.model, value)
+        if chosen is None:
+            raise ValidationError(self.error_messages['invalid_choice'], code='invalid_choice',
+                                  params={'value': value})
+        return chosen
+
 class LogInForm(AuthenticationForm):
     '''
     for login
@@ -37,10 +73,15 @@ class WorkerForm(ModelForm):
     '''
     Form for Worker Model
     '''
+    speciality = CharField(max_length=255) # name, new specialities are added
+
     class Meta:
         model = Worker
         fields = '__all__'
 
+    def clean_speciality(self):
+        return Speciality.objects.get_by_name(self.cleaned_data['speciality'].strip())
+
 class LocationForm(ModelForm):
     '''
     Form for Location Model
@@ -62,6 +103,7 @@ class ScheduleForm(ModelForm):
     class Meta:
         model = Schedule
         fields = '__all__'
+        field_classes = {'worker': CachedModelChoiceField, 'place': CachedModelChoiceField}
         help_texts = {
             'time_in': None,
             'time_out': None,
@@ -77,6 +119,20 @@ class Date_Input(DateInput):
     '''    
     input_type = 'date'
 
+class ScheduleExceptionForm(ModelForm):
+    '''
+    Form for ScheduleException Model
+    '''
+    class Meta:
+        model = ScheduleException
+        fields = '__all__'
+        field_classes = {'worker': CachedModelChoiceField, 'place': CachedModelChoiceField}
+        widgets = {
+            'day': Date_Input(), # format entry field
+            'time_in': Time_Input(), # format entry field
+            'time_out': Time_Input(), # format entry field
+        }
+
 class AppointmentsForm(ModelForm):
     '''
     Form for Appointments Model
@@ -84,6 +140,7 @@ class AppointmentsForm(ModelForm):
     class Meta:
         model = Appointments
         fields = '__all__'
+        field_classes = {'worker': CachedModelChoiceField, 'place': CachedModelChoiceField}
         # exclude = ('creator', )
         help_texts = {
             'time_in': None,
@@ -97,9 +154,68 @@ class AppointmentsForm(ModelForm):
 
     def __init__(self, *args, **kwargs):
         super(ModelForm, self).__init__(*args, **kwargs)
-        max_number = Appointments.objects.aggregate(Max('number')) # set initial number in form
-        self.fields['number'].initial = (max_number['number__max'] or 0) + 1
+        self.fields['number'].initial = Appointments.next_number() # set initial number in form
         self.fields['creator'].disabled = True # disable creation field to prevent misdata
 
+    def save(self, commit=True):
+        if not commit or not getattr(settings, 'SCHED_GROUP_COMMIT', False): return super().save(commit)
+        # one transaction with the bookings of other requests, overlaps are checked again there
+        from .writequeue import writer
+        self.instance = writer().book(self.instance)
+        return self.instance
 
-    
\ No newline at end of file
+class WaitlistForm(ModelForm):
+    '''
+    Form for WaitlistRequest Model
+    '''
+    class Meta:
+        model = WaitlistRequest
+        fields = ('worker', 'speciality', 'day_from', 'day_to', 'time_from', 'time_to', 
+                  'duration', 'title', 'creator')
+        field_classes = {'worker': CachedModelChoiceField, 'speciality': CachedModelChoiceField}
+        widgets = {
+            'day_from': Date_Input(), # format entry field
+            'day_to': Date_Input(), # format entry field
+            'time_from': Time_Input(), # format entry field
+            'time_to': Time_Input(), # format entry field
+        }
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.fields['creator'].disabled = True # disable creation field to prevent misdata
+
+class SeriesForm(ModelForm):
+    '''
+    Form for AppointmentSeries Model, occurrences within the booking horizon are created at once
+    '''
+    class Meta:
+        model = AppointmentSeries
+        fields = ('worker', 'place', 'first_day', 'time_in', 'time_out', 'interval_days', 
+                  'until', 'count', 'title', 'creator')
+        field_classes = {'worker': CachedModelChoiceField, 'place': CachedModelChoiceField}
+        widgets = {
+            'first_day': Date_Input(), # format entry field
+            'until': Date_Input(), # format entry field
+            'time_in': Time_Input(), # format entry field
+            'time_out': Time_Input(), # format entry field
+        }
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.fields['creator'].disabled = True # disable creation field to prevent misdata
+
+    @transaction.atomic
+    def save(self, commit=True):
+        from .series import materialize
+        series = super().save(commit)
+        if commit: materialize(series)
+        return series
+
+class HoldForm(ModelForm):
+    '''
+    Form for holding the time of the booking
+    '''
+    class Meta:
+        model = SlotHold
+        fields = ('worker', 'place', 'day', 'time_in', 'time_out')
+        field_classes = {'worker': CachedModelChoiceField, 'place': CachedModelChoiceField}
@@ -0,0 +1,118 @@
+'''
+Short holds of the time while the booking form is filled.
+
+A hold of (worker, place, day, interval) is a conflict for other bookings
+until settings.SCHED_HOLD_TTL seconds pass. Expired holds are ignored by
+the checks (indexed expires_at) and deleted by the sweeper after new holds
+and new appointments: the process keeps a heap of expiry moments, so the
+table is only touched when some hold is due (or every SWEEP_INTERVAL), and
+then expired rows are deleted by the index range. The holds of the holder
+do not conflict with the holder's own bookings and are deleted by them.
+'''
+
+import datetime
+import heapq
+import threading
+import uuid
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db import transaction
+from django.utils import timezone
+
+from .models import Appointments, SlotHold
+
+SWEEP_INTERVAL = 60 # seconds, holds of other processes are swept at least that often
+
+_heap = [] # (expires_at, id of SlotHold) of holds placed by the process
+_lock = threading.Lock()
+_swept = timezone.now()
+
+
+def ttl():
+    return datetime.timedelta(seconds=getattr(settings, 'SCHED_HOLD_TTL', 300))
+
+
+def sweep(now=None):
+    '''
+    Delete expired holds if any of them is due
+
+            Returns:
+                    number of deleted holds
+    '''
+    global _swept
+    now = now or timezone.now()
+    with _lock:
+        due = bool(_heap) and _heap[0][0] <= now
+        while _heap and _heap[0][0] <= now: heapq.heappop(_heap)
+        if not due and now - _swept < datetime.timedelta(seconds=SWEEP_INTERVAL): return 0
+        _swept = now
+    return SlotHold.objects.filter(expires_at__lte=now).delete()[0]
+
+
+def place_hold(worker, place, day, time_in, time_out, holder):
+    '''
+    Hold the time for the booking
+
+            Parameters:
+                    worker (Worker), place (Location): who and where
+                    day (date), time_in, time_out (time): when
+                    holder (Users): who fills the booking form
+
+            Returns:
+                    created SlotHold, ValidationError if the time is taken or held
+    '''
+    sweep()
+    with transaction.atomic():
+        # same checks as for the appointment, active holds included
+        Appointments(number=0, worker=worker, place=place, day=day, time_in=time_in,
+                     time_out=time_out, title='hold', creator=holder).clean()
+        hold = SlotHold.objects.create(token=uuid.uuid4().hex, worker=worker, place=place, day=day,
+                                       time_in=time_in, time_out=time_out, holder=holder,
+                                       expires_at=timezone.now() + ttl())
+    with _lock:
+        heapq.heappush(_heap, (hold.expires_at, hold.pk))
+    return hold
+
+
+def release_own(appointment, using='default'):
+    '''
+    Delete the holds of the creator of the appointment for its time, the
+    booking is made through the usual form after the hold
+
+            Returns:
+                    number of deleted holds
+    '''
+    if appointment.creator_id is None: return 0
+    return SlotHold.objects.using(using).filter(
+        worker=appointment.worker_id, day=appointment.day, holder=appointment.creator_id,
+        time_in__lt=appointment.time_out, time_out__gt=appointment.time_in).delete()[0]
+
+
+def release_hold(token):
+    return SlotHold.objects.filter(token=token).delete()[0] > 0
+
+
+@transaction.atomic
+def confirm_hold(token, title, creator=None):
+    '''
+    Turn the hold into the appointment in one transaction
+
+            Parameters:
+                    token (str): token of the hold
+                    title (str): title of the appointment
+                    creator (Users): who books
+
+            Returns:
+                    created Appointments, ValidationError if the hold has expired
+    '''
+    hold = SlotHold.active().select_for_update().filter(token=token).first()
+    # the row is deleted before the checks, so the hold does not conflict with itself
+    if hold is None or not SlotHold.active().filter(pk=hold.pk).delete()[0]:
+        raise ValidationError('The hold has expired')
+    appointment = Appointments(number=Appointments.next_number(), worker_id=hold.worker_id,
+                               place_id=hold.place_id, day=hold.day, time_in=hold.time_in,
+                               time_out=hold.time_out, title=title, creator=creator or hold.holder)
+    appointment.clean()
+    appointment.save()
+    return appointment
@@ -0,0 +1,77 @@
+'''
+Flat rows of appointments for the lists (AppointmentRow).
+
+Lists of appointments show names of the worker, the place and the creator.
+The names are copied into AppointmentRow when the appointment is saved
+and updated when a worker, a place or a user is renamed, so the lists
+read one table ordered by its (day, time_in) index without joins.
+Bulk changes of appointments (solver, reconcile) call refresh_rows.
+Changed rows also invalidate the cached calendar feeds (feeds.invalidate).
+'''
+
+from django.db import transaction
+
+from .feeds import invalidate
+from .models import Appointments, AppointmentRow
+
+BATCH = 500
+NAME_FIELDS = {'worker': 'worker_name', 'place': 'place_name', 'creator': 'creator_username'}
+
+
+def row_for(appointment):
+    # flat row of the appointment, related objects are read if not loaded
+    creator = appointment.creator
+    return AppointmentRow(appointment_id=appointment.pk, number=appointment.number,
+                          worker_id=appointment.worker_id, worker_name=appointment.worker.name,
+                          place_id=appointment.place_id, place_name=appointment.place.name,
+                          day=appointment.day, time_in=appointment.time_in,
+                          time_out=appointment.time_out, title=appointment.title,
+                          creator_id=appointment.creator_id,
+                          creator_username=creator.username if creator is not None else '',
+                          orphaned=appointment.orphaned, series_id=appointment.series_id)
+
+
+def save_row(appointment, using='default'):
+    # update or insert the row of one appointment
+    appointment = Appointments.objects.using(using).select_related('worker', 'place', 'creator'
+                                                                   ).get(pk=appointment.pk)
+    old = AppointmentRow.objects.using(using).filter(pk=appointment.pk).values_list('worker_id', 'place_id').first()
+    row_for(appointment).save(using=using)
+    # calendar feeds of the old and the new worker and place
+    invalidate(using, {appointment.worker_id, old and old[0]}, {appointment.place_id, old and old[1]})
+
+
+def refresh_rows(appointment_ids, using='default'):
+    '''
+    Write the rows of the appointments again after bulk changes
+
+            Parameters:
+                    appointment_ids (iterable): ids of Appointments
+                    using (str): database alias
+    '''
+    appointment_ids = list(appointment_ids)
+    with transaction.atomic(using=using):
+        for i in range(0, len(appointment_ids), BATCH):
+            ids = appointment_ids[i:i + BATCH]
+            rows = [row_for(x) for x in Appointments.objects.using(using).filter(pk__in=ids)
+                    .select_related('worker', 'place', 'creator')]
+            old = AppointmentRow.objects.using(using).filter(appointment_id__in=ids).values_list('worker_id', 'place_id')
+            changed = list(old) + [(x.worker_id, x.place_id) for x in rows]
+            AppointmentRow.objects.using(using).filter(appointment_id__in=ids).delete()
+            AppointmentRow.objects.using(using).bulk_create(rows)
+            invalidate(using, [x[0] for x in changed], [x[1] for x in changed])
+
+
+def rename(field, object_id, name, using='default'):
+    '''
+    New name of the worker, the place or the user in all their rows
+
+            Parameters:
+                    field (str): 'worker', 'place' or 'creator'
+                    object_id (int): id of the renamed object
+                    name (str): new name
+                    using (str): database alias
+    '''
+    name_field = NAME_FIELDS[field]
+    AppointmentRow.objects.using(using).filter(**{field + '_id': object_id}).exclude(
+        **{name_field: name}).update(**{name_field: name})
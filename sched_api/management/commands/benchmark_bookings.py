@@ -0,0 +1,130 @@
+import datetime
+import os
+import tempfile
+import threading
+import time
+
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.core.management import BaseCommand, call_command
+from django.db import DatabaseError, connections
+from django.test.utils import override_settings
+
+from ... import refcache, writequeue
+from ...forms import AppointmentsForm
+from ...models import Location, Schedule, Users, Worker, speciality_cache_key
+from ...sqlite import PRODUCTION_PRAGMAS
+from ...tenancy import use_facility
+
+FACILITY = 'benchmark' # temporary facility with the database of the run
+
+
+class Command(BaseCommand):
+    '''
+    Bookings per second saved one by one and by the group writer
+    '''
+    help = ('Compare concurrent bookings through AppointmentsForm saved per request and by the group writer '
+            '(SCHED_GROUP_COMMIT) in a temporary database')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--clients', type=int, default=8, help='booking threads')
+        parser.add_argument('--bookings', type=int, default=200, help='bookings of every thread')
+        parser.add_argument('--production', action='store_true', help='WAL and the production pragmas')
+        parser.add_argument('--wait', type=float, default=0, help='ms the group writer waits for more bookings')
+
+    def handle(self, *args, **options):
+        pragmas = PRODUCTION_PRAGMAS if options['production'] else {}
+        for name, group in (('per request', False), ('group commit', True)):
+            with tempfile.TemporaryDirectory() as directory:
+                alias = self.create(os.path.join(directory, 'bench.sqlite3'))
+                try:
+                    with override_settings(SCHED_SQLITE_PRAGMAS=pragmas, SCHED_GROUP_COMMIT=group,
+                                           SCHED_GROUP_COMMIT_WAIT_MS=options['wait'],
+                                           SCHED_FACILITIES={FACILITY: {'DATABASE': alias}}):
+                        call_command('migrate', database=alias, verbosity=0)
+                        writequeue._writer = None # a new writer with the settings of the run
+                        desks = self.fill(options['clients'])
+                        started = time.perf_counter()
+                        counts = self.run_clients(desks, options['bookings'])
+                        seconds = time.perf_counter() - started
+                finally:
+                    writequeue._writer = None
+                    self.drop(alias)
+            self.stdout.write('%-13s bookings/s %8.0f  booked %d  rejected %d  locked errors %d' % (
+                name, counts['booked'] / seconds, counts['booked'], counts['rejected'], counts['errors']))
+
+    def create(self, path):
+        # database alias of the file, migrated by the caller
+        alias = 'benchmark_%d' % os.getpid()
+        connections.settings[alias] = dict(connections.settings['default'], ENGINE='django.db.backends.sqlite3',
+                                           NAME=path, OPTIONS={}, TEST={})
+        connections.ensure_defaults(alias)
+        connections.prepare_test_settings(alias)
+        self.forget(alias)
+        return alias
+
+    def drop(self, alias):
+        connections[alias].close()
+        del connections[alias]
+        del connections.settings[alias]
+        self.forget(alias)
+
+    def forget(self, alias):
+        # cached specialities and workers of the previous database with the same alias
+        cache.delete(speciality_cache_key(alias))
+        refcache.forget(alias)
+
+    def fill(self, clients):
+        # every desk books its own worker and room, open all week
+        desks = []
+        with use_facility(FACILITY):
+            user = Users.objects.create_user(username='benchmark', is_admin=True)
+            for i in range(clients):
+                worker = Worker.objects.create(name='Worker %d' % i, speciality='benchmark')
+                place = Location.objects.create(name='Room %d' % i, room=i + 1)
+                Schedule.objects.bulk_create([Schedule(worker=worker, day=day, time_in=datetime.time(0),
+                                                       time_out=datetime.time(23, 59)) for day in range(1, 8)])
+                desks.append((i, worker.pk, place.pk, user))
+        connections.close_all()
+        return desks
+
+    def requests(self, desk, count):
+        # form data of one desk: 10-minute slots from 8:00, a new day every 60 slots
+        number, worker_id, place_id, user = desk
+        for i in range(count):
+            minutes = 8 * 60 + i % 60 * 10
+            yield {'number': number * count + i + 1, 'worker': worker_id, 'place': place_id, 'creator': user.pk,
+                   'day': str(datetime.date(2030, 1, 1) + datetime.timedelta(days=i // 60)),
+                   'time_in': '%02d:%02d' % divmod(minutes, 60), 'time_out': '%02d:%02d' % divmod(minutes + 10, 60),
+                   'title': 'Benchmark %d' % i}
+
+    def run_clients(self, desks, bookings):
+        # the same path as api_admin_appointments: validation and AppointmentsForm.save
+        counts = {'booked': 0, 'rejected': 0, 'errors': 0}
+        lock = threading.Lock()
+
+        def add(key):
+            with lock: counts[key] += 1
+
+        def client(desk):
+            with use_facility(FACILITY):
+                try:
+                    for data in self.requests(desk, bookings):
+                        form = AppointmentsForm(data, initial={'creator': desk[3]})
+                        try:
+                            if not form.is_valid():
+                                add('rejected')
+                                continue
+                            form.save()
+                            add('booked')
+                        except ValidationError: # rejected by the group
+                            add('rejected')
+                        except DatabaseError: # the lock was not given within the timeout
+                            add('errors')
+                finally:
+                    connections.close_all()
+
+        threads = [threading.Thread(target=client, args=(x,)) for x in desks]
+        for thread in threads: thread.start()
+        for thread in threads: thread.join()
+        return counts
@@ -0,0 +1,51 @@
+import datetime
+import time
+
+from django.core.management import BaseCommand
+from rest_framework.renderers import JSONRenderer
+
+from ...compression import brotli, compress
+from ...models import AppointmentRow
+from ...renderers import ColumnarJSONRenderer, MessagePackRenderer, msgpack
+from ...serializers import AppointmentRowSerializer
+
+
+class Command(BaseCommand):
+    '''
+    Size and encoding time of the list of appointments in every response format
+    '''
+    help = 'Compare payload size and encode time of JSON, columnar JSON and MessagePack lists'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=1000, help='appointments in the list')
+        parser.add_argument('--repeat', type=int, default=20, help='encodings of every format')
+
+    def handle(self, *args, **options):
+        data = AppointmentRowSerializer(self.rows(options['rows']), many=True).data
+        renderers = [JSONRenderer(), ColumnarJSONRenderer()]
+        if msgpack is not None: renderers.append(MessagePackRenderer())
+        encodings = [None, 'gzip'] + (['br'] if brotli is not None else [])
+
+        self.stdout.write('%-38s %-8s %10s %10s' % ('format', 'encoding', 'bytes', 'ms'))
+        for renderer in renderers:
+            for encoding in encodings:
+                started = time.perf_counter()
+                for _ in range(options['repeat']):
+                    content = renderer.render(data)
+                    if encoding is not None: content = compress(content, encoding)
+                seconds = (time.perf_counter() - started) / options['repeat']
+                self.stdout.write('%-38s %-8s %10d %10.2f' % (
+                    renderer.media_type, encoding or '-', len(content), seconds * 1000))
+        if msgpack is None: self.stdout.write('MessagePack: install msgpack')
+        if brotli is None: self.stdout.write('brotli: install brotli')
+
+    def rows(self, count):
+        # rows of a clinic: a few dozen workers and places, 20 appointments of every worker a day
+        day = datetime.date(2022, 6, 20)
+        return [AppointmentRow(appointment_id=i + 1, number=i + 1, worker_id=i % 40, 
+                               worker_name='Worker %d' % (i % 40), place_id=i % 25, place_name='Room %d' % (i % 25),
+                               day=day + datetime.timedelta(days=i // 800), 
+                               time_in=datetime.time(8 + i // 40 % 20 // 2, i // 40 % 2 * 30),
+                               time_out=datetime.time(8 + i // 40 % 20 // 2, i // 40 % 2 * 30 + 29),
+                               title='Appointment %d' % i, creator_id=1, creator_username='admin', orphaned=False)
+                for i in range(count)]
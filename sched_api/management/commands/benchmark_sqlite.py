@@ -0,0 +1,91 @@
+import os
+import random
+import sqlite3
+import tempfile
+import threading
+import time
+
+from django.core.management import BaseCommand
+
+from ...sqlite import PRODUCTION_PRAGMAS, apply_pragmas
+
+# (name, pragmas, new connection for every request as with CONN_MAX_AGE = 0)
+PROFILES = (
+    ('default', {}, True),
+    ('production', PRODUCTION_PRAGMAS, False),
+)
+
+
+class Command(BaseCommand):
+    '''
+    Concurrent reads and writes of appointments with the default and the production SQLite profile
+    '''
+    help = 'Measure throughput of concurrent readers and one writer for SQLite profiles'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--readers', type=int, default=4, help='reading threads')
+        parser.add_argument('--seconds', type=float, default=3, help='duration of every profile')
+        parser.add_argument('--rows', type=int, default=20000, help='appointments in the table')
+
+    def handle(self, *args, **options):
+        for name, pragmas, reconnect in PROFILES:
+            with tempfile.TemporaryDirectory() as directory:
+                path = os.path.join(directory, 'bench.sqlite3')
+                self.fill(path, pragmas, options['rows'])
+                reads, writes, errors = self.run(path, pragmas, reconnect, options['readers'], 
+                                                 options['seconds'])
+            self.stdout.write('%-10s reads/s %8.0f  writes/s %6.0f  locked errors %d' % (
+                name, reads / options['seconds'], writes / options['seconds'], errors))
+
+    def connect(self, path, pragmas):
+        connection = sqlite3.connect(path, timeout=5, check_same_thread=False)
+        apply_pragmas(connection, pragmas)
+        return connection
+
+    def fill(self, path, pragmas, rows):
+        connection = self.connect(path, pragmas)
+        connection.execute('CREATE TABLE appointment (id INTEGER PRIMARY KEY, worker_id INTEGER, '
+                           'day TEXT, time_in TEXT, title TEXT)')
+        connection.execute('CREATE INDEX appointment_day_time ON appointment (day, time_in)')
+        connection.executemany('INSERT INTO appointment (worker_id, day, time_in, title) VALUES (?, ?, ?, ?)',
+                               [(i % 40, '2022-06-%02d' % (i % 28 + 1), '%02d:%02d' % (8 + i % 10, i % 60), 
+                                 'appointment %d' % i) for i in range(rows)])
+        connection.commit()
+        connection.close()
+
+    def run(self, path, pragmas, reconnect, readers, seconds):
+        counts = {'reads': 0, 'writes': 0, 'errors': 0}
+        lock = threading.Lock()
+        deadline = time.monotonic() + seconds
+
+        def add(key):
+            with lock: counts[key] += 1
+
+        def reader():
+            connection = None if reconnect else self.connect(path, pragmas)
+            while time.monotonic() < deadline:
+                current = connection or self.connect(path, pragmas)
+                try:
+                    current.execute('SELECT id, worker_id, time_in, title FROM appointment WHERE day = ? '
+                                    'ORDER BY time_in LIMIT 50', ('2022-06-%02d' % random.randint(1, 28),)
+                                    ).fetchall()
+                    add('reads')
+                except sqlite3.OperationalError:
+                    add('errors')
+                if connection is None: current.close()
+
+        def writer():
+            connection = self.connect(path, pragmas)
+            while time.monotonic() < deadline:
+                try:
+                    with connection: # one transaction for every booking
+                        connection.execute('INSERT INTO appointment (worker_id, day, time_in, title) '
+                                           'VALUES (?, ?, ?, ?)', (1, '2022-06-20', '09:00', 'new'))
+                    add('writes')
+                except sqlite3.OperationalError:
+                    add('errors')
+
+        threads = [threading.Thread(target=reader) for _ in range(readers)] + [threading.Thread(target=writer)]
+        for thread in threads: thread.start()
+        for thread in threads: thread.join()
+        return counts['reads'], counts['writes'], counts['errors']
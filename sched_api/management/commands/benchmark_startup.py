@@ -0,0 +1,46 @@
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+from django.conf import settings
+from django.core.management import BaseCommand
+
+PROFILES = ('Sched.settings', 'Sched.settings_api')
+
+# fresh interpreter: time and memory until the worker is ready to serve (URLconf and views loaded)
+WORKER = '''
+import json, os, resource, sys, time
+started = time.perf_counter()
+from django.core.wsgi import get_wsgi_application
+application = get_wsgi_application()
+from django.urls import get_resolver
+get_resolver().url_patterns
+seconds = time.perf_counter() - started
+with open('/proc/self/statm') as file: rss = int(file.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+print(json.dumps({'seconds': seconds, 'rss': rss, 'modules': len(sys.modules),
+                  'tables': 'django_tables2' in sys.modules}))
+'''
+
+
+class Command(BaseCommand):
+    '''
+    Startup time and memory of workers of the full and API-only profiles
+    '''
+    help = 'Measure import time and resident memory of a new worker for every settings profile'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--repeat', type=int, default=5, help='workers started for every profile')
+        parser.add_argument('--profile', action='append', help='settings module, both profiles by default')
+
+    def handle(self, *args, **options):
+        for profile in options['profile'] or PROFILES:
+            env = dict(os.environ, DJANGO_SETTINGS_MODULE=profile)
+            runs = [json.loads(subprocess.run([sys.executable, '-c', WORKER], env=env, check=True,
+                                              cwd=settings.BASE_DIR, capture_output=True).stdout)
+                    for _ in range(options['repeat'])]
+            self.stdout.write('%-20s ready in %6.1f ms, RSS %5.1f MB, %4d modules, tables loaded: %s' % (
+                profile, statistics.median(x['seconds'] for x in runs) * 1000,
+                statistics.median(x['rss'] for x in runs) / 2 ** 20, runs[0]['modules'],
+                'yes' if runs[0]['tables'] else 'no'))
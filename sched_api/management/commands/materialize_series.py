@@ -0,0 +1,21 @@
+from django.core.management import BaseCommand
+
+from ...series import materialize_due
+from ...tenancy import command_facilities, use_facility
+
+
+class Command(BaseCommand):
+    '''
+    Create appointments of recurring series up to the booking horizon
+    '''
+    help = 'Create appointments of recurring series up to the booking horizon, run it daily'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--facility', help='only the facility, by default all facilities and the default database')
+
+    def handle(self, *args, **options):
+        for facility in command_facilities(options['facility']):
+            with use_facility(facility):
+                created = materialize_due()
+            prefix = 'Facility %s: ' % facility if facility is not None else ''
+            self.stdout.write(prefix + 'Series: %d, appointments created: %d' % (len(created), sum(created.values())))
@@ -0,0 +1,17 @@
+from django.core.management import BaseCommand, call_command
+
+from ...tenancy import facilities
+
+
+class Command(BaseCommand):
+    '''
+    Apply migrations to the databases of all facilities
+    '''
+    help = 'Apply migrations to the default database and the databases of all facilities'
+
+    def handle(self, *args, **options):
+        aliases = ['default'] + [x['DATABASE'] for x in facilities().values()]
+        for alias in dict.fromkeys(aliases):
+            self.stdout.write('Database: ' + alias)
+            call_command('migrate', database=alias, verbosity=options['verbosity'], 
+                         interactive=False)
@@ -0,0 +1,24 @@
+from django.core.management import BaseCommand
+
+from ...reconcile import reconcile
+from ...tenancy import command_facilities, use_facility
+
+
+class Command(BaseCommand):
+    '''
+    Flag future appointments outside working hours
+    '''
+    help = 'Flag future appointments outside working hours of their workers'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--worker', type=int, action='append', help='check only the worker (id)')
+        parser.add_argument('--move', action='store_true', 
+                            help='move appointments to free workers of the same speciality')
+        parser.add_argument('--facility', help='only the facility, by default all facilities and the default database')
+
+    def handle(self, *args, **options):
+        for facility in command_facilities(options['facility']):
+            with use_facility(facility):
+                flagged, moved = reconcile(options['worker'], move=options['move'])
+            prefix = 'Facility %s: ' % facility if facility is not None else ''
+            self.stdout.write(prefix + 'Outside working hours: %d, moved: %d' % (flagged, moved))
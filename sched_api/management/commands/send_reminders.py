@@ -0,0 +1,39 @@
+import time
+
+from django.core.management import BaseCommand
+from django.utils import timezone
+
+from ...reminders import SCAN_INTERVAL, ReminderScheduler
+from ...tenancy import command_facilities, use_facility
+
+
+class Command(BaseCommand):
+    '''
+    Send reminders of upcoming appointments
+    '''
+    help = 'Send reminders SCHED_REMINDER_HOURS before appointments, runs until stopped'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help='send the due reminders and exit')
+        parser.add_argument('--facility', help='only the facility, by default all facilities and the default database')
+
+    def handle(self, *args, **options):
+        # one heap for every database
+        schedulers = {x: ReminderScheduler() for x in command_facilities(options['facility'])}
+        scanned = None
+        while True:
+            now = timezone.now()
+            scan = scanned is None or (now - scanned).total_seconds() >= SCAN_INTERVAL
+            sent = 0
+            for facility, scheduler in schedulers.items():
+                with use_facility(facility):
+                    if scan: scheduler.scan(now)
+                    sent += scheduler.run_pending(now)
+            if scan: scanned = now
+            if sent: self.stdout.write('Reminders sent: %d' % sent)
+            if options['once']: return
+            # sleep until the next reminder or the next scan
+            wake = SCAN_INTERVAL - (timezone.now() - scanned).total_seconds()
+            due = [x.next_due() for x in schedulers.values() if x.next_due() is not None]
+            if due: wake = min(wake, (min(due) - timezone.now()).total_seconds())
+            time.sleep(max(wake, 0.1))
@@ -0,0 +1,41 @@
+import json
+
+from django.core.management import BaseCommand, CommandError
+
+from ...solver import Solver
+from ...tenancy import command_facilities, use_facility
+
+
+class Command(BaseCommand):
+    '''
+    Place the batch of booking requests from the JSON file
+    '''
+    help = ('Place booking requests from the JSON file (list of objects with speciality or worker, '
+            'day, time_from, time_to, duration and title) into free time of workers and rooms')
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='JSON file with requests')
+        parser.add_argument('--dry-run', action='store_true', help='do not create appointments')
+        parser.add_argument('--facility', help='facility of the requests, the default database by default')
+
+    def handle(self, *args, **options):
+        # the requests name workers of one database
+        facility = command_facilities(options['facility'])[0] if options['facility'] else None
+        with use_facility(facility):
+            self.solve(options)
+
+    def solve(self, options):
+        try:
+            with open(options['path']) as file:
+                solver = Solver(json.load(file))
+        except (OSError, ValueError, KeyError) as err:
+            raise CommandError(str(err))
+        solver.solve()
+        if not options['dry_run']: solver.save()
+        report = solver.report()
+        self.stdout.write('Placed %d of %d requests in %.3f s' % (
+            report['placed'], report['requests'], report['seconds']))
+        if report['unplaced']:
+            self.stdout.write('Not placed: ' + ', '.join(str(x) for x in report['unplaced']))
+        for rejected in report['rejected']:
+            self.stdout.write('Not saved: %d, %s' % (rejected['index'], rejected['reason']))
@@ -0,0 +1,269 @@
+'''
+Metrics of requests, queries, bookings and caches in the Prometheus text
+exposition format (/metrics).
+
+Every thread writes into its own dict, so recording takes no locks; the
+dicts are summed only when the metrics are read. Dicts of finished threads
+are added to one total and dropped, so servers starting a thread per
+request do not keep them. With several worker processes (gunicorn) set
+settings.SCHED_METRICS_DIR: each process dumps its values there from time
+to time and /metrics sums the files of all processes; files of dead
+processes are added to retired.json and removed.
+'''
+
+import fcntl
+import json
+import os
+import threading
+import time
+from contextlib import ExitStack
+
+from django.conf import settings
+from django.db import connections
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500)
+DUMP_INTERVAL = 5 # seconds between dumps of the process into SCHED_METRICS_DIR
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+_metrics = {} # name: (type, help, buckets)
+_shards = [] # (thread, values) of every running thread
+_retired = {} # values of finished threads
+_shards_lock = threading.Lock()
+_local = threading.local()
+RETIRED_FILE = 'retired.json' # values of dead processes in SCHED_METRICS_DIR
+_dumped = 0
+
+
+def counter(name, help):
+    _metrics[name] = ('counter', help, None)
+
+
+def histogram(name, help, buckets=LATENCY_BUCKETS):
+    _metrics[name] = ('histogram', help, buckets)
+
+
+counter('sched_requests_total', 'Requests by view and status')
+histogram('sched_request_seconds', 'Request latency by view')
+histogram('sched_request_db_seconds', 'Time of database queries per request by view')
+histogram('sched_request_queries', 'Database queries per request by view', QUERY_BUCKETS)
+histogram('sched_overlap_check_seconds', 'Time of overlap checks of bookings')
+counter('sched_booking_rejections_total', 'Rejected bookings by reason')
+histogram('sched_group_commit_size', 'Bookings written in one transaction by the group writer', QUERY_BUCKETS)
+counter('sched_cache_requests_total', 'Cache lookups by cache and result (hit or miss)')
+
+
+def _values():
+    # values of the current thread, {(name, labels): number or [buckets..., sum, count]}
+    values = getattr(_local, 'values', None)
+    if values is None:
+        values = _local.values = {}
+        with _shards_lock:
+            _retire_threads()
+            _shards.append((threading.current_thread(), values))
+    return values
+
+
+def _retire_threads():
+    # values of finished threads are added to one total, called with the lock
+    for shard in [x for x in _shards if not x[0].is_alive()]:
+        _shards.remove(shard)
+        for key, value in shard[1].items(): _add(_retired, key, value)
+
+
+def inc(name, value=1, **labels):
+    key = (name, tuple(sorted(labels.items())))
+    values = _values()
+    values[key] = values.get(key, 0) + value
+
+
+def observe(name, value, **labels):
+    key = (name, tuple(sorted(labels.items())))
+    values = _values()
+    row = values.get(key)
+    if row is None:
+        row = values[key] = [0] * (len(_metrics[name][2]) + 2)
+    # only the first bucket of the value, render() adds them up
+    for i, bound in enumerate(_metrics[name][2]):
+        if value <= bound:
+            row[i] += 1
+            break
+    row[-2] += value
+    row[-1] += 1
+
+
+def cache_lookup(cache, hit):
+    inc('sched_cache_requests_total', cache=cache, result='hit' if hit else 'miss')
+
+
+def _add(total, key, value):
+    if isinstance(value, list):
+        row = total.setdefault(key, [0] * len(value))
+        for i, x in enumerate(value): row[i] += x
+    else:
+        total[key] = total.get(key, 0) + value
+
+
+def snapshot():
+    # sum of the values of all threads of the process
+    with _shards_lock:
+        _retire_threads()
+        shards = [_retired] + [x[1] for x in _shards]
+        total = {}
+        for values in shards:
+            for key, value in list(values.items()): _add(total, key, value)
+    return total
+
+
+def dump(force=False):
+    '''
+    Write the values of the process into SCHED_METRICS_DIR (not more often
+    than DUMP_INTERVAL seconds)
+    '''
+    global _dumped
+    directory = getattr(settings, 'SCHED_METRICS_DIR', None)
+    if not directory or (not force and time.monotonic() - _dumped < DUMP_INTERVAL): return
+    _dumped = time.monotonic()
+    _write(os.path.join(directory, '%d.json' % os.getpid()), snapshot())
+
+
+def collect():
+    # values of all processes
+    directory = getattr(settings, 'SCHED_METRICS_DIR', None)
+    total = snapshot()
+    if not directory: return total
+    own = '%d.json' % os.getpid()
+    for file_name in os.listdir(directory):
+        pid = file_name[:-len('.json')]
+        if file_name.endswith('.json') and pid.isdigit() and not _alive(int(pid)):
+            _retire_process(directory, file_name)
+    for file_name in os.listdir(directory):
+        if not file_name.endswith('.json') or file_name == own: continue
+        try:
+            with open(os.path.join(directory, file_name)) as file: rows = json.load(file)
+        except (OSError, ValueError):
+            continue
+        for name, labels, value in rows:
+            if name in _metrics: _add(total, (name, tuple(tuple(x) for x in labels)), value)
+    return total
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError: # process of another user
+        return True
+    return True
+
+
+def _read(path):
+    # {(name, labels): value} of the file
+    with open(path) as file:
+        return {(name, tuple(tuple(x) for x in labels)): value for name, labels, value in json.load(file)}
+
+
+def _write(path, values):
+    rows = [[name, list(labels), value] for (name, labels), value in values.items()]
+    with open(path + '.tmp', 'w') as file:
+        json.dump(rows, file)
+    os.replace(path + '.tmp', path) # readers never see a half written file
+
+
+def _retire_process(directory, file_name):
+    # the values of the dead process are kept in RETIRED_FILE, counters do not go down
+    with open(os.path.join(directory, 'retired.lock'), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        path, retired_path = os.path.join(directory, file_name), os.path.join(directory, RETIRED_FILE)
+        try:
+            values = _read(path)
+        except FileNotFoundError: # retired by another process
+            return
+        except (OSError, ValueError):
+            values = {}
+        try:
+            retired = _read(retired_path)
+        except (OSError, ValueError):
+            retired = {}
+        for key, value in values.items(): _add(retired, key, value)
+        _write(retired_path, retired)
+        os.unlink(path)
+
+
+def _labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs: return ''
+    return '{' + ','.join('%s="%s"' % (key, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                          for key, value in pairs) + '}'
+
+
+def render():
+    '''
+    All metrics in the text exposition format
+    '''
+    values = collect()
+    lines = []
+    for name, (kind, help, buckets) in _metrics.items():
+        lines.append('# HELP %s %s' % (name, help))
+        lines.append('# TYPE %s %s' % (name, kind))
+        for (metric, labels), value in sorted(values.items()):
+            if metric != name: continue
+            if kind == 'counter':
+                lines.append('%s%s %s' % (name, _labels(labels), value))
+                continue
+            cumulative = 0
+            for bound, count in zip(buckets, value):
+                cumulative += count # the buckets are stored not cumulative
+                lines.append('%s_bucket%s %d' % (name, _labels(labels, [('le', bound)]), cumulative))
+            lines.append('%s_bucket%s %d' % (name, _labels(labels, [('le', '+Inf')]), value[-1]))
+            lines.append('%s_sum%s %s' % (name, _labels(labels), value[-2]))
+            lines.append('%s_count%s %d' % (name, _labels(labels), value[-1]))
+    return '\n'.join(lines) + '\n'
+
+
+class QueryTimer:
+    '''
+    Execute wrapper counting queries and their time
+    '''
+
+    def __init__(self):
+        self.queries = 0
+        self.seconds = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.seconds += time.perf_counter() - started
+            self.queries += 1
+
+
+class MetricsMiddleware:
+    '''
+    Latency, number of queries and time of queries of every request by the URL name
+    '''
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        timer = QueryTimer()
+        started = time.perf_counter()
+        status = 500
+        try:
+            with ExitStack() as stack:
+                for alias in connections:
+                    stack.enter_context(connections[alias].execute_wrapper(timer))
+                response = self.get_response(request)
+            status = response.status_code
+            return response
+        finally:
+            match = getattr(request, 'resolver_match', None)
+            view = match.url_name if match is not None and match.url_name else 'unmatched'
+            inc('sched_requests_total', view=view, status=status)
+            observe('sched_request_seconds', time.perf_counter() - started, view=view)
+            observe('sched_request_db_seconds', timer.seconds, view=view)
+            observe('sched_request_queries', timer.queries, view=view)
+            dump()
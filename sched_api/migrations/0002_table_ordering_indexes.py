@@ -0,0 +1,21 @@
+# Generated by Django 4.0.5 on 2026-10-19 16:22
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sched_api', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='appointments',
+            index=models.Index(fields=['day', 'time_in'], name='appointments_day_time_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='schedule',
+            index=models.Index(fields=['day', 'time_in'], name='schedule_day_time_idx'),
+        ),
+    ]
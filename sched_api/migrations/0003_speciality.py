@@ -0,0 +1,72 @@
+# Generated by Django 4.0.5 on 2026-10-19 16:40
+
+from django.db import migrations, models
+import django.db.models.deletion
+import sched_api.models
+
+
+def specialities_forward(apps, schema_editor):
+    # move free text specialities of workers to the Speciality table
+    Worker = apps.get_model('sched_api', 'Worker')
+    Speciality = apps.get_model('sched_api', 'Speciality')
+    db = schema_editor.connection.alias
+    names = Worker.objects.using(db).values_list('speciality', flat=True).distinct()
+    Speciality.objects.using(db).bulk_create([Speciality(name=name) for name in names])
+    ids = dict(Speciality.objects.using(db).values_list('name', 'id'))
+    for name, speciality_id in ids.items():
+        Worker.objects.using(db).filter(speciality=name).update(speciality_ref=speciality_id)
+
+
+def specialities_backward(apps, schema_editor):
+    Worker = apps.get_model('sched_api', 'Worker')
+    Speciality = apps.get_model('sched_api', 'Speciality')
+    db = schema_editor.connection.alias
+    for speciality in Speciality.objects.using(db).all():
+        Worker.objects.using(db).filter(speciality_ref=speciality.id).update(speciality=speciality.name)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sched_api', '0002_table_ordering_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Speciality',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(db_index=True, max_length=255, unique=True)),
+            ],
+            options={
+                'verbose_name': 'Speciality',
+                'verbose_name_plural': 'Specialities',
+                'ordering': ('name',),
+            },
+        ),
+        migrations.AddField(
+            model_name='worker',
+            name='speciality_ref',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.PROTECT, related_name='+', to='sched_api.speciality'),
+        ),
+        migrations.RunPython(specialities_forward, specialities_backward),
+        migrations.AlterField(
+            model_name='worker',
+            name='speciality',
+            field=models.CharField(db_index=True, default='', max_length=255),
+        ),
+        migrations.RemoveField(
+            model_name='worker',
+            name='speciality',
+        ),
+        migrations.RenameField(
+            model_name='worker',
+            old_name='speciality_ref',
+            new_name='speciality',
+        ),
+        migrations.AlterField(
+            model_name='worker',
+            name='speciality',
+            field=sched_api.models.SpecialityField(on_delete=django.db.models.deletion.PROTECT, related_name='workers', to='sched_api.speciality'),
+        ),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 4.0.5 on 2026-10-19 17:05
+
+from django.db import migrations
+
+FTS_TABLE = 'sched_api_worker_fts'
+
+
+def create_fts(apps, schema_editor):
+    # full-text index of workers exists only in SQLite
+    if schema_editor.connection.vendor != 'sqlite': return
+    Worker = apps.get_model('sched_api', 'Worker')
+    schema_editor.execute(
+        'CREATE VIRTUAL TABLE IF NOT EXISTS %s USING fts5(name, speciality, '
+        'tokenize="unicode61 remove_diacritics 2")' % FTS_TABLE)
+    db = schema_editor.connection.alias
+    for worker_id, name, speciality in Worker.objects.using(db).values_list('id', 'name', 'speciality__name'):
+        schema_editor.execute('INSERT INTO %s (rowid, name, speciality) VALUES (%%s, %%s, %%s)' % FTS_TABLE,
+                              [worker_id, name, speciality])
+
+
+def drop_fts(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite': return
+    schema_editor.execute('DROP TABLE IF EXISTS %s' % FTS_TABLE)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sched_api', '0003_speciality'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_fts, drop_fts),
+    ]
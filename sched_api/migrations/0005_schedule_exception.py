@@ -0,0 +1,39 @@
+# Generated by Django 4.0.5 on 2026-10-19 16:29
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sched_api', '0004_worker_fts'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ScheduleException',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('closure', 'Closure'), ('extra', 'Extra shift')], default='closure', max_length=16)),
+                ('day', models.DateField(db_index=True, verbose_name='Day')),
+                ('time_in', models.TimeField(blank=True, null=True, verbose_name='Starting time')),
+                ('time_out', models.TimeField(blank=True, null=True, verbose_name='Final time')),
+                ('title', models.CharField(blank=True, max_length=255)),
+                ('place', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='schedule_exceptions', to='sched_api.location')),
+                ('worker', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='schedule_exceptions', to='sched_api.worker', verbose_name='Staff')),
+            ],
+            options={
+                'verbose_name': 'Schedule exception',
+                'verbose_name_plural': 'Schedule exceptions',
+            },
+        ),
+        migrations.AddIndex(
+            model_name='scheduleexception',
+            index=models.Index(fields=['worker', 'day'], name='exception_worker_day_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='scheduleexception',
+            index=models.Index(fields=['place', 'day'], name='exception_place_day_idx'),
+        ),
+    ]
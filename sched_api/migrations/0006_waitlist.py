@@ -0,0 +1,45 @@
+# Generated by Django 4.0.5 on 2026-10-19 16:31
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sched_api', '0005_schedule_exception'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='WaitlistRequest',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day_from', models.DateField(verbose_name='First day')),
+                ('day_to', models.DateField(verbose_name='Last day')),
+                ('time_from', models.TimeField(verbose_name='Earliest time')),
+                ('time_to', models.TimeField(verbose_name='Latest time')),
+                ('duration', models.PositiveIntegerField(verbose_name='Duration, minutes')),
+                ('title', models.CharField(max_length=255)),
+                ('status', models.CharField(choices=[('waiting', 'Waiting'), ('booked', 'Booked'), ('cancelled', 'Cancelled')], default='waiting', max_length=16)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('appointment', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='waitlist', to='sched_api.appointments')),
+                ('creator', models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='waitlist', to=settings.AUTH_USER_MODEL)),
+                ('speciality', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='waitlist', to='sched_api.speciality')),
+                ('worker', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='waitlist', to='sched_api.worker', verbose_name='Staff')),
+            ],
+            options={
+                'verbose_name': 'Waitlist request',
+                'verbose_name_plural': 'Waitlist',
+            },
+        ),
+        migrations.AddIndex(
+            model_name='waitlistrequest',
+            index=models.Index(fields=['worker', 'status', 'day_from', 'time_from'], name='waitlist_worker_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='waitlistrequest',
+            index=models.Index(fields=['speciality', 'status', 'day_from', 'time_from'], name='waitlist_speciality_idx'),
+        ),
+    ]
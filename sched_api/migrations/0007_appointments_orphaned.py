@@ -0,0 +1,18 @@
+# Generated by Django 4.0.5 on 2026-10-19 16:36
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sched_api', '0006_waitlist'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='appointments',
+            name='orphaned',
+            field=models.BooleanField(db_index=True, default=False, editable=False, verbose_name='Outside working hours'),
+        ),
+    ]
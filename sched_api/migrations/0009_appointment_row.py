@@ -0,0 +1,59 @@
+# Generated by Django 4.0.5 on 2026-10-19 16:45
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def rows_forward(apps, schema_editor):
+    # flat rows of the existing appointments
+    Appointments = apps.get_model('sched_api', 'Appointments')
+    AppointmentRow = apps.get_model('sched_api', 'AppointmentRow')
+    db = schema_editor.connection.alias
+    rows = (AppointmentRow(appointment_id=x.pk, number=x.number, worker_id=x.worker_id, 
+                           worker_name=x.worker.name, place_id=x.place_id, place_name=x.place.name,
+                           day=x.day, time_in=x.time_in, time_out=x.time_out, title=x.title,
+                           creator_id=x.creator_id, orphaned=x.orphaned,
+                           creator_username=x.creator.username if x.creator_id else '')
+            for x in Appointments.objects.using(db).select_related('worker', 'place', 'creator').iterator())
+    AppointmentRow.objects.using(db).bulk_create(rows, batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sched_api', '0008_idempotency'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AppointmentRow',
+            fields=[
+                ('appointment', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='row', serialize=False, to='sched_api.appointments')),
+                ('number', models.IntegerField()),
+                ('worker_id', models.BigIntegerField()),
+                ('worker_name', models.CharField(max_length=255, verbose_name='Worker')),
+                ('place_id', models.BigIntegerField(db_index=True)),
+                ('place_name', models.CharField(max_length=255, verbose_name='Place')),
+                ('day', models.DateField(verbose_name='Day')),
+                ('time_in', models.TimeField(verbose_name='Starting time')),
+                ('time_out', models.TimeField(verbose_name='Final time')),
+                ('title', models.CharField(max_length=255)),
+                ('creator_id', models.BigIntegerField(db_index=True, null=True)),
+                ('creator_username', models.CharField(blank=True, max_length=150, verbose_name='Creator')),
+                ('orphaned', models.BooleanField(default=False, verbose_name='Outside working hours')),
+            ],
+            options={
+                'verbose_name': 'Appointment row',
+                'verbose_name_plural': 'Appointment rows',
+            },
+        ),
+        migrations.AddIndex(
+            model_name='appointmentrow',
+            index=models.Index(fields=['day', 'time_in'], name='appointment_row_day_time_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='appointmentrow',
+            index=models.Index(fields=['worker_id', 'day', 'time_in'], name='appointment_row_worker_idx'),
+        ),
+        migrations.RunPython(rows_forward, migrations.RunPython.noop),
+    ]
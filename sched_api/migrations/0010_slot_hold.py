@@ -0,0 +1,41 @@
+# Generated by Django 4.0.5 on 2026-10-19 16:50
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sched_api', '0009_appointment_row'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SlotHold',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('token', models.CharField(max_length=32, unique=True)),
+                ('day', models.DateField(verbose_name='Day')),
+                ('time_in', models.TimeField(verbose_name='Starting time')),
+                ('time_out', models.TimeField(verbose_name='Final time')),
+                ('expires_at', models.DateTimeField(db_index=True)),
+                ('holder', models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='holds', to=settings.AUTH_USER_MODEL)),
+                ('place', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='holds', to='sched_api.location')),
+                ('worker', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='holds', to='sched_api.worker')),
+            ],
+            options={
+                'verbose_name': 'Slot hold',
+                'verbose_name_plural': 'Slot holds',
+            },
+        ),
+        migrations.AddIndex(
+            model_name='slothold',
+            index=models.Index(fields=['worker', 'day', 'expires_at'], name='hold_worker_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='slothold',
+            index=models.Index(fields=['place', 'day', 'expires_at'], name='hold_place_idx'),
+        ),
+    ]
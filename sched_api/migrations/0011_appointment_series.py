@@ -0,0 +1,49 @@
+# Generated by Django 4.0.5 on 2026-10-19 16:56
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sched_api', '0010_slot_hold'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AppointmentSeries',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('first_day', models.DateField(verbose_name='First day')),
+                ('time_in', models.TimeField(verbose_name='Starting time')),
+                ('time_out', models.TimeField(verbose_name='Final time')),
+                ('interval_days', models.PositiveIntegerField(default=7, verbose_name='Every N days')),
+                ('until', models.DateField(blank=True, null=True, verbose_name='Last day')),
+                ('count', models.PositiveIntegerField(blank=True, null=True, verbose_name='Number of occurrences')),
+                ('title', models.CharField(max_length=255)),
+                ('materialized_until', models.DateField(blank=True, editable=False, null=True)),
+                ('creator', models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='series', to=settings.AUTH_USER_MODEL)),
+                ('place', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='series', to='sched_api.location')),
+                ('worker', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='series', to='sched_api.worker')),
+            ],
+            options={
+                'verbose_name': 'Appointment series',
+                'verbose_name_plural': 'Appointment series',
+            },
+        ),
+        migrations.AddField(
+            model_name='appointments',
+            name='series',
+            field=models.ForeignKey(blank=True, editable=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='appointments', to='sched_api.appointmentseries'),
+        ),
+        migrations.AddIndex(
+            model_name='appointmentseries',
+            index=models.Index(fields=['worker', 'first_day'], name='series_worker_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='appointmentseries',
+            index=models.Index(fields=['place', 'first_day'], name='series_place_idx'),
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 4.0.5 on 2026-10-19 16:58
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sched_api', '0011_appointment_series'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SentReminder',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('hours', models.PositiveSmallIntegerField(verbose_name='Hours before')),
+                ('claimed_by', models.CharField(max_length=32)),
+                ('sent_at', models.DateTimeField(blank=True, null=True)),
+                ('appointment', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='reminders', to='sched_api.appointments')),
+            ],
+            options={
+                'verbose_name': 'Sent reminder',
+                'verbose_name_plural': 'Sent reminders',
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='sentreminder',
+            constraint=models.UniqueConstraint(fields=('appointment', 'hours'), name='reminder_once'),
+        ),
+    ]
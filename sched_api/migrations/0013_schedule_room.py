@@ -0,0 +1,28 @@
+# Generated by Django 4.0.5 on 2026-10-19 17:09
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sched_api', '0012_sent_reminder'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='schedule',
+            name='place',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='shifts', to='sched_api.location', verbose_name='Room'),
+        ),
+        migrations.AlterField(
+            model_name='appointments',
+            name='place',
+            field=models.ForeignKey(blank=True, help_text='Room of the shift if empty', on_delete=django.db.models.deletion.CASCADE, related_name='place', to='sched_api.location'),
+        ),
+        migrations.AddIndex(
+            model_name='schedule',
+            index=models.Index(fields=['place', 'day', 'time_in'], name='schedule_place_day_time_idx'),
+        ),
+    ]
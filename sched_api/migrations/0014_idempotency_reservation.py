@@ -0,0 +1,23 @@
+# Generated by Django 4.0.5 on 2026-10-19 17:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sched_api', '0013_schedule_room'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='idempotencyrecord',
+            name='body_hash',
+            field=models.CharField(blank=True, max_length=64),
+        ),
+        migrations.AlterField(
+            model_name='idempotencyrecord',
+            name='status',
+            field=models.PositiveSmallIntegerField(null=True),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 4.0.5 on 2026-10-19 17:31
+
+from django.db import migrations, models
+
+
+def series_forward(apps, schema_editor):
+    # series of the existing rows
+    Appointments = apps.get_model('sched_api', 'Appointments')
+    AppointmentRow = apps.get_model('sched_api', 'AppointmentRow')
+    db = schema_editor.connection.alias
+    for series_id in Appointments.objects.using(db).filter(series__isnull=False).values_list(
+            'series_id', flat=True).distinct():
+        AppointmentRow.objects.using(db).filter(appointment__series_id=series_id).update(series_id=series_id)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sched_api', '0014_idempotency_reservation'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='appointmentrow',
+            name='series_id',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+        migrations.RunPython(series_forward, migrations.RunPython.noop),
+    ]
@@ -12,9 +12,17 @@
 занимать разное время).
 '''
 
-from django.db import models
+from django.conf import settings
+from django.db import models, connections
+from django.db.models.fields.related_descriptors import ForwardManyToOneDescriptor
+from django.core.cache import cache
 from django.core.exceptions import ValidationError
 from django.contrib.auth.models import AbstractUser
+from django.utils import timezone
+import datetime
+import time
+
+from . import metrics, refcache
 
 WEEK = (
             (1, "Monday"),
@@ -45,16 +53,100 @@ class Location(models.Model):
     def __str__(self):
         return str(self.room) + " : " + self.name
 
+SPECIALITY_CACHE_KEY = 'sched_api:specialities' # {name: id} of all specialities
+
+def speciality_cache_key(using):
+    # every facility database has its own specialities
+    return SPECIALITY_CACHE_KEY + ':' + using
+
+class SpecialityManager(models.Manager):
+    '''
+    Cached lookups of specialities by name
+    '''
+
+    def cached_map(self):
+        # {name: id} for the filters and lookups, one query after each change
+        return refcache.get(self.db, 'specialities', None, self._shared_map)
+
+    def _shared_map(self):
+        # from the shared cache when the process cache is empty
+        key = speciality_cache_key(self.db)
+        specialities = cache.get(key)
+        metrics.cache_lookup('speciality', specialities is not None)
+        if specialities is None:
+            specialities = dict(self.values_list('name', 'id'))
+            if not connections[self.db].in_atomic_block: # uncommitted rows can be rolled back
+                # expires in case the deletion after a change is lost
+                cache.set(key, specialities, getattr(settings, 'SCHED_SPECIALITY_CACHE_SECONDS', 5 * 60))
+        return specialities
+
+    def id_for_name(self, name):
+        # id of the speciality or None if there is no such speciality
+        return self.cached_map().get(name)
+
+    def get_by_name(self, name):
+        # speciality with the name, not saved if it is new: validation does not write, Worker.save creates it
+        return self.model(id=self.id_for_name(name), name=name)
+
+    def saved(self, speciality):
+        # row of the speciality, created for a new name
+        if speciality.pk is not None: return speciality
+        return self.get_or_create(name=speciality.name)[0]
+
+class Speciality(models.Model):
+    '''
+    Specialities of workers
+    '''
+    name = models.CharField(max_length=255, unique=True, db_index=True)
+
+    objects = SpecialityManager()
+
+    class Meta:
+        verbose_name = u'Speciality'
+        verbose_name_plural = u'Specialities'
+        ordering = ('name', )
+
+    def __str__(self):
+        return self.name
+
+class SpecialityDescriptor(ForwardManyToOneDescriptor):
+    '''
+    Allows to set speciality of the worker by its name
+    '''
+    def __set__(self, instance, value):
+        if isinstance(value, str): value = Speciality.objects.get_by_name(value)
+        super().__set__(instance, value)
+
+class SpecialityField(models.ForeignKey):
+    '''
+    ForeignKey to Speciality, which accepts names of specialities too
+    '''
+    forward_related_accessor_class = SpecialityDescriptor
+
 class Worker(models.Model):
     ''''
     People who work there
     '''
     name = models.CharField(u'Name, surname', max_length=255, db_index=True, blank=False)
-    speciality = models.CharField(max_length=255, db_index=True)
+    speciality = SpecialityField(Speciality, related_name='workers', 
+                            on_delete=models.PROTECT, blank=False)
 
     def __str__(self):
         return self.name
 
+    def clean_fields(self, exclude=None):
+        # a new speciality has no id until the worker is saved
+        speciality = self._state.fields_cache.get('speciality')
+        if speciality is not None and speciality.pk is None: exclude = list(exclude or []) + ['speciality']
+        return super().clean_fields(exclude)
+
+    def save(self, *args, **kwargs):
+        # speciality is stored by its name, so take the actual row for it
+        speciality = self._state.fields_cache.get('speciality')
+        if speciality is not None:
+            self.speciality = Speciality.objects.saved(Speciality.objects.get_by_name(speciality.name))
+        return super().save(*args, **kwargs)
+
 class Schedule(models.Model):
     ''''
     Weekly schedule of workers, has checking for time crossing
@@ -68,10 +160,14 @@ class Schedule(models.Model):
                             db_index=True, blank=False)
     time_out = models.TimeField(u'Final time', help_text=u'Final time', 
                             db_index=True, blank=False)
+    place = models.ForeignKey(Location, verbose_name=u'Room', related_name='shifts', 
+                            on_delete=models.SET_NULL, null=True, blank=True)
 
     class Meta:
         verbose_name = u'Scheduling'
         verbose_name_plural = u'Scheduling'    
+        indexes = [models.Index(fields=['day', 'time_in'], name='schedule_day_time_idx'),
+                   models.Index(fields=['place', 'day', 'time_in'], name='schedule_place_day_time_idx')]
 
     def clean(self) -> None:
         
@@ -81,7 +177,7 @@ class Schedule(models.Model):
         if self.time_out <= self.time_in:
             raise ValidationError('Ending hour must be after the starting hour')
         
-        if not Worker.objects.filter(name = self.worker.name):
+        if refcache.instance(Worker, self.worker_id) is None:
             raise ValidationError('Wrong staff')
         
         if self.day < 1 or self.day > 7: raise ValidationError('Wrong day')
@@ -89,6 +185,8 @@ class Schedule(models.Model):
         events_worker = check_overlap(self, Schedule.objects.
                                     filter(worker = self.worker).
                                     filter(day = self.day))
+        # a changed shift (e.g. a room assigned) does not overlap itself
+        if self.pk is not None: events_worker = events_worker.exclude(pk=self.pk)
 
         if events_worker.exists():
             raise ValidationError(
@@ -97,6 +195,68 @@ class Schedule(models.Model):
                     events_worker[0].time_in) + '-' + str(
                     events_worker[0].time_out))
 
+        # one worker in the room at a time
+        if self.place_id is not None:
+            shifts = Schedule.objects.filter(place=self.place_id, day=self.day, time_in__lt=self.time_out, 
+                                             time_out__gt=self.time_in)
+            if self.pk is not None: shifts = shifts.exclude(pk=self.pk)
+            shift = shifts.select_related('worker').first()
+            if shift is not None:
+                raise ValidationError('The room is taken by another shift: ' + str(shift.worker) + ', ' + 
+                                      str(shift.time_in) + '-' + str(shift.time_out))
+            booked = Appointments.objects.filter(place=self.place_id, day__iso_week_day=self.day, 
+                                                 day__gte=timezone.localdate(), time_in__lt=self.time_out, 
+                                                 time_out__gt=self.time_in).exclude(worker=self.worker_id)
+            if booked.exists():
+                raise ValidationError('The room has appointments of other workers in that time')
+
+        return super().clean()
+
+class ScheduleException(models.Model):
+    '''
+    Changes of the weekly schedule on concrete dates: closures (holidays, 
+    sick days) and extra shifts. Closure without worker and place closes 
+    the whole facility, without times - the whole day.
+    '''
+    CLOSURE = 'closure'
+    EXTRA = 'extra'
+    KINDS = (
+        (CLOSURE, 'Closure'),
+        (EXTRA, 'Extra shift'),
+    )
+
+    kind = models.CharField(max_length=16, choices=KINDS, default=CLOSURE)
+    worker = models.ForeignKey(Worker, verbose_name=u'Staff', related_name='schedule_exceptions', 
+                            on_delete=models.CASCADE, null=True, blank=True)
+    place = models.ForeignKey(Location, related_name='schedule_exceptions', 
+                            on_delete=models.CASCADE, null=True, blank=True)
+    day = models.DateField(u'Day', db_index=True, blank=False)
+    time_in = models.TimeField(u'Starting time', null=True, blank=True)
+    time_out = models.TimeField(u'Final time', null=True, blank=True)
+    title = models.CharField(max_length=255, blank=True)
+
+    class Meta:
+        verbose_name = u'Schedule exception'
+        verbose_name_plural = u'Schedule exceptions'
+        indexes = [
+            models.Index(fields=['worker', 'day'], name='exception_worker_day_idx'),
+            models.Index(fields=['place', 'day'], name='exception_place_day_idx'),
+        ]
+
+    def __str__(self):
+        return str(self.day) + ' : ' + self.get_kind_display()
+
+    def clean(self) -> None:
+
+        super().clean_fields()
+
+        if (self.time_in is None) != (self.time_out is None):
+            raise ValidationError('Set both starting and final time or none of them')
+        if self.time_in is not None and self.time_out <= self.time_in:
+            raise ValidationError('Ending hour must be after the starting hour')
+        if self.kind == self.EXTRA and (self.worker is None or self.time_in is None):
+            raise ValidationError('Extra shift needs the staff and the time')
+
         return super().clean()
 
 class Appointments(models.Model):
@@ -107,8 +267,8 @@ class Appointments(models.Model):
     number = models.IntegerField(unique=True, db_index=True)
     worker = models.ForeignKey(Worker, related_name='worker', 
                             on_delete=models.CASCADE, blank=False)
-    place = models.ForeignKey(Location, related_name='place', 
-                            on_delete=models.CASCADE, blank=False)
+    place = models.ForeignKey(Location, related_name='place', help_text=u'Room of the shift if empty', 
+                            on_delete=models.CASCADE, blank=True)
     day = models.DateField(u'Day', db_index=True, blank=False)
     time_in = models.TimeField(u'Starting time', help_text=u'Starting time', 
                             db_index=True, blank=False)
@@ -117,10 +277,21 @@ class Appointments(models.Model):
     title = models.CharField(max_length=255)
     creator = models.ForeignKey(Users, related_name='creator', null=True, 
                             on_delete=models.CASCADE)
+    orphaned = models.BooleanField(u'Outside working hours', default=False, db_index=True, 
+                            editable=False)
+    series = models.ForeignKey('AppointmentSeries', related_name='appointments', null=True, 
+                            blank=True, editable=False, on_delete=models.SET_NULL)
 
     class Meta:
         verbose_name = u'Appointment'
         verbose_name_plural = u'Appointments'
+        indexes = [models.Index(fields=['day', 'time_in'], name='appointments_day_time_idx')]
+
+    @classmethod
+    def next_number(cls):
+        # number for the new appointment
+        max_number = cls.objects.aggregate(models.Max('number'))
+        return (max_number['number__max'] or 0) + 1
 
     def clean(self) -> None:
 
@@ -130,28 +301,292 @@ class Appointments(models.Model):
         if self.time_out <= self.time_in:
             raise ValidationError('Ending hour must be after the starting hour')
         
-        events_place = check_overlap(self, Appointments.objects.filter(place = self.place))
-        events_worker = check_overlap(self, Appointments.objects.filter(worker = self.worker))
-        if events_place.exists():
+        started = time.perf_counter()
+        # the room of the shift belongs to the worker, no other shift may use it at that time
+        weekday = self.day.isoweekday()
+        room = Schedule.objects.filter(worker=self.worker_id, day=weekday, place__isnull=False, 
+                                       time_in__lte=self.time_in, time_out__gte=self.time_out
+                                       ).values_list('place_id', flat=True).first()
+        if self.place_id is None: self.place_id = room
+        if self.place_id is None: raise ValidationError('Choose the place, the shift has no room')
+        if room != self.place_id:
+            shift = Schedule.objects.filter(place=self.place_id, day=weekday, time_in__lt=self.time_out, 
+                                            time_out__gt=self.time_in).select_related('worker').first()
+            if shift is not None:
+                metrics.inc('sched_booking_rejections_total', reason='room_taken')
+                raise ValidationError('The place is the room of another shift: ' + str(shift.worker) + 
+                                      ', ' + str(shift.time_in) + '-' + str(shift.time_out))
+
+        # appointments of the same day only, occurrences of series repeat the time every week;
+        # appointments in the room of the shift can only be the worker's own
+        events_place = None if room == self.place_id else check_overlap(
+            self, Appointments.objects.filter(place = self.place, day = self.day))
+        events_worker = check_overlap(self, Appointments.objects.filter(worker = self.worker, day = self.day))
+        place_busy = events_place is not None and events_place.exists()
+        worker_busy = not place_busy and events_worker.exists()
+        metrics.observe('sched_overlap_check_seconds', time.perf_counter() - started)
+        if place_busy:
+            metrics.inc('sched_booking_rejections_total', reason='place_overlap')
             raise ValidationError(
                 'There is an overlap with another event: ' + 
                     str(events_place[0].worker) + ', ' + str(
                     events_place[0].time_in) + '-' + str(events_place[0].time_out))
-        elif events_worker.exists():
+        elif worker_busy:
+            metrics.inc('sched_booking_rejections_total', reason='worker_overlap')
             raise ValidationError(
                 'There is an overlap with another event: ' + 
                     str(events_worker[0].place) + ', ' + str(
                     events_worker[0].time_in) + '-' + str(events_worker[0].time_out))
+        held = SlotHold.active().filter(models.Q(worker=self.worker_id) | models.Q(place=self.place_id), 
+                                        day=self.day, time_in__lt=self.time_out, time_out__gt=self.time_in)
+        # the holds of the creator are taken by this booking
+        if self.creator_id is not None: held = held.exclude(holder=self.creator_id)
+        held = held.first()
+        if held is not None:
+            metrics.inc('sched_booking_rejections_total', reason='held')
+            raise ValidationError('The time is held by another booking until ' + 
+                                  str(timezone.localtime(held.expires_at).time().replace(microsecond=0)))
+        # occurrences of series beyond the booking horizon are not in the table yet
+        from .series import series_conflict
+        series = series_conflict(self.worker_id, self.place_id, self.day, self.time_in, self.time_out, 
+                                 exclude=self.series_id)
+        if series is not None:
+            metrics.inc('sched_booking_rejections_total', reason='series')
+            raise ValidationError('There is an overlap with the series: ' + str(series))
         
-        events_schedule = Schedule.objects.filter(worker = self.worker
-                                        ).filter(day = self.day.isoweekday()
-                                        ).filter(time_in__lte = self.time_in
-                                        ).filter(time_out__gte = self.time_out)
-        if not events_schedule.exists():
+        # weekly schedule merged with closures and extra shifts of the day
+        from .availability import Availability, covers, overlaps
+        availability = Availability([self.worker_id], self.day, self.day, place_ids=[self.place_id])
+        if not covers(availability.hours(self.worker_id, self.day), self.time_in, self.time_out):
+            metrics.inc('sched_booking_rejections_total', reason='no_working_hours')
             raise ValidationError('There are no working hours in that time: ')
+        if overlaps(availability.place_closures(self.place_id, self.day), self.time_in, self.time_out):
+            metrics.inc('sched_booking_rejections_total', reason='place_closed')
+            raise ValidationError('The place is closed in that time')
+
+        return super().clean()
+
+class WaitlistRequest(models.Model):
+    '''
+    Request to book the worker (or any worker of the speciality) in the 
+    window of dates and times, booked automatically when the time gets free
+    '''
+    WAITING = 'waiting'
+    BOOKED = 'booked'
+    CANCELLED = 'cancelled'
+    STATUSES = (
+        (WAITING, 'Waiting'),
+        (BOOKED, 'Booked'),
+        (CANCELLED, 'Cancelled'),
+    )
+    MAX_DAYS = 62 # longest window, the lookups by the freed day range over day_from by index
+
+    worker = models.ForeignKey(Worker, verbose_name=u'Staff', related_name='waitlist', 
+                            on_delete=models.CASCADE, null=True, blank=True)
+    speciality = models.ForeignKey(Speciality, related_name='waitlist', 
+                            on_delete=models.CASCADE, null=True, blank=True)
+    day_from = models.DateField(u'First day', blank=False)
+    day_to = models.DateField(u'Last day', blank=False)
+    time_from = models.TimeField(u'Earliest time', blank=False)
+    time_to = models.TimeField(u'Latest time', blank=False)
+    duration = models.PositiveIntegerField(u'Duration, minutes', blank=False)
+    title = models.CharField(max_length=255)
+    status = models.CharField(max_length=16, choices=STATUSES, default=WAITING)
+    appointment = models.ForeignKey(Appointments, related_name='waitlist', 
+                            on_delete=models.SET_NULL, null=True, blank=True)
+    creator = models.ForeignKey(Users, related_name='waitlist', null=True, 
+                            on_delete=models.CASCADE)
+    created = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        verbose_name = u'Waitlist request'
+        verbose_name_plural = u'Waitlist'
+        indexes = [
+            models.Index(fields=['worker', 'status', 'day_from', 'time_from'], name='waitlist_worker_idx'),
+            models.Index(fields=['speciality', 'status', 'day_from', 'time_from'], name='waitlist_speciality_idx'),
+        ]
+
+    def __str__(self):
+        return self.title + ' : ' + str(self.day_from) + '-' + str(self.day_to)
+
+    def clean(self) -> None:
+
+        super().clean_fields()
+
+        if (self.worker is None) == (self.speciality is None):
+            raise ValidationError('Choose the staff or the speciality')
+        if self.day_to < self.day_from:
+            raise ValidationError('Last day must not be before the first day')
+        if (self.day_to - self.day_from).days > self.MAX_DAYS:
+            raise ValidationError('The window must not be longer than %d days' % self.MAX_DAYS)
+        if self.time_to <= self.time_from:
+            raise ValidationError('Latest time must be after the earliest time')
+        if self.duration <= 0:
+            raise ValidationError('Wrong duration')
 
         return super().clean()
 
+class SlotHold(models.Model):
+    '''
+    Short hold of the time of the worker and the place while the booking 
+    form is filled, counts as a conflict for other bookings until it expires
+    '''
+    token = models.CharField(max_length=32, unique=True)
+    worker = models.ForeignKey(Worker, related_name='holds', on_delete=models.CASCADE)
+    place = models.ForeignKey(Location, related_name='holds', on_delete=models.CASCADE)
+    day = models.DateField(u'Day')
+    time_in = models.TimeField(u'Starting time')
+    time_out = models.TimeField(u'Final time')
+    holder = models.ForeignKey(Users, related_name='holds', null=True, on_delete=models.CASCADE)
+    expires_at = models.DateTimeField(db_index=True)
+
+    class Meta:
+        verbose_name = u'Slot hold'
+        verbose_name_plural = u'Slot holds'
+        indexes = [models.Index(fields=['worker', 'day', 'expires_at'], name='hold_worker_idx'),
+                   models.Index(fields=['place', 'day', 'expires_at'], name='hold_place_idx')]
+
+    @classmethod
+    def active(cls):
+        return cls.objects.filter(expires_at__gt=timezone.now())
+
+class AppointmentSeries(models.Model):
+    '''
+    Recurring appointment (every N days until the date or the number of 
+    occurrences). Occurrences are created as Appointments only within the 
+    booking horizon, later ones are checked by the series itself
+    '''
+    worker = models.ForeignKey(Worker, related_name='series', on_delete=models.CASCADE)
+    place = models.ForeignKey(Location, related_name='series', on_delete=models.CASCADE)
+    first_day = models.DateField(u'First day')
+    time_in = models.TimeField(u'Starting time')
+    time_out = models.TimeField(u'Final time')
+    interval_days = models.PositiveIntegerField(u'Every N days', default=7)
+    until = models.DateField(u'Last day', null=True, blank=True)
+    count = models.PositiveIntegerField(u'Number of occurrences', null=True, blank=True)
+    title = models.CharField(max_length=255)
+    creator = models.ForeignKey(Users, related_name='series', null=True, on_delete=models.CASCADE)
+    materialized_until = models.DateField(null=True, blank=True, editable=False)
+
+    class Meta:
+        verbose_name = u'Appointment series'
+        verbose_name_plural = u'Appointment series'
+        indexes = [models.Index(fields=['worker', 'first_day'], name='series_worker_idx'),
+                   models.Index(fields=['place', 'first_day'], name='series_place_idx')]
+
+    def __str__(self):
+        return self.title + ' : ' + str(self.first_day) + ', every ' + str(self.interval_days) + ' days'
+
+    def last_day(self):
+        # last occurrence
+        if self.count is not None:
+            last = self.first_day + datetime.timedelta(days=self.interval_days * (self.count - 1))
+            return min(last, self.until) if self.until is not None else last
+        return self.until
+
+    def occurs(self, day):
+        return (self.first_day <= day <= self.last_day() and 
+                (day - self.first_day).days % self.interval_days == 0)
+
+    def days(self, date_from=None, date_to=None):
+        # occurrences in the range of dates
+        date_from = max(date_from or self.first_day, self.first_day)
+        date_to = min(date_to or self.last_day(), self.last_day())
+        offset = -(date_from - self.first_day).days % self.interval_days
+        day = date_from + datetime.timedelta(days=offset)
+        while day <= date_to:
+            yield day
+            day += datetime.timedelta(days=self.interval_days)
+
+    def clean(self) -> None:
+
+        super().clean_fields()
+
+        if self.time_out <= self.time_in:
+            raise ValidationError('Ending hour must be after the starting hour')
+        if self.interval_days < 1: raise ValidationError('Wrong interval')
+        if self.until is None and self.count is None:
+            raise ValidationError('Set the last day or the number of occurrences')
+        if self.count is not None and self.count < 1:
+            raise ValidationError('Number of occurrences must be at least 1')
+        if self.until is not None and self.until < self.first_day:
+            raise ValidationError('Last day must not be before the first day')
+        from .series import MAX_OCCURRENCES, check_series
+        if len(list(self.days())) > MAX_OCCURRENCES:
+            raise ValidationError('Too many occurrences, the limit is ' + str(MAX_OCCURRENCES))
+        # all occurrences are checked together
+        conflicts = check_series(self)
+        if conflicts:
+            raise ValidationError('Occurrences can not be booked: ' + ', '.join(
+                str(day) + ' (' + reason + ')' for day, reason in conflicts[:10]))
+
+        return super().clean()
+
+class SentReminder(models.Model):
+    '''
+    Mark of the reminder of the appointment, claimed by the sender before 
+    the delivery, so every reminder is sent once by one of the senders
+    '''
+    appointment = models.ForeignKey(Appointments, related_name='reminders', on_delete=models.CASCADE)
+    hours = models.PositiveSmallIntegerField(u'Hours before')
+    claimed_by = models.CharField(max_length=32)
+    sent_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        verbose_name = u'Sent reminder'
+        verbose_name_plural = u'Sent reminders'
+        constraints = [models.UniqueConstraint(fields=['appointment', 'hours'], name='reminder_once')]
+
+class AppointmentRow(models.Model):
+    '''
+    Flat row of the appointment for the lists: names of the worker, the place
+    and the creator are copied here, so lists are read from one table 
+    without joins. Kept in sync by signals (see listing.py)
+    '''
+    appointment = models.OneToOneField(Appointments, primary_key=True, related_name='row',
+                            on_delete=models.CASCADE)
+    number = models.IntegerField()
+    worker_id = models.BigIntegerField()
+    worker_name = models.CharField(u'Worker', max_length=255)
+    place_id = models.BigIntegerField(db_index=True)
+    place_name = models.CharField(u'Place', max_length=255)
+    day = models.DateField(u'Day')
+    time_in = models.TimeField(u'Starting time')
+    time_out = models.TimeField(u'Final time')
+    title = models.CharField(max_length=255)
+    creator_id = models.BigIntegerField(null=True, db_index=True)
+    creator_username = models.CharField(u'Creator', max_length=150, blank=True)
+    orphaned = models.BooleanField(u'Outside working hours', default=False)
+    series_id = models.BigIntegerField(null=True, blank=True)
+
+    class Meta:
+        verbose_name = u'Appointment row'
+        verbose_name_plural = u'Appointment rows'
+        indexes = [models.Index(fields=['day', 'time_in'], name='appointment_row_day_time_idx'),
+                   models.Index(fields=['worker_id', 'day', 'time_in'], name='appointment_row_worker_idx')]
+
+class IdempotencyRecord(models.Model):
+    '''
+    Stored responses of write requests with the Idempotency-Key header,
+    retries get the stored response without validation and writes.
+    The record is reserved (status is empty) before the first request runs.
+    '''
+    key = models.CharField(max_length=255)
+    user = models.ForeignKey(Users, related_name='idempotency_records', null=True, 
+                            on_delete=models.CASCADE)
+    path = models.CharField(max_length=255)
+    body_hash = models.CharField(max_length=64, blank=True)
+    status = models.PositiveSmallIntegerField(null=True)
+    content_type = models.CharField(max_length=255)
+    content = models.BinaryField()
+    expires_at = models.DateTimeField(db_index=True)
+
+    class Meta:
+        verbose_name = u'Idempotency record'
+        verbose_name_plural = u'Idempotency records'
+        constraints = [models.UniqueConstraint(fields=['key', 'user', 'path'], 
+                                               name='idempotency_key_unique')]
+
 def check_overlap(self_events, events):
     '''
     Helper function for the time crossing
@@ -0,0 +1,128 @@
+'''
+Profiling of single requests and the log of slow queries.
+
+A request is profiled when it has the X-Profile header with
+settings.SCHED_PROFILE_TOKEN or is taken by settings.SCHED_PROFILE_RATE
+(part of all requests). The cProfile dump and the list of queries with
+their time are written into settings.SCHED_PROFILE_DIR, only the last
+SCHED_PROFILE_KEEP requests are kept. Queries longer than
+settings.SCHED_SLOW_QUERY_MS are logged to "sched_api.slow_queries" with
+the view and the line of the project which made the query.
+
+Without these settings the middleware removes itself from the chain.
+'''
+
+import cProfile
+import logging
+import os
+import random
+import time
+import traceback
+from contextlib import ExitStack
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+
+PROFILE_HEADER = 'HTTP_X_PROFILE'
+
+logger = logging.getLogger('sched_api.slow_queries')
+
+
+def view_name(request):
+    match = getattr(request, 'resolver_match', None)
+    return match.view_name if match is not None else 'unmatched'
+
+
+def query_origin():
+    # last line of the project code in the stack, not Django or this module
+    root = str(settings.BASE_DIR)
+    for frame in reversed(traceback.extract_stack()[:-2]):
+        if frame.filename.startswith(root) and frame.filename != __file__:
+            return '%s:%d in %s' % (os.path.relpath(frame.filename, root), frame.lineno, frame.name)
+    return 'unknown'
+
+
+class QueryLog:
+    '''
+    Execute wrapper: queries of the profiled request and slow queries
+    '''
+
+    def __init__(self, request, record, slow):
+        self.request = request
+        self.queries = [] if record else None
+        self.slow = slow # seconds or None
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            seconds = time.perf_counter() - started
+            if self.queries is not None: self.queries.append((seconds, sql, params))
+            if self.slow is not None and seconds >= self.slow:
+                logger.warning('Slow query %.1f ms in %s at %s: %s', seconds * 1000,
+                               view_name(self.request), query_origin(), sql)
+
+
+class ProfilingMiddleware:
+    '''
+    Profiles the chosen requests and logs slow queries
+    '''
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.directory = getattr(settings, 'SCHED_PROFILE_DIR', None)
+        self.token = getattr(settings, 'SCHED_PROFILE_TOKEN', None)
+        self.rate = getattr(settings, 'SCHED_PROFILE_RATE', 0)
+        self.keep = getattr(settings, 'SCHED_PROFILE_KEEP', 100)
+        slow = getattr(settings, 'SCHED_SLOW_QUERY_MS', None)
+        self.slow = slow / 1000 if slow is not None else None
+        if not self.directory and self.slow is None: raise MiddlewareNotUsed()
+
+    def chosen(self, request):
+        if not self.directory: return False
+        if self.token and request.META.get(PROFILE_HEADER) == self.token: return True
+        return self.rate > 0 and random.random() < self.rate
+
+    def __call__(self, request):
+        profile = self.chosen(request)
+        if not profile and self.slow is None: return self.get_response(request)
+
+        log = QueryLog(request, profile, self.slow)
+        profiler = cProfile.Profile() if profile else None
+        with ExitStack() as stack:
+            for alias in connections:
+                stack.enter_context(connections[alias].execute_wrapper(log))
+            if profiler is not None: profiler.enable()
+            started = time.perf_counter()
+            try:
+                return self.get_response(request)
+            finally:
+                if profiler is not None:
+                    profiler.disable()
+                    self.save(request, profiler, log.queries, time.perf_counter() - started)
+
+    def save(self, request, profiler, queries, seconds):
+        '''
+        Write <time>-<view>.prof (pstats) and <time>-<view>.sql, remove the oldest requests
+        '''
+        os.makedirs(self.directory, exist_ok=True)
+        name = '%d-%s' % (time.time_ns(), view_name(request).replace(':', '_').replace('/', '_'))
+        path = os.path.join(self.directory, name)
+        profiler.dump_stats(path + '.prof')
+        with open(path + '.sql', 'w') as file:
+            file.write('%s %s %.1f ms, %d queries %.1f ms\n\n' % (
+                request.method, request.get_full_path(), seconds * 1000, len(queries),
+                sum(x[0] for x in queries) * 1000))
+            for query_seconds, sql, params in queries:
+                file.write('%.1f ms\t%s\t%r\n' % (query_seconds * 1000, sql, params))
+
+        names = sorted({os.path.splitext(x)[0] for x in os.listdir(self.directory)
+                        if x.endswith(('.prof', '.sql'))})
+        for old in names[:-self.keep] if self.keep else []:
+            for extension in ('.prof', '.sql'):
+                try:
+                    os.remove(os.path.join(self.directory, old + extension))
+                except FileNotFoundError:
+                    pass
@@ -0,0 +1,138 @@
+'''
+Detection of future appointments left outside working hours after changes
+of the Schedule or of schedule exceptions.
+
+One query with anti-joins (NOT EXISTS) finds the appointments without a
+covering weekly segment or extra shift, or with a closure of the worker or
+the place on their time. Only these rows are checked in memory against the
+merged working hours (segments touching each other cover an appointment
+together). Moves to colleagues are checked as bookings are (appointments,
+holds, series and shift rooms, see conflicts.Occupancy).
+'''
+
+import datetime
+from collections import defaultdict
+
+from django.db import router, transaction
+from django.db.models import Exists, OuterRef, Q
+from django.db.models.functions import ExtractIsoWeekDay
+
+from .models import Appointments, AppointmentRow, Schedule, ScheduleException, Worker
+from .availability import Availability, covers, free_intervals, overlaps, subtract
+from .conflicts import Occupancy
+from .listing import refresh_rows
+
+
+def suspects(worker_ids=None, date_from=None):
+    '''
+    Future appointments which may be outside working hours
+
+            Parameters:
+                    worker_ids (iterable): check only these workers, all by default
+                    date_from (date): first day to check, today by default
+
+            Returns:
+                    QuerySet of Appointments
+    '''
+    weekly = Schedule.objects.filter(worker=OuterRef('worker'), day=OuterRef('weekday'),
+                                     time_in__lte=OuterRef('time_in'), time_out__gte=OuterRef('time_out'))
+    extra = ScheduleException.objects.filter(kind=ScheduleException.EXTRA, worker=OuterRef('worker'),
+                                             day=OuterRef('day'), time_in__lte=OuterRef('time_in'),
+                                             time_out__gte=OuterRef('time_out'))
+    closure = ScheduleException.objects.filter(
+        Q(worker=OuterRef('worker')) | Q(worker__isnull=True, place=OuterRef('place')) |
+        Q(worker__isnull=True, place__isnull=True),
+        Q(time_in__isnull=True) | Q(time_in__lt=OuterRef('time_out'), time_out__gt=OuterRef('time_in')),
+        kind=ScheduleException.CLOSURE, day=OuterRef('day'))
+
+    appointments = Appointments.objects.filter(day__gte=date_from or datetime.date.today())
+    if worker_ids is not None: appointments = appointments.filter(worker_id__in=worker_ids)
+    return appointments.annotate(weekday=ExtractIsoWeekDay('day')).filter(
+        (~Exists(weekly) & ~Exists(extra)) | Exists(closure))
+
+
+def find_orphans(worker_ids=None, date_from=None):
+    '''
+    Future appointments outside working hours of their workers or in closed places
+
+            Returns:
+                    list of Appointments
+    '''
+    rows = list(suspects(worker_ids, date_from))
+    if not rows: return []
+    availability = Availability({x.worker_id for x in rows}, min(x.day for x in rows),
+                                max(x.day for x in rows), place_ids={x.place_id for x in rows})
+    return [x for x in rows if not covers(availability.hours(x.worker_id, x.day), x.time_in, x.time_out)
+            or overlaps(availability.place_closures(x.place_id, x.day), x.time_in, x.time_out)]
+
+
+def reconcile(worker_ids=None, date_from=None, move=False):
+    '''
+    Flag the appointments outside working hours and clear the flag of the
+    fixed ones, optionally move the flagged appointments to other workers
+    of the same speciality
+
+            Parameters:
+                    worker_ids (iterable): check only these workers, all by default
+                    date_from (date): first day to check, today by default
+                    move (bool): move appointments to free workers of the same speciality
+
+            Returns:
+                    (number of flagged appointments, number of moved appointments)
+    '''
+    date_from = date_from or datetime.date.today()
+    using = router.db_for_write(Appointments) # database of the current facility
+    with transaction.atomic(using=using):
+        orphans = find_orphans(worker_ids, date_from)
+        moved = move_orphans(orphans, using) if move and orphans else []
+
+        moved_ids = {x.pk for x in moved}
+        flagged = [x.pk for x in orphans if x.pk not in moved_ids]
+        for model, key in ((Appointments, 'pk'), (AppointmentRow, 'appointment_id')): # rows of lists too
+            stale = model.objects.filter(orphaned=True, day__gte=date_from).exclude(**{key + '__in': flagged})
+            if worker_ids is not None: stale = stale.filter(worker_id__in=worker_ids)
+            stale.update(orphaned=False)
+            model.objects.filter(orphaned=False, **{key + '__in': flagged}).update(orphaned=True)
+    return len(flagged), len(moved)
+
+
+def move_orphans(orphans, using='default'):
+    '''
+    Move appointments to other workers of the same speciality who are free at that time,
+    appointments in closed places stay
+
+            Returns:
+                    list of moved Appointments
+    '''
+    specialities = dict(Worker.objects.filter(pk__in={x.worker_id for x in orphans}
+                                              ).values_list('id', 'speciality_id'))
+    colleagues = defaultdict(list)
+    for worker_id, speciality_id in Worker.objects.filter(
+            speciality_id__in=set(specialities.values())).values_list('id', 'speciality_id'):
+        colleagues[speciality_id].append(worker_id)
+    worker_ids = {x for ids in colleagues.values() for x in ids}
+    date_from, date_to = min(x.day for x in orphans), max(x.day for x in orphans)
+    free = free_intervals(worker_ids, date_from, date_to)
+    places = Availability((), date_from, date_to, place_ids={x.place_id for x in orphans})
+    occupancy = Occupancy({x.day for x in orphans}, worker_ids, {x.place_id for x in orphans}, using)
+
+    moved = []
+    for appointment in orphans:
+        day, time_in, time_out = appointment.day, appointment.time_in, appointment.time_out
+        if overlaps(places.place_closures(appointment.place_id, day), time_in, time_out): continue
+        for worker_id in colleagues[specialities[appointment.worker_id]]:
+            key = (worker_id, day)
+            if worker_id == appointment.worker_id or not covers(free.get(key, []), time_in, time_out):
+                continue
+            if occupancy.conflict(worker_id, appointment.place_id, day, time_in, time_out,
+                                  appointment.creator_id, exclude=appointment.pk) is not None:
+                continue
+            free[key] = subtract(free[key], [(time_in, time_out)])
+            occupancy.add(worker_id, appointment.place_id, day, time_in, time_out, pk=appointment.pk)
+            appointment.worker_id = worker_id
+            appointment.orphaned = False
+            moved.append(appointment)
+            break
+    Appointments.objects.bulk_update(moved, ['worker', 'orphaned'], batch_size=500)
+    refresh_rows([x.pk for x in moved], using)
+    return moved
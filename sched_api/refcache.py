@@ -0,0 +1,162 @@
+'''
+Process-local cache of reference data: workers, places, specialities and
+choices of form fields.
+
+The objects are kept in a LRU dict of the process (settings.SCHED_REFCACHE_SIZE
+entries). Every change of the reference data writes a new shared version
+into the Django cache (a random value, so concurrent changes never leave the
+old one); each request compares it with the version seen by the process and
+drops the local entries if it differs, so writes of one process are seen by
+all processes from their next request. CACHES must be shared by the
+processes (see settings). Callers get copies of the cached objects, so
+changes of them do not leak into other requests and threads.
+'''
+
+import copy
+import threading
+import uuid
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.db import connections, models, router
+
+from . import metrics
+
+VERSION_KEY = 'sched_api:reference_version:'
+MISSING = object()
+
+
+class LRU:
+    '''
+    Dict with the bounded size, the least recently used entries are dropped
+    '''
+
+    def __init__(self, size):
+        self.size = size
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            value = self.data.get(key, MISSING)
+            if value is MISSING: return default
+            self.data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.data[key] = value
+            self.data.move_to_end(key)
+            while len(self.data) > self.size: self.data.popitem(last=False)
+
+    def clear(self, using):
+        # entries of one database
+        with self.lock:
+            for key in [x for x in self.data if x[0] == using]: del self.data[key]
+
+
+_lru = LRU(getattr(settings, 'SCHED_REFCACHE_SIZE', 1024))
+_versions = {} # database alias: version seen by the process
+
+
+def database(model):
+    return router.db_for_read(model) or 'default'
+
+
+def sync(using='default'):
+    # drop the local entries if another process changed the reference data
+    version = cache.get(VERSION_KEY + using, 0)
+    if _versions.get(using) != version:
+        _lru.clear(using)
+        _versions[using] = version
+
+
+def forget(using='default'):
+    # drop the local entries only, e.g. before the change is committed
+    _lru.clear(using)
+
+
+def invalidate(using='default'):
+    '''
+    Drop the reference data of the database in this process and in all other processes
+    '''
+    _lru.clear(using)
+    # incr of the shared backends (files, database) is not atomic, a new value is never lost
+    _versions[using] = uuid.uuid4().hex
+    cache.set(VERSION_KEY + using, _versions[using], None)
+
+
+def _copy(value):
+    # objects of the caller: the models with their related objects, the containers
+    if isinstance(value, list): return [_copy(x) for x in value]
+    if isinstance(value, dict): return dict(value)
+    if isinstance(value, models.Model):
+        value = copy.copy(value)
+        value._state.fields_cache = {k: copy.copy(v) for k, v in value._state.fields_cache.items()}
+    return value
+
+
+def get(using, kind, key, load):
+    '''
+    Cached value or the result of load()
+
+            Parameters:
+                    using (str): database alias
+                    kind, key: what is cached, e.g. ('instance', 'sched_api.Worker', 1)
+                    load (callable): reads the value from the database
+
+            Returns:
+                    copy of the cached value
+    '''
+    value = _lru.get((using, kind, key), MISSING)
+    metrics.cache_lookup('reference', value is not MISSING)
+    if value is MISSING:
+        value = load()
+        if not connections[using].in_atomic_block: # uncommitted rows can be rolled back
+            _lru.set((using, kind, key), value)
+    return _copy(value)
+
+
+def instance(model, pk):
+    '''
+    Object of the reference model (Worker, Location, Speciality) by its id, None if there is no such object
+    '''
+    try:
+        pk = model._meta.pk.to_python(pk)
+    except ValidationError:
+        return None
+    using = database(model)
+    queryset = model.objects.using(using)
+    if any(x.name == 'speciality' for x in model._meta.fields): queryset = queryset.select_related('speciality')
+    return get(using, 'instance', (model._meta.label, pk), lambda: queryset.filter(pk=pk).first())
+
+
+def choices(model):
+    # [(id, name)] of all objects of the model for choice fields
+    using = database(model)
+    return get(using, 'choices', model._meta.label,
+               lambda: [(x.pk, str(x)) for x in model.objects.using(using).order_by('pk')])
+
+
+def workers():
+    # all workers with their specialities
+    from .models import Worker
+    using = database(Worker)
+    return get(using, 'workers', None,
+               lambda: list(Worker.objects.using(using).select_related('speciality').order_by('pk')))
+
+
+class ReferenceCacheMiddleware:
+    '''
+    Checks the shared version of the reference data once per request
+    '''
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        from .models import Worker
+        sync(database(Worker)) # database of the facility of the request
+        return self.get_response(request)
@@ -0,0 +1,173 @@
+'''
+Reminders of upcoming appointments.
+
+The send_reminders command keeps a heap of the reminders due soon. Every
+SCAN_INTERVAL seconds it reads the appointments starting in the window
+(now - grace, now + lookahead) shifted by each of settings.SCHED_REMINDER_HOURS
+with one range query over the (day, time_in) index and pushes the new ones
+into the heap. Due reminders are taken from the heap in batches, claimed
+in SentReminder (unique per appointment and hours, so a reminder is sent
+once even by several senders) and delivered by settings.SCHED_REMINDER_BACKEND:
+LocalBackend sends e-mails through the Django mail backend, StubBackend keeps
+the messages in memory for tests and development.
+'''
+
+import datetime
+import heapq
+import logging
+import uuid
+from collections import namedtuple
+
+from django.conf import settings
+from django.core import mail
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from .models import Appointments, AppointmentRow, SentReminder, Users
+
+SCAN_INTERVAL = 60 # seconds
+GRACE = datetime.timedelta(minutes=30) # late reminders are still sent, e.g. after a restart
+
+logger = logging.getLogger('sched_api.reminders')
+
+Message = namedtuple('Message', 'appointment_id hours day time_in worker place title username email')
+
+
+class StubBackend:
+    '''
+    Keeps the messages in StubBackend.outbox
+    '''
+    outbox = []
+
+    def send_messages(self, messages):
+        self.outbox.extend(messages)
+        return len(messages)
+
+
+class LocalBackend:
+    '''
+    E-mails to the creators of the appointments through one connection of the Django mail backend
+    '''
+
+    def send_messages(self, messages):
+        emails = [mail.EmailMessage('Reminder: ' + x.title, text(x), to=[x.email]) for x in messages if x.email]
+        if emails: mail.get_connection().send_messages(emails)
+        return len(messages)
+
+
+def text(message):
+    return '%s at %s, %s, %s: %s' % (message.day, message.time_in.strftime('%H:%M'), message.worker,
+                                     message.place, message.title)
+
+
+def get_backend():
+    return import_string(getattr(settings, 'SCHED_REMINDER_BACKEND', 'sched_api.reminders.LocalBackend'))()
+
+
+def starts(date_from, date_to):
+    '''
+    Appointments starting in the range of local times by the (day, time_in) index
+
+            Parameters:
+                    date_from, date_to (datetime): aware range, both ends included
+
+            Returns:
+                    QuerySet of Appointments ordered by day and time_in
+    '''
+    date_from, date_to = timezone.localtime(date_from), timezone.localtime(date_to)
+    day_from, day_to = date_from.date(), date_to.date()
+    time_from, time_to = date_from.time().replace(tzinfo=None), date_to.time().replace(tzinfo=None)
+    if day_from == day_to:
+        where = Q(day=day_from, time_in__gte=time_from, time_in__lte=time_to)
+    else:
+        where = (Q(day=day_from, time_in__gte=time_from) | Q(day__gt=day_from, day__lt=day_to) |
+                 Q(day=day_to, time_in__lte=time_to))
+    return Appointments.objects.filter(where).order_by('day', 'time_in')
+
+
+def start_of(day, time_in):
+    return timezone.make_aware(datetime.datetime.combine(day, time_in))
+
+
+class ReminderScheduler:
+    '''
+    Heap of due reminders filled by scans of upcoming appointments
+    '''
+
+    def __init__(self, backend=None, hours=None, batch=None):
+        self.backend = backend or get_backend()
+        self.hours = hours or getattr(settings, 'SCHED_REMINDER_HOURS', (24,))
+        self.batch = batch or getattr(settings, 'SCHED_REMINDER_BATCH', 100)
+        self.token = uuid.uuid4().hex
+        self.heap = [] # (due, appointment id, hours)
+        self.queued = set() # (appointment id, hours) in the heap
+
+    def scan(self, now=None):
+        '''
+        Push reminders of the appointments starting soon into the heap
+
+                Returns:
+                        number of new reminders
+        '''
+        now = now or timezone.now()
+        lookahead = datetime.timedelta(seconds=2 * SCAN_INTERVAL)
+        pushed = 0
+        for hours in self.hours:
+            lead = datetime.timedelta(hours=hours)
+            upcoming = starts(now - GRACE + lead, now + lookahead + lead).exclude(reminders__hours=hours)
+            for pk, day, time_in in upcoming.values_list('pk', 'day', 'time_in').iterator():
+                if (pk, hours) in self.queued: continue
+                heapq.heappush(self.heap, (start_of(day, time_in) - lead, pk, hours))
+                self.queued.add((pk, hours))
+                pushed += 1
+        return pushed
+
+    def next_due(self):
+        return self.heap[0][0] if self.heap else None
+
+    def run_pending(self, now=None):
+        '''
+        Send the due reminders in batches
+
+                Returns:
+                        number of sent reminders
+        '''
+        now = now or timezone.now()
+        sent = 0
+        while self.heap and self.heap[0][0] <= now:
+            due = []
+            while self.heap and self.heap[0][0] <= now and len(due) < self.batch:
+                due.append(heapq.heappop(self.heap))
+                self.queued.discard(due[-1][1:])
+            sent += self.send(due, now)
+        return sent
+
+    def send(self, due, now):
+        # claim, deliver and mark one batch; moved or deleted appointments are dropped
+        rows = AppointmentRow.objects.in_bulk([x[1] for x in due])
+        messages = {}
+        for when, pk, hours in due:
+            row = rows.get(pk)
+            if row is None or start_of(row.day, row.time_in) - datetime.timedelta(hours=hours) != when: continue
+            messages[(pk, hours)] = Message(pk, hours, row.day, row.time_in, row.worker_name, row.place_name,
+                                            row.title, row.creator_username, None)
+        if not messages: return 0
+
+        SentReminder.objects.bulk_create([SentReminder(appointment_id=pk, hours=hours, claimed_by=self.token)
+                                          for pk, hours in messages], ignore_conflicts=True)
+        claimed = SentReminder.objects.filter(claimed_by=self.token, sent_at__isnull=True,
+                                              appointment_id__in={x[0] for x in messages})
+        claimed = {(x.appointment_id, x.hours): x for x in claimed if (x.appointment_id, x.hours) in messages}
+        if not claimed: return 0
+        emails = dict(Users.objects.filter(pk__in={rows[x[0]].creator_id for x in claimed}).values_list('pk', 'email'))
+        batch = [messages[x]._replace(email=emails.get(rows[x[0]].creator_id) or None) for x in claimed]
+        try:
+            self.backend.send_messages(batch)
+        except Exception:
+            # not sent, the claims are released for the next scan
+            logger.exception('Reminders of %d appointments are not sent', len(batch))
+            SentReminder.objects.filter(pk__in=[x.pk for x in claimed.values()]).delete()
+            return 0
+        SentReminder.objects.filter(pk__in=[x.pk for x in claimed.values()]).update(sent_at=now)
+        return len(batch)
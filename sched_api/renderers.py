@@ -0,0 +1,80 @@
+'''
+Compact formats of the lists chosen by the Accept header.
+
+application/vnd.sched.columnar+json - field names once, values of every
+field as one array; string fields with repeated values (names of workers,
+places, creators) are written once into "dictionaries" and the column
+keeps their indexes:
+
+    {"length": 2, "columns": {"id": [1, 2], "worker": [0, 0]},
+     "dictionaries": {"worker": ["Smith"]}}
+
+application/msgpack - the same structure in MessagePack, available when
+the msgpack package is installed.
+'''
+
+from rest_framework.renderers import BaseRenderer, JSONRenderer
+from rest_framework.settings import api_settings
+
+try:
+    import msgpack
+except ImportError: # optional
+    msgpack = None
+
+
+def columnar(data):
+    '''
+    Columns of the list of dicts
+
+            Parameters:
+                    data (list): serialized objects with the same fields
+
+            Returns:
+                    dict with length, columns and dictionaries
+    '''
+    rows = list(data)
+    fields = list(rows[0]) if rows else []
+    columns = {x: [row[x] for row in rows] for x in fields}
+    dictionaries = {}
+    for field, values in columns.items():
+        if not values or not all(isinstance(x, str) for x in values): continue
+        distinct = list(dict.fromkeys(values))
+        if len(distinct) * 2 > len(values): continue # codes would not save space
+        codes = {x: i for i, x in enumerate(distinct)}
+        columns[field] = [codes[x] for x in values]
+        dictionaries[field] = distinct
+    return {'length': len(rows), 'columns': columns, 'dictionaries': dictionaries}
+
+
+def to_columns(data):
+    # lists (and pages of lists) are columnar, other answers (errors) are left as they are
+    if isinstance(data, list): return columnar(data)
+    if isinstance(data, dict) and isinstance(data.get('results'), list):
+        return dict(data, results=columnar(data['results']))
+    return data
+
+
+class ColumnarJSONRenderer(JSONRenderer):
+    media_type = 'application/vnd.sched.columnar+json'
+    format = 'columnar'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        return super().render(to_columns(data), accepted_media_type, renderer_context)
+
+
+class MessagePackRenderer(BaseRenderer):
+    media_type = 'application/msgpack'
+    format = 'msgpack'
+    charset = None
+    render_style = 'binary'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None: return b''
+        return msgpack.packb(to_columns(data), use_bin_type=True, default=str)
+
+
+def list_renderers():
+    # renderers of the list views: the default ones first, then the compact formats
+    renderers = list(api_settings.DEFAULT_RENDERER_CLASSES) + [ColumnarJSONRenderer]
+    if msgpack is not None: renderers.append(MessagePackRenderer)
+    return renderers
@@ -0,0 +1,199 @@
+'''
+Prefix and full-text search of workers by name and speciality.
+
+On SQLite the search uses the FTS5 virtual table FTS_TABLE (created by
+migration, kept in sync by signals). Other databases use the in-memory
+trigram index, which is updated by the same signals and rebuilt every
+TRIGRAM_MAX_AGE seconds to see changes made by other processes.
+'''
+
+import re
+import threading
+import time
+from collections import defaultdict
+
+from django.db import connections
+
+from .models import Worker
+
+FTS_TABLE = 'sched_api_worker_fts'
+SEARCH_LIMIT = 20 # default number of found workers
+TRIGRAM_MAX_AGE = 60 # seconds, in-memory index catches up with other processes
+
+TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+
+
+def tokenize(text):
+    return [x.lower() for x in TOKEN_RE.findall(text or '')]
+
+
+_fts_tables = {} # alias of database: FTS5 table exists
+
+
+def fts_available(using):
+    # FTS5 works only with SQLite and when the table was created by migration
+    connection = connections[using]
+    if connection.vendor != 'sqlite': return False
+    if using not in _fts_tables:
+        _fts_tables[using] = FTS_TABLE in connection.introspection.table_names()
+    return _fts_tables[using]
+
+
+class Fts5Index:
+    '''
+    Search in the SQLite FTS5 table
+    '''
+
+    def __init__(self, using):
+        self.using = using
+
+    def query(self, text):
+        # every token is a prefix, all tokens must be found
+        return ' AND '.join('"%s"*' % x.replace('"', '""') for x in tokenize(text))
+
+    def search(self, text, limit=SEARCH_LIMIT):
+        '''
+        Find workers
+
+                Parameters:
+                        text (str): words or beginnings of words of name and speciality
+                        limit (int): max number of results
+
+                Returns:
+                        list of ids of workers, best matches first
+        '''
+        query = self.query(text)
+        if not query: return []
+        with connections[self.using].cursor() as cursor:
+            # name is more important than speciality for the rank
+            cursor.execute('SELECT rowid FROM %s WHERE %s MATCH %%s '
+                           'ORDER BY bm25(%s, 10.0, 1.0) LIMIT %%s' % (FTS_TABLE, FTS_TABLE, FTS_TABLE),
+                           [query, limit])
+            return [x[0] for x in cursor.fetchall()]
+
+    def update(self, worker_id, name, speciality):
+        with connections[self.using].cursor() as cursor:
+            cursor.execute('DELETE FROM %s WHERE rowid = %%s' % FTS_TABLE, [worker_id])
+            cursor.execute('INSERT INTO %s (rowid, name, speciality) VALUES (%%s, %%s, %%s)' % FTS_TABLE,
+                           [worker_id, name, speciality])
+
+    def remove(self, worker_id):
+        with connections[self.using].cursor() as cursor:
+            cursor.execute('DELETE FROM %s WHERE rowid = %%s' % FTS_TABLE, [worker_id])
+
+
+class TrigramIndex:
+    '''
+    In-memory index of trigrams of words for the databases without FTS5
+    '''
+
+    def __init__(self, using):
+        self.using = using
+        self._lock = threading.RLock()
+        self._loaded = 0 # time of loading
+        self._documents = {} # id: (name tokens, speciality tokens)
+        self._trigrams = defaultdict(set) # trigram: ids
+
+    @staticmethod
+    def trigrams(token):
+        token = ' ' + token # marks the beginning of the word for prefixes
+        return {token[i:i + 3] for i in range(max(len(token) - 2, 1))}
+
+    def _load(self):
+        if self._loaded and time.monotonic() - self._loaded < TRIGRAM_MAX_AGE: return
+        self._documents.clear()
+        self._trigrams.clear()
+        for worker_id, name, speciality in Worker.objects.using(self.using).values_list(
+                                        'id', 'name', 'speciality__name'):
+            self._add(worker_id, name, speciality)
+        self._loaded = time.monotonic()
+
+    def _add(self, worker_id, name, speciality):
+        document = (tokenize(name), tokenize(speciality))
+        self._documents[worker_id] = document
+        for token in document[0] + document[1]:
+            for trigram in self.trigrams(token):
+                self._trigrams[trigram].add(worker_id)
+
+    def update(self, worker_id, name, speciality):
+        with self._lock:
+            if not self._loaded: return
+            self._remove(worker_id)
+            self._add(worker_id, name, speciality)
+
+    def remove(self, worker_id):
+        with self._lock:
+            if self._loaded: self._remove(worker_id)
+
+    def _remove(self, worker_id):
+        document = self._documents.pop(worker_id, None)
+        if document is None: return
+        for token in document[0] + document[1]:
+            for trigram in self.trigrams(token):
+                self._trigrams[trigram].discard(worker_id)
+
+    def search(self, text, limit=SEARCH_LIMIT):
+        tokens = tokenize(text)
+        if not tokens: return []
+        with self._lock:
+            self._load()
+            candidates = None
+            for token in tokens:
+                if len(token) < 2: ids = set(self._documents) # too short for trigrams
+                else: ids = set.intersection(*(self._trigrams.get(x, set()) for x in self.trigrams(token)))
+                candidates = ids if candidates is None else candidates & ids
+                if not candidates: return []
+            scored = []
+            for worker_id in candidates:
+                score = self._score(tokens, *self._documents[worker_id])
+                if score: scored.append((-score, worker_id))
+        scored.sort()
+        return [worker_id for _, worker_id in scored[:limit]]
+
+    @staticmethod
+    def _score(tokens, name, speciality):
+        # trigrams only select candidates, every token must be a prefix of a word
+        score = 0
+        for token in tokens:
+            if any(x.startswith(token) for x in name): score += 10
+            elif any(x.startswith(token) for x in speciality): score += 1
+            else: return 0
+        return score
+
+
+_indexes = {} # alias of database: index
+
+
+def get_index(using=None):
+    '''
+    Search index of the database (of the current facility by default)
+    '''
+    using = using or Worker.objects.db
+    if using not in _indexes:
+        _indexes[using] = Fts5Index(using) if fts_available(using) else TrigramIndex(using)
+    return _indexes[using]
+
+
+def search_workers(text, limit=SEARCH_LIMIT):
+    '''
+    Find workers by beginnings of words of the name and speciality
+
+            Parameters:
+                    text (str): search string
+                    limit (int): max number of results
+
+            Returns:
+                    list of Worker, best matches first
+    '''
+    index = get_index()
+    ids = index.search(text, limit)
+    workers = Worker.objects.using(index.using).select_related('speciality').in_bulk(ids)
+    return [workers[x] for x in ids if x in workers]
+
+
+def index_worker(worker, using=None):
+    get_index(using).update(worker.pk, worker.name, worker.speciality.name)
+
+
+def unindex_worker(worker_id, using=None):
+    get_index(using).remove(worker_id)
@@ -1,5 +1,5 @@
 from rest_framework import serializers
-from .models import Users, Location, Worker, Schedule, Appointments
+from .models import Users, Location, Worker, Schedule, Appointments, Speciality, AppointmentRow
 
 class UsersSerializer(serializers.ModelSerializer):
     
@@ -13,7 +13,19 @@ class LocationSerializer(serializers.ModelSerializer):
         model = Location
         fields = '__all__'
 
+class SpecialityField(serializers.SlugRelatedField):
+    '''
+    Speciality as its name, new specialities are created when the worker is saved
+    '''
+    def __init__(self, **kwargs):
+        kwargs.setdefault('queryset', Speciality.objects.all())
+        super().__init__(slug_field='name', **kwargs)
+
+    def to_internal_value(self, data):
+        return Speciality.objects.get_by_name(str(data))
+
 class WorkerSerializer(serializers.ModelSerializer):
+    speciality = SpecialityField()
     
     class Meta:
         model = Worker
@@ -35,3 +47,21 @@ class AppointmentsSerializer(serializers.ModelSerializer):
         model = Appointments
         fields = '__all__'
 
+class AppointmentRowSerializer(serializers.ModelSerializer):
+    '''
+    Same fields as AppointmentsSerializer, read from the flat row
+    '''
+    id = serializers.ReadOnlyField(source='appointment_id')
+    worker = serializers.ReadOnlyField(source='worker_name')
+    place = serializers.ReadOnlyField(source='place_name')
+    creator = serializers.SerializerMethodField()
+    series = serializers.ReadOnlyField(source='series_id')
+
+    class Meta:
+        model = AppointmentRow
+        fields = ('id', 'worker', 'place', 'creator', 'number', 'day', 'time_in', 'time_out', 
+                  'title', 'orphaned', 'series')
+
+    def get_creator(self, row):
+        # null without a creator, as in AppointmentsSerializer
+        return row.creator_username if row.creator_id is not None else None
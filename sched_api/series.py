@@ -0,0 +1,160 @@
+'''
+Recurring appointments (AppointmentSeries).
+
+All occurrences of a new series are checked together: one query of
+appointments per BATCH dates, one of active holds, one of other series
+and the working hours of the whole range (Availability). Occurrences are
+created as Appointments only up to settings.SCHED_BOOKING_HORIZON days
+ahead; the rest are added day by day by the materialize_series command,
+so a long series does not fill the table of appointments. Until then the
+bookings check the series themselves (series_conflict). The new range is
+checked again when it is created, days booked meanwhile are skipped.
+'''
+
+import datetime
+import logging
+from collections import defaultdict
+
+from django.conf import settings
+from django.db import router, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from . import metrics
+from .availability import Availability, covers, overlaps
+from .listing import refresh_rows
+from .models import Appointments, AppointmentSeries, SlotHold
+
+BATCH = 500 # dates in one IN query
+MAX_OCCURRENCES = 366
+
+logger = logging.getLogger('sched_api.series')
+
+
+def horizon(today=None):
+    # last day with created occurrences
+    today = today or timezone.localdate()
+    return today + datetime.timedelta(days=getattr(settings, 'SCHED_BOOKING_HORIZON', 62))
+
+
+def crossing(queryset, worker_id, place_id, time_in, time_out):
+    # rows of the worker or of the place overlapping the time of the day
+    return queryset.filter(Q(worker_id=worker_id) | Q(place_id=place_id),
+                           time_in__lt=time_out, time_out__gt=time_in)
+
+
+def virtual(series, day):
+    # the occurrence is not created as an appointment yet
+    return series.occurs(day) and (series.materialized_until is None or series.materialized_until < day)
+
+
+def check_series(series, date_from=None, date_to=None):
+    '''
+    Occurrences of the series which can not be booked
+
+            Parameters:
+                    series (AppointmentSeries): new or changed series
+                    date_from, date_to (date): range of the occurrences, all by default
+
+            Returns:
+                    sorted list of (date, reason)
+    '''
+    days = list(series.days(date_from, date_to))
+    if not days: return []
+    conflicts = {}
+    worker_id, place_id = series.worker_id, series.place_id
+
+    appointments = crossing(Appointments.objects, worker_id, place_id, series.time_in, series.time_out)
+    others = crossing(AppointmentSeries.objects, worker_id, place_id, series.time_in, series.time_out)
+    if series.pk is not None:
+        appointments = appointments.exclude(series_id=series.pk)
+        others = others.exclude(pk=series.pk)
+    for i in range(0, len(days), BATCH):
+        for day in appointments.filter(day__in=days[i:i + BATCH]).values_list('day', flat=True):
+            conflicts.setdefault(day, 'booked')
+    held = crossing(SlotHold.active(), worker_id, place_id, series.time_in, series.time_out)
+    for day in held.filter(day__range=(days[0], days[-1])).values_list('day', flat=True):
+        conflicts.setdefault(day, 'held')
+    for other in others.filter(first_day__lte=days[-1]):
+        for day in days:
+            if virtual(other, day): conflicts.setdefault(day, 'series')
+
+    availability = Availability([worker_id], days[0], days[-1], place_ids=[place_id])
+    for day in days:
+        if not covers(availability.hours(worker_id, day), series.time_in, series.time_out):
+            conflicts.setdefault(day, 'no working hours')
+        elif overlaps(availability.place_closures(place_id, day), series.time_in, series.time_out):
+            conflicts.setdefault(day, 'place closed')
+    return sorted(conflicts.items())
+
+
+def series_conflict(worker_id, place_id, day, time_in, time_out, exclude=None):
+    '''
+    Series with a not created occurrence overlapping the booking
+
+            Parameters:
+                    worker_id, place_id (int): who and where
+                    day (date), time_in, time_out (time): when
+                    exclude (int): id of the series of the booking itself
+
+            Returns:
+                    AppointmentSeries or None
+    '''
+    candidates = crossing(AppointmentSeries.objects, worker_id, place_id, time_in, time_out).filter(
+        Q(materialized_until__isnull=True) | Q(materialized_until__lt=day), first_day__lte=day)
+    if exclude is not None: candidates = candidates.exclude(pk=exclude)
+    return next((x for x in candidates if virtual(x, day)), None)
+
+
+def materialize(series, until=None):
+    '''
+    Create appointments of the occurrences up to the day
+
+            Parameters:
+                    series (AppointmentSeries): checked series
+                    until (date): last day, the booking horizon by default
+
+            Returns:
+                    list of created Appointments
+    '''
+    until = min(until or horizon(), series.last_day())
+    start = series.first_day
+    if series.materialized_until is not None:
+        start = max(start, series.materialized_until + datetime.timedelta(days=1))
+    using = router.db_for_write(Appointments) # database of the current facility
+    with transaction.atomic(using=using):
+        days = list(series.days(start, until)) if start <= until else []
+        if days: # the days could be booked or closed after the series was checked
+            conflicts = dict(check_series(series, start, until))
+            for day, reason in sorted(conflicts.items()):
+                logger.warning('Occurrence of the series %d on %s is skipped: %s', series.pk, day, reason)
+                metrics.inc('sched_booking_rejections_total', reason='series_skipped')
+            days = [x for x in days if x not in conflicts]
+        number = Appointments.next_number()
+        appointments = Appointments.objects.bulk_create(
+            [Appointments(number=number + i, worker_id=series.worker_id, place_id=series.place_id,
+                          day=day, time_in=series.time_in, time_out=series.time_out,
+                          title=series.title, creator_id=series.creator_id, series=series)
+             for i, day in enumerate(days)], batch_size=BATCH)
+        refresh_rows(Appointments.objects.filter(number__gte=number).values_list('id', flat=True), using)
+        if until > (series.materialized_until or datetime.date.min):
+            series.materialized_until = until
+            AppointmentSeries.objects.filter(pk=series.pk).update(materialized_until=until)
+    return appointments
+
+
+def materialize_due(today=None):
+    '''
+    Move all series to the current booking horizon, run it daily
+
+            Returns:
+                    {series id: number of created appointments}
+    '''
+    until = horizon(today)
+    created = defaultdict(int)
+    for series in AppointmentSeries.objects.filter(
+            Q(materialized_until__isnull=True) | Q(materialized_until__lt=until), first_day__lte=until):
+        if series.materialized_until is not None and series.materialized_until >= series.last_day():
+            continue
+        created[series.pk] += len(materialize(series, until))
+    return dict(created)
@@ -0,0 +1,150 @@
+'''
+Handlers of the model signals
+'''
+
+from django.core.cache import cache
+from django.db import transaction
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from .models import Appointments, Speciality, Worker, Schedule, ScheduleException, Location, Users
+from .models import speciality_cache_key
+from .events import broadcaster, appointment_event, schedule_event
+from .search import index_worker, unindex_worker
+from .waitlist import match_freed_interval, match_worker_schedule
+from .reconcile import reconcile
+from .snapshot import refresh_snapshot
+from .listing import save_row, rename
+from .holds import release_own, sweep
+from . import feeds, refcache
+from .sqlite import configure_connection
+
+
+@receiver(post_save, sender=Appointments)
+def appointment_row_saved(sender, instance, using, **kwargs):
+    # flat row for the lists, in the same transaction
+    save_row(instance, using)
+
+
+@receiver(post_save, sender=Appointments)
+def appointment_saved(sender, instance, created, using, **kwargs):
+    # push the change to the live schedule pages after commit
+    event = appointment_event(instance, 'created' if created else 'updated')
+    transaction.on_commit(lambda: broadcaster.publish(event), using=using)
+
+
+@receiver(post_save, sender=Appointments)
+def appointment_holds(sender, instance, created, using, **kwargs):
+    # the holds of the creator are used up, expired holds are swept from time to time
+    if created: release_own(instance, using)
+    transaction.on_commit(sweep, using=using)
+
+
+@receiver(post_delete, sender=Appointments)
+def appointment_deleted(sender, instance, using, **kwargs):
+    event = appointment_event(instance, 'cancelled')
+    transaction.on_commit(lambda: broadcaster.publish(event), using=using)
+    # book the freed time for the waitlist
+    freed = (instance.worker_id, instance.place_id) + tuple(
+        Appointments._meta.get_field(x).to_python(getattr(instance, x)) for x in ('day', 'time_in', 'time_out'))
+    transaction.on_commit(lambda: match_freed_interval(*freed), using=using)
+    feeds.invalidate(using, [instance.worker_id], [instance.place_id])
+
+
+@receiver(post_save, sender=Schedule)
+@receiver(post_delete, sender=Schedule)
+def schedule_changed(sender, using, **kwargs):
+    # swap the shared snapshot before other handlers read working hours
+    transaction.on_commit(lambda: refresh_snapshot(using), using=using)
+
+
+@receiver(post_save, sender=Schedule)
+@receiver(post_delete, sender=Schedule)
+def schedule_published(sender, instance, using, **kwargs):
+    # push the change to the live schedule pages after commit
+    event = schedule_event(instance, 'updated' if 'created' in kwargs else 'deleted')
+    transaction.on_commit(lambda: broadcaster.publish(event), using=using)
+
+
+@receiver(post_save, sender=Schedule)
+def schedule_saved(sender, instance, using, **kwargs):
+    worker_id = instance.worker_id
+    transaction.on_commit(lambda: match_worker_schedule(worker_id), using=using)
+
+
+@receiver(post_save, sender=Schedule)
+@receiver(post_delete, sender=Schedule)
+@receiver(post_save, sender=ScheduleException)
+@receiver(post_delete, sender=ScheduleException)
+def working_hours_changed(sender, instance, using, **kwargs):
+    # flag future appointments left outside working hours
+    worker_ids = None if instance.worker_id is None else [instance.worker_id]
+    transaction.on_commit(lambda: reconcile(worker_ids), using=using)
+
+
+@receiver(post_save, sender=Schedule)
+@receiver(post_delete, sender=Schedule)
+@receiver(post_save, sender=ScheduleException)
+@receiver(post_delete, sender=ScheduleException)
+def feed_hours_changed(sender, instance, using, **kwargs):
+    # working hours in the calendar feeds, closures of all workers change every feed
+    everything = sender is ScheduleException and instance.worker_id is None and instance.place_id is None
+    place_ids = [instance.place_id] if sender is ScheduleException else []
+    feeds.invalidate(using, [instance.worker_id], place_ids, everything)
+
+
+@receiver(post_save, sender=Speciality)
+@receiver(post_delete, sender=Speciality)
+def speciality_changed(sender, using, **kwargs):
+    # list of specialities is cached, build it again on next request
+    cache.delete(speciality_cache_key(using))
+
+
+@receiver(post_save, sender=Worker)
+@receiver(post_delete, sender=Worker)
+@receiver(post_save, sender=Location)
+@receiver(post_delete, sender=Location)
+@receiver(post_save, sender=Speciality)
+@receiver(post_delete, sender=Speciality)
+def reference_changed(sender, using, **kwargs):
+    # drop reference data cached by this process now and by all processes after commit
+    refcache.forget(using)
+    transaction.on_commit(lambda: refcache.invalidate(using), using=using)
+    feeds.invalidate(using, everything=True) # names and members of the feeds
+
+
+@receiver(post_save, sender=Worker)
+def worker_saved(sender, instance, using, **kwargs):
+    # keep the search index of workers in sync
+    index_worker(instance, using)
+
+
+@receiver(post_save, sender=Worker)
+@receiver(post_save, sender=Location)
+def name_changed(sender, instance, created, using, **kwargs):
+    # names are copied into rows of appointments
+    if created: return
+    rename('worker' if sender is Worker else 'place', instance.pk, instance.name, using)
+
+
+@receiver(post_save, sender=Users)
+def username_changed(sender, instance, created, using, **kwargs):
+    if created: return
+    rename('creator', instance.pk, instance.username, using)
+
+
+@receiver(post_delete, sender=Worker)
+def worker_deleted(sender, instance, using, **kwargs):
+    unindex_worker(instance.pk, using)
+
+
+@receiver(post_save, sender=Speciality)
+def speciality_renamed(sender, instance, created, using, **kwargs):
+    if created: return
+    for worker in instance.workers.using(using):
+        index_worker(worker, using)
+
+
+# pragmas of SQLite connections (WAL, timeouts, caches)
+connection_created.connect(configure_connection, dispatch_uid='sched_api_sqlite_pragmas')
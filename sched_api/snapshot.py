@@ -0,0 +1,147 @@
+'''
+Snapshot of the weekly schedules shared by all worker processes.
+
+The Schedule segments are written into one file of arrays (sorted ids of
+workers, offsets of every (worker, day of the week) and pairs of seconds
+since midnight) in settings.SCHED_SNAPSHOT_DIR. Processes map the file
+into memory and read the arrays in place, so the memory is shared by all
+of them. After changes of the Schedule the file is built again into a
+temporary file and swapped with os.replace; readers see the new file by
+its inode and map it again.
+
+Without SCHED_SNAPSHOT_DIR the schedules are read from the database.
+'''
+
+import bisect
+import datetime
+import fcntl
+import mmap
+import os
+import struct
+from array import array
+
+from django.conf import settings
+from django.db import router
+
+from .models import Schedule
+from .tenancy import primary_database
+
+MAGIC = b'SCHEDSNP'
+VERSION = 1
+HEADER = struct.Struct('<8sIII4x') # magic, version, number of workers, number of segments
+DAYS = 7
+
+_snapshots = {} # alias: Snapshot
+
+
+def seconds(time):
+    return time.hour * 3600 + time.minute * 60 + time.second
+
+
+def to_time(value):
+    return datetime.time(value // 3600, value // 60 % 60, value % 60)
+
+
+def snapshot_path(using):
+    directory = getattr(settings, 'SCHED_SNAPSHOT_DIR', None)
+    return os.path.join(directory, 'schedule-%s.bin' % using) if directory else None
+
+
+def build_snapshot(using='default'):
+    '''
+    Write the snapshot of the database and swap it with the old one
+
+            Parameters:
+                    using (str): database alias
+
+            Returns:
+                    path of the snapshot file
+    '''
+    path = snapshot_path(using)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # builds of several processes go one after another, the last one reads all commits
+    with open(path + '.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        rows = Schedule.objects.using(using).order_by('worker_id', 'day', 'time_in').values_list(
+            'worker_id', 'day', 'time_in', 'time_out')
+        workers = array('q')
+        offsets = array('I')
+        segments = array('I')
+        for worker_id, day, time_in, time_out in rows.iterator():
+            if not workers or workers[-1] != worker_id: workers.append(worker_id)
+            # offsets of the days before the segment (and of the day itself) point here
+            while len(offsets) < (len(workers) - 1) * DAYS + day: offsets.append(len(segments) // 2)
+            segments.extend((seconds(time_in), seconds(time_out)))
+        while len(offsets) < len(workers) * DAYS + 1: offsets.append(len(segments) // 2)
+
+        temporary = '%s.%d.tmp' % (path, os.getpid())
+        with open(temporary, 'wb') as file:
+            file.write(HEADER.pack(MAGIC, VERSION, len(workers), len(segments) // 2))
+            for data in (workers, offsets, segments): data.tofile(file)
+        os.replace(temporary, path)
+    return path
+
+
+class Snapshot:
+    '''
+    Read only view of the snapshot file mapped into memory
+    '''
+
+    def __init__(self, path):
+        with open(path, 'rb') as file:
+            self.inode = os.fstat(file.fileno()).st_ino
+            self.map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, workers, segments = HEADER.unpack_from(self.map)
+        if magic != MAGIC or version != VERSION: raise ValueError('Wrong snapshot file ' + path)
+        view = memoryview(self.map)
+        start = HEADER.size
+        self.workers = view[start:start + workers * 8].cast('q')
+        start += workers * 8
+        self.offsets = view[start:start + (workers * DAYS + 1) * 4].cast('I')
+        start += (workers * DAYS + 1) * 4
+        self.segments = view[start:start + segments * 8].cast('I')
+
+    def segments_of(self, worker_id, day):
+        '''
+        Weekly segments of the worker
+
+                Parameters:
+                        worker_id (int): id of Worker
+                        day (int): day of the week, 1 - Monday
+
+                Returns:
+                        list of (time_in, time_out) sorted by time_in
+        '''
+        i = bisect.bisect_left(self.workers, worker_id)
+        if i == len(self.workers) or self.workers[i] != worker_id: return []
+        first, last = self.offsets[i * DAYS + day - 1], self.offsets[i * DAYS + day]
+        return [(to_time(self.segments[2 * j]), to_time(self.segments[2 * j + 1]))
+                for j in range(first, last)]
+
+
+def get_snapshot(using=None):
+    '''
+    Current snapshot of the database, built if there is no file yet
+
+            Parameters:
+                    using (str): database alias, the database of Schedule reads by default
+
+            Returns:
+                    Snapshot or None if snapshots are turned off
+    '''
+    using = primary_database(using or router.db_for_read(Schedule) or 'default')
+    path = snapshot_path(using)
+    if path is None: return None
+    try:
+        inode = os.stat(path).st_ino
+    except FileNotFoundError:
+        build_snapshot(using)
+        inode = os.stat(path).st_ino
+    snapshot = _snapshots.get(using)
+    if snapshot is None or snapshot.inode != inode: # swapped by the refresher
+        snapshot = _snapshots[using] = Snapshot(path)
+    return snapshot
+
+
+def refresh_snapshot(using='default'):
+    if snapshot_path(using) is not None: build_snapshot(using)
@@ -0,0 +1,256 @@
+'''
+Batch assignment of booking requests (mass vaccination and screening days).
+
+Requests ("speciality X, between 9 and 13, 20 minutes") are packed into
+the free working time of workers and free rooms. All data of the batch is
+read with a few queries, the packing works with minutes in memory:
+requests are taken by the earliest deadline, every request goes to the
+worker who can start it first, and the room is the one the worker already
+uses at that time of the day (or the room of the shift) or any free room.
+Existing appointments, active holds, occurrences of series, rooms of shifts,
+closures and extra shifts are respected. The placed bookings are checked
+again when they are saved, so bookings made meanwhile are not overlapped.
+'''
+
+import bisect
+import datetime
+import time
+from collections import defaultdict
+
+from django.db import router, transaction
+
+from .models import Appointments, Location, Worker, Speciality
+from .availability import Availability
+from .conflicts import MESSAGES, Occupancy
+from .listing import refresh_rows
+
+
+def to_minutes(value):
+    if isinstance(value, str): value = datetime.time.fromisoformat(value)
+    return value.hour * 60 + value.minute
+
+
+def to_time(minutes):
+    return datetime.time(minutes // 60, minutes % 60) if minutes < 24 * 60 else datetime.time.max
+
+
+class Timeline:
+    '''
+    Sorted not overlapping busy intervals (in minutes) of one worker or room for one day
+    '''
+
+    def __init__(self):
+        self.starts = []
+        self.ends = []
+
+    def add(self, start, end):
+        # overlapping and touching intervals are merged
+        i = bisect.bisect_left(self.ends, start)
+        j = bisect.bisect_right(self.starts, end)
+        if i < j:
+            start = min(start, self.starts[i])
+            end = max(end, self.ends[j - 1])
+        self.starts[i:j] = [start]
+        self.ends[i:j] = [end]
+
+    def is_free(self, start, end):
+        return self.free_from(start, end) == start
+
+    def free_from(self, start, end):
+        # start if the interval is free, else the end of the busy interval blocking it
+        i = bisect.bisect_left(self.starts, end)
+        return start if i == 0 or self.ends[i - 1] <= start else self.ends[i - 1]
+
+    def earliest(self, start, end, duration, free):
+        '''
+        First start of the interval of the duration inside (start, end), which is
+        inside one of the free intervals and not busy
+        '''
+        for x, y in free:
+            moment = max(start, x)
+            last = min(end, y) - duration
+            while moment <= last:
+                i = bisect.bisect_right(self.starts, moment)
+                if i and self.ends[i - 1] > moment: # inside the busy interval
+                    moment = self.ends[i - 1]
+                    continue
+                if i < len(self.starts) and self.starts[i] < moment + duration:
+                    moment = self.ends[i]
+                    continue
+                return moment
+        return None
+
+
+class Request:
+    '''
+    One request of the batch
+    '''
+
+    def __init__(self, index, data):
+        self.index = index
+        self.worker = data.get('worker')
+        self.speciality = data.get('speciality')
+        self.day = data['day'] if isinstance(data['day'], datetime.date) else (
+            datetime.date.fromisoformat(data['day']))
+        self.start = to_minutes(data['time_from'])
+        self.end = to_minutes(data['time_to'])
+        self.duration = int(data['duration'])
+        self.title = data.get('title', '')
+        if self.end - self.start < self.duration or self.duration <= 0:
+            raise ValueError('Wrong time of the request ' + str(index))
+        if (self.worker is None) == (self.speciality is None):
+            raise ValueError('Choose the worker or the speciality in the request ' + str(index))
+
+    def key(self):
+        return (self.worker, self.speciality, self.day, self.start, self.end, self.duration)
+
+
+class Solver:
+    '''
+    Packs the batch of requests into schedules of workers and rooms
+    '''
+
+    def __init__(self, requests):
+        self.requests = [Request(i, x) for i, x in enumerate(requests)]
+        self.placed = [] # (request, worker id, place id, start, end)
+        self.unplaced = []
+        self.rejected = [] # (request, reason) taken meanwhile, found by save()
+        self.failed = set() # keys of requests which can not be placed
+        self.seconds = 0
+        self.using = router.db_for_write(Appointments) # database of the current facility
+
+    def load(self):
+        # candidates of every request, free hours and busy timelines, few queries
+        specialities = Speciality.objects.cached_map()
+        by_speciality = defaultdict(list)
+        for worker_id, speciality_id in Worker.objects.values_list('id', 'speciality_id'):
+            by_speciality[speciality_id].append(worker_id)
+        for request in self.requests:
+            if request.worker is not None: request.candidates = [int(request.worker)]
+            else: request.candidates = by_speciality.get(specialities.get(request.speciality), [])
+
+        self.places = list(Location.objects.order_by('room').values_list('id', flat=True))
+        days = {x.day for x in self.requests}
+        worker_ids = {x for request in self.requests for x in request.candidates}
+        self.workers_busy = defaultdict(Timeline)
+        self.places_busy = defaultdict(Timeline)
+        self.free = {}
+        if not days: return
+        availability = Availability(worker_ids, min(days), max(days), place_ids=self.places)
+        for day in days:
+            for worker_id in worker_ids:
+                self.free[(worker_id, day)] = [(to_minutes(x), to_minutes(y) if y != datetime.time.max
+                                                else 24 * 60) for x, y in availability.hours(worker_id, day)]
+            for place_id in self.places:
+                for x, y in availability.place_closures(place_id, day):
+                    self.places_busy[(place_id, day)].add(to_minutes(x), 24 * 60 if y == datetime.time.max
+                                                          else to_minutes(y))
+        # appointments, occurrences of series and holds (of any holder) are busy time
+        self.occupancy = Occupancy(days, worker_ids, self.places, self.using)
+        busy = {'worker': self.workers_busy, 'place': self.places_busy}
+        for (kind, pk, day), intervals in list(self.occupancy.busy.items()) + list(self.occupancy.holds.items()):
+            for time_in, time_out, *_ in intervals:
+                busy[kind][(pk, day)].add(to_minutes(time_in), 24 * 60 if time_out == datetime.time.max
+                                          else to_minutes(time_out))
+        self.rooms_of_workers = {} # (worker, day): room used by the worker that day
+
+    def place(self, request):
+        # the worker who can start first, then the room for that time
+        best = None
+        for worker_id in request.candidates:
+            free = self.free.get((worker_id, request.day), [])
+            moment = request.start
+            while True:
+                start = self.workers_busy[(worker_id, request.day)].earliest(
+                    moment, request.end, request.duration, free)
+                if start is None or (best is not None and start >= best[0]): break
+                place_id, later = self.room(worker_id, request.day, start, start + request.duration)
+                if place_id is not None:
+                    best = (start, worker_id, place_id)
+                    break
+                if later is None: break
+                moment = later # all rooms are busy, try when one gets free
+        if best is None:
+            # resources are only taken, so the same request will fail later too
+            self.failed.add(request.key())
+            return False
+        start, worker_id, place_id = best
+        end = start + request.duration
+        self.workers_busy[(worker_id, request.day)].add(start, end)
+        self.places_busy[(place_id, request.day)].add(start, end)
+        self.rooms_of_workers[(worker_id, request.day)] = place_id
+        self.placed.append((request, worker_id, place_id, start, end))
+        return True
+
+    def room(self, worker_id, day, start, end):
+        '''
+        Free room for the interval, the room of the worker is preferred, 
+        so one worker keeps one room
+
+                Returns:
+                        (id of Location or None, earliest moment when some room gets free)
+        '''
+        time_in, time_out = to_time(start), to_time(end)
+        own = self.rooms_of_workers.get((worker_id, day)) or self.occupancy.room_of(worker_id, day, time_in, time_out)
+        if own is not None and self.places_busy[(own, day)].is_free(start, end) and \
+                not self.occupancy.room_taken(worker_id, own, day, time_in, time_out): return own, start
+        later = None
+        for place_id in self.places:
+            if self.occupancy.room_taken(worker_id, place_id, day, time_in, time_out): continue
+            moment = self.places_busy[(place_id, day)].free_from(start, end)
+            if moment == start: return place_id, start
+            later = moment if later is None else min(later, moment)
+        return None, later
+
+    def solve(self):
+        '''
+        Place all requests
+
+                Returns:
+                        number of placed requests
+        '''
+        started = time.perf_counter()
+        self.load()
+        # earliest deadline first, shorter windows first among equal deadlines
+        for request in sorted(self.requests, key=lambda x: (x.day, x.end, x.end - x.start, x.index)):
+            if request.key() in self.failed or not self.place(request): self.unplaced.append(request)
+        self.seconds = time.perf_counter() - started
+        return len(self.placed)
+
+    def save(self, creator=None):
+        '''
+        Create the appointments of the placed requests in one transaction,
+        the ones conflicting with bookings made after solve() are rejected
+
+                Returns:
+                        list of created Appointments
+        '''
+        with transaction.atomic(using=self.using):
+            # the occupancy is read again inside the transaction
+            occupancy = Occupancy({x[0].day for x in self.placed}, {x[1] for x in self.placed},
+                                  {x[2] for x in self.placed}, self.using)
+            creator_id = creator.pk if creator is not None else None
+            number = Appointments.next_number()
+            appointments = []
+            for request, worker_id, place_id, start, end in self.placed:
+                time_in, time_out = to_time(start), to_time(end)
+                reason = occupancy.conflict(worker_id, place_id, request.day, time_in, time_out, creator_id)
+                if reason is not None:
+                    self.rejected.append((request, reason))
+                    continue
+                occupancy.add(worker_id, place_id, request.day, time_in, time_out)
+                appointments.append(Appointments(number=number + len(appointments), worker_id=worker_id,
+                                                 place_id=place_id, day=request.day, time_in=time_in,
+                                                 time_out=time_out, title=request.title, creator=creator))
+            appointments = Appointments.objects.bulk_create(appointments, batch_size=500)
+            refresh_rows(Appointments.objects.filter(number__gte=number).values_list('id', flat=True), self.using)
+        return appointments
+
+    def report(self):
+        return {
+            'requests': len(self.requests),
+            'placed': len(self.placed) - len(self.rejected),
+            'unplaced': [x.index for x in self.unplaced],
+            'rejected': [{'index': x.index, 'reason': MESSAGES[reason]} for x, reason in self.rejected],
+            'seconds': round(self.seconds, 3),
+        }
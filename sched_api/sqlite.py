@@ -0,0 +1,46 @@
+'''
+Tuning of SQLite connections.
+
+settings.SCHED_SQLITE_PRAGMAS are executed on every new SQLite connection
+(connection_created signal), e.g. WAL journal, so readers do not wait for
+the writer, busy timeout instead of immediate "database is locked" errors,
+memory-mapped reads and a bigger page cache. Empty in development,
+see Sched.settings_production.
+'''
+
+import sqlite3
+
+from django.conf import settings
+from django.db import OperationalError
+
+# Pragmas of the production profile, the order matters (journal mode first)
+PRODUCTION_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL', # safe with WAL, fsync on checkpoints only
+    'busy_timeout': 5000, # ms to wait for the lock of the writer
+    'mmap_size': 256 * 2 ** 20,
+    'cache_size': -64 * 2 ** 10, # KiB (negative value) per connection
+    'temp_store': 'MEMORY',
+}
+
+
+def apply_pragmas(cursor, pragmas):
+    '''
+    Execute the pragmas
+
+            Parameters:
+                    cursor: cursor of sqlite3 or of Django
+                    pragmas (dict): {name: value}
+    '''
+    for name, value in pragmas.items():
+        try:
+            cursor.execute('PRAGMA %s = %s' % (name, value))
+        except (sqlite3.OperationalError, OperationalError):
+            # read only connections (replicas) can not change the journal mode
+            if name != 'journal_mode': raise
+
+
+def configure_connection(sender, connection, **kwargs):
+    pragmas = getattr(settings, 'SCHED_SQLITE_PRAGMAS', None)
+    if pragmas and connection.vendor == 'sqlite':
+        with connection.cursor() as cursor: apply_pragmas(cursor, pragmas)
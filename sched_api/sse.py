@@ -0,0 +1,96 @@
+'''
+ASGI application for the Server-Sent Events stream of appointments and
+of the weekly schedule (events 'schedule').
+Query parameters (comma separated lists, all optional):
+    worker - ids of Worker
+    place - ids of Location
+    day - days in ISO format (2022-06-20)
+The stream of the facility is served at /f/<facility>/schedule/events.
+'''
+
+import asyncio
+import json
+import re
+from urllib.parse import parse_qs
+
+from .events import broadcaster
+
+HEARTBEAT = 25 # seconds between keep-alive comments for proxies
+EVENTS_PATH_RE = re.compile(r'^(/f/(?P<facility>[^/]+))?/schedule/events/?$')
+
+
+def match_events_path(path):
+    # None if the path is not the events stream, else (facility, )
+    match = EVENTS_PATH_RE.match(path)
+    return (match.group('facility'), ) if match else None
+
+
+def parse_filter(query_string):
+    '''
+    Get filters of the stream from query string
+
+            Parameters:
+                    query_string (bytes): raw query string of the request
+
+            Returns:
+                    dict with 'workers', 'places' and 'days' lists
+    '''
+    query = parse_qs(query_string.decode('latin-1'))
+
+    def values(name):
+        return [x for item in query.get(name, []) for x in item.split(',') if x]
+
+    return {
+        'workers': [int(x) for x in values('worker') if x.isdigit()],
+        'places': [int(x) for x in values('place') if x.isdigit()],
+        'days': values('day'),
+    }
+
+
+def format_event(event):
+    return ('event: %s\ndata: %s\n\n' % (event['type'], json.dumps(event))).encode()
+
+
+async def sse_application(scope, receive, send):
+    '''
+    Stream the appointment events to the client until it disconnects
+    '''
+    if scope['method'] != 'GET':
+        await send({'type': 'http.response.start', 'status': 405,
+                    'headers': [(b'allow', b'GET')]})
+        await send({'type': 'http.response.body', 'body': b''})
+        return
+
+    facility, = match_events_path(scope.get('path', '/schedule/events'))
+    subscription = broadcaster.subscribe(facility=facility, 
+                                         **parse_filter(scope.get('query_string', b'')))
+    try:
+        await send({
+            'type': 'http.response.start',
+            'status': 200,
+            'headers': [
+                (b'content-type', b'text/event-stream'),
+                (b'cache-control', b'no-cache'),
+                (b'x-accel-buffering', b'no'),
+            ],
+        })
+        await send({'type': 'http.response.body', 'body': b': connected\n\n', 'more_body': True})
+
+        disconnect = asyncio.ensure_future(receive())
+        event = asyncio.ensure_future(subscription.queue.get())
+        while True:
+            done, _ = await asyncio.wait({event, disconnect}, timeout=HEARTBEAT,
+                                         return_when=asyncio.FIRST_COMPLETED)
+            if disconnect in done:
+                if disconnect.result()['type'] == 'http.disconnect':
+                    event.cancel()
+                    break
+                disconnect = asyncio.ensure_future(receive()) # request body, wait further
+            if event in done:
+                body = format_event(event.result())
+                event = asyncio.ensure_future(subscription.queue.get())
+            elif not done: body = b': keep-alive\n\n'
+            else: continue
+            await send({'type': 'http.response.body', 'body': body, 'more_body': True})
+    finally:
+        broadcaster.unsubscribe(subscription)
@@ -0,0 +1,225 @@
+'''
+Facilities (clinics) served by one deployment.
+
+Each facility has its own database (settings.SCHED_FACILITIES), so rooms,
+workers, schedules and appointments of the facility live in their own
+tables and indexes. The facility of the request is taken from the URL
+prefix /f/<facility>/ or from the X-Facility-Token header, and
+FacilityRouter sends all queries of the request to its database.
+Without the facility everything works with the default database.
+
+Read only views (use_replica) send reads of schedules and appointments to
+the replica of the database (settings.SCHED_READ_REPLICAS) by ReplicaRouter.
+'''
+
+from contextlib import contextmanager
+
+from asgiref.local import Local
+from django.conf import settings
+from django.core.management import CommandError
+from django.http import Http404
+from django.urls import get_script_prefix, set_script_prefix
+
+URL_PREFIX = '/f/'
+TOKEN_HEADER = 'HTTP_X_FACILITY_TOKEN'
+
+_current = Local()
+
+
+def facilities():
+    # {facility: {'DATABASE': alias, 'TOKEN': token}}
+    return getattr(settings, 'SCHED_FACILITIES', {})
+
+
+def get_current_facility():
+    return getattr(_current, 'facility', None)
+
+
+def set_current_facility(facility):
+    if facility is not None and facility not in facilities():
+        raise Http404('Unknown facility: ' + str(facility))
+    _current.facility = facility
+
+
+def facility_database(facility=None):
+    '''
+    Database alias of the facility
+
+            Parameters:
+                    facility (str): name of the facility, current facility by default
+
+            Returns:
+                    alias from settings.DATABASES or None for the default database
+    '''
+    facility = facility or get_current_facility()
+    if facility is None: return None
+    return facilities()[facility]['DATABASE']
+
+
+def facility_for_database(alias):
+    # name of the facility by its database alias
+    for facility, config in facilities().items():
+        if config['DATABASE'] == alias: return facility
+    return None
+
+
+def command_facilities(facility=None):
+    '''
+    Facilities handled by a command: the given one, or the default database
+    and every facility with its own database
+
+            Parameters:
+                    facility (str): name of the facility, all by default
+
+            Returns:
+                    list of names for use_facility, None for the default database
+    '''
+    if facility is not None:
+        if facility not in facilities(): raise CommandError('Unknown facility: ' + facility)
+        return [facility]
+    names, aliases = [None], {'default'}
+    for name, config in facilities().items():
+        if config['DATABASE'] in aliases: continue
+        aliases.add(config['DATABASE'])
+        names.append(name)
+    return names
+
+
+def replicas():
+    # {database alias: alias of its read replica}
+    return getattr(settings, 'SCHED_READ_REPLICAS', {})
+
+
+def primary_database(alias):
+    # database of the replica, the alias itself for other databases
+    for primary, replica in replicas().items():
+        if replica == alias: return primary
+    return alias
+
+
+@contextmanager
+def use_replica():
+    '''
+    Read schedules and appointments from the replica, for read only views
+    '''
+    previous = getattr(_current, 'replica', False)
+    _current.replica = True
+    try:
+        yield
+    finally:
+        _current.replica = previous
+
+
+@contextmanager
+def use_facility(facility):
+    '''
+    Run the code (commands, tests, workers) with data of the facility
+    '''
+    previous = get_current_facility()
+    set_current_facility(facility)
+    try:
+        yield
+    finally:
+        _current.facility = previous
+
+
+def keep_context(iterator):
+    '''
+    Iterator run in the facility and replica context of the caller, for
+    streamed responses which are consumed after the middleware has reset it
+
+            Parameters:
+                    iterator (iterator): lazy chunks making queries
+
+            Returns:
+                    generator of the same chunks
+    '''
+    # taken now, the generator body runs only when the response is sent
+    facility, replica = get_current_facility(), getattr(_current, 'replica', False)
+
+    def chunks():
+        while True:
+            previous = getattr(_current, 'replica', False)
+            _current.replica = replica
+            try:
+                with use_facility(facility):
+                    chunk = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                _current.replica = previous
+            yield chunk
+
+    return chunks()
+
+
+class FacilityRouter:
+    '''
+    Sends queries to the database of the current facility
+    '''
+
+    def db_for_read(self, model, **hints):
+        return facility_database()
+
+    def db_for_write(self, model, **hints):
+        return facility_database()
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # rows of different facilities are never related
+        return obj1._state.db == obj2._state.db
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # every facility database has the full schema
+        return True
+
+
+class ReplicaRouter:
+    '''
+    Sends reads of read only views to the replica of the current database,
+    reference data (workers, places, users) is read from the primary database
+    with its caches
+    '''
+    models = ('appointments', 'appointmentrow', 'schedule', 'scheduleexception')
+
+    def db_for_read(self, model, **hints):
+        if not getattr(_current, 'replica', False) or model._meta.model_name not in self.models: return None
+        return replicas().get(facility_database() or 'default')
+
+    def allow_relation(self, obj1, obj2, **hints):
+        if primary_database(obj1._state.db) == primary_database(obj2._state.db): return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # replicas share the files of their databases
+        return False if db in replicas().values() else None
+
+
+class FacilityMiddleware:
+    '''
+    Takes the facility from the URL prefix or the token of the request
+    '''
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.tokens = {config['TOKEN']: facility for facility, config in facilities().items()
+                       if config.get('TOKEN')}
+
+    def __call__(self, request):
+        facility = None
+        script_prefix = get_script_prefix()
+        if request.path_info.startswith(URL_PREFIX):
+            facility, _, path = request.path_info[len(URL_PREFIX):].partition('/')
+            request.path_info = '/' + path
+            # links in templates keep the prefix of the facility
+            set_script_prefix(script_prefix + URL_PREFIX.lstrip('/') + facility + '/')
+        elif TOKEN_HEADER in request.META:
+            facility = self.tokens.get(request.META[TOKEN_HEADER])
+            if facility is None: raise Http404('Unknown facility token')
+
+        try:
+            set_current_facility(facility)
+            request.facility = facility
+            return self.get_response(request)
+        finally:
+            _current.facility = None
+            set_script_prefix(script_prefix)
@@ -1,13 +1,51 @@
-from django.test import TestCase, Client
+from django.test import TestCase, TransactionTestCase, Client, override_settings
+from django.http import Http404
+from django.core.cache import cache
+from django.db import connection, connections, router, OperationalError
+from django.core.management import call_command, CommandError
+from django.test.utils import CaptureQueriesContext
 from django.core.exceptions import ValidationError
 from django.urls import reverse
-from .models import Schedule, Worker, Location, Appointments, Users
+from django.utils import timezone
+from .models import Schedule, Worker, Location, Appointments, Users, Speciality, ScheduleException
+from .models import WaitlistRequest, IdempotencyRecord, AppointmentRow, SlotHold, AppointmentSeries
+from .models import SentReminder
+from .models import speciality_cache_key
 from .models import check_overlap
-from .forms import WorkerForm, LocationForm, ScheduleForm, AppointmentsForm
+from .forms import WorkerForm, LocationForm, ScheduleForm, AppointmentsForm, SeriesForm
 from .views import api_admin_add_staff
+from .search import TrigramIndex, fts_available
+from .availability import Availability, merge, subtract
+from .solver import Solver
+from .holds import place_hold, confirm_hold, sweep
+from .series import horizon, materialize_due
+from .waitlist import first_fit
+from .reminders import ReminderScheduler, StubBackend
+from .renderers import columnar, msgpack
+from .compression import choose_encoding
+from .writequeue import GroupWriter, write_group
+from .feeds import fold, token
+from .snapshot import get_snapshot
+from .reconcile import reconcile, find_orphans
+from . import metrics, refcache
+from .tenancy import FacilityRouter, use_facility, get_current_facility, set_current_facility
+from .tenancy import ReplicaRouter, use_replica
+from .sqlite import apply_pragmas
 from .serializers import (UsersSerializer, WorkerSerializer, 
-                    LocationSerializer, ScheduleSerializer, AppointmentsSerializer)
+                    LocationSerializer, ScheduleSerializer, AppointmentsSerializer,
+                    AppointmentRowSerializer)
 import datetime
+import asyncio
+import threading
+import gzip
+import unittest
+from unittest import mock
+import json
+import os
+import tempfile
+import pstats
+from io import StringIO
+import sqlite3
 from django.contrib.auth import get_user_model
 
 class ModelTest(TestCase):
@@ -272,3 +310,1289 @@ class SerializersTest(TestCase):
         self.assertNotEqual(ScheduleSerializer(Schedule.objects.filter(time_in='11:00'),
                          many=True).data[0]['time_out'],'11:00') # check wrong
         self.assertEqual(len(Schedule.objects.filter(day=2)),0) # check mistake
+
+class EventsTest(TestCase):
+    '''
+    Live events of appointments
+    '''
+
+    def test_broadcaster_filter(self):
+        from .events import Broadcaster
+        broadcaster = Broadcaster()
+
+        async def listen():
+            subscription = broadcaster.subscribe(workers=[1], days=['2022-06-20'])
+            broadcaster.publish({'type': 'created', 'worker': 2, 'place': 1, 'day': '2022-06-20'})
+            broadcaster.publish({'type': 'created', 'worker': 1, 'place': 1, 'day': '2022-06-20'})
+            event = await asyncio.wait_for(subscription.queue.get(), 1)
+            broadcaster.unsubscribe(subscription)
+            return event, subscription.queue.qsize()
+
+        event, left = asyncio.run(listen())
+        self.assertEqual(event['worker'], 1)
+        self.assertEqual(left, 0) # event of another worker is skipped
+        self.assertEqual(broadcaster.listeners(), 0)
+
+    def test_appointment_signals(self):
+        from .events import broadcaster
+        published = []
+        broadcaster_publish = broadcaster.publish
+        broadcaster.publish = published.append
+        try:
+            worker = Worker.objects.create(name='test worker', speciality='test dantist')
+            place = Location.objects.create(name='test place', room=2)
+            with self.captureOnCommitCallbacks(execute=True):
+                appointment = Appointments.objects.create(number=1, worker=worker, place=place,
+                                        day=datetime.date(2022,6,20), time_in='12:00',
+                                        time_out='14:00', title='test_app')
+            with self.captureOnCommitCallbacks(execute=True):
+                appointment.delete()
+        finally:
+            broadcaster.publish = broadcaster_publish
+        self.assertEqual([x['type'] for x in published], ['created', 'cancelled'])
+        self.assertEqual(published[0]['worker'], worker.pk)
+
+    def test_schedule_signals(self):
+        from .events import broadcaster
+        published = []
+        broadcaster_publish = broadcaster.publish
+        broadcaster.publish = published.append
+        try:
+            worker = Worker.objects.create(name='test worker', speciality='test dantist')
+            with self.captureOnCommitCallbacks(execute=True):
+                schedule = Schedule.objects.create(worker=worker, day=1, time_in='09:00', time_out='12:00')
+            with self.captureOnCommitCallbacks(execute=True):
+                schedule.delete()
+        finally:
+            broadcaster.publish = broadcaster_publish
+        self.assertEqual([(x['type'], x['kind']) for x in published], [('schedule', 'updated'), ('schedule', 'deleted')])
+        self.assertEqual((published[0]['worker'], published[0]['weekday']), (worker.pk, 1))
+
+    def test_sse_stream(self):
+        from .sse import sse_application, parse_filter
+        from .events import broadcaster
+        self.assertEqual(parse_filter(b'worker=1,2&day=2022-06-20'),
+                         {'workers': [1, 2], 'places': [], 'days': ['2022-06-20']})
+        sent = []
+
+        async def stream():
+            messages = asyncio.Queue()
+            await messages.put({'type': 'http.request', 'body': b''})
+
+            async def send(message):
+                sent.append(message)
+                if len(sent) == 2: # headers and greeting are sent
+                    broadcaster.publish({'type': 'created', 'worker': 1, 'day': '2022-06-20'})
+                elif len(sent) == 3:
+                    await messages.put({'type': 'http.disconnect'})
+
+            scope = {'type': 'http', 'method': 'GET', 'query_string': b'worker=1'}
+            await asyncio.wait_for(sse_application(scope, messages.get, send), 2)
+
+        asyncio.run(stream())
+        self.assertEqual(sent[0]['status'], 200)
+        self.assertIn(b'event: created', sent[2]['body'])
+        self.assertEqual(broadcaster.listeners(), 0)
+
+class TableTest(TestCase):
+    '''
+    Paginated and sorted html tables
+    '''
+
+    def test_pagination(self):
+        for i in range(30):
+            Worker.objects.create(name='worker %02d' % i, speciality='test dantist')
+        resp = self.client.get(reverse('html_workers'))
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn('worker 00', resp.content.decode())
+        self.assertNotIn('worker 29', resp.content.decode())
+
+        resp = self.client.get(reverse('html_workers'), {'page': 2})
+        self.assertIn('worker 29', resp.content.decode())
+
+        resp = self.client.get(reverse('html_workers'), {'sort': '-name'})
+        self.assertIn('worker 29', resp.content.decode())
+        self.assertNotIn('worker 00', resp.content.decode())
+
+    def test_schedule_ordering(self):
+        worker = Worker.objects.create(name='test worker', speciality='test dantist')
+        Schedule.objects.create(worker=worker, day=2, time_in='08:00', time_out='09:00')
+        Schedule.objects.create(worker=worker, day=1, time_in='10:00', time_out='11:00')
+        resp = self.client.get(reverse('html_schedule'))
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual([row.record.day for row in resp.context['data'].page.object_list], [1, 2])
+
+class SpecialityTest(TestCase):
+    '''
+    Specialities of workers in the separate table
+    '''
+
+    def test_speciality(self):
+        first = Worker.objects.create(name='first', speciality='test dantist')
+        second = Worker.objects.create(name='second', speciality='test dantist')
+        Worker.objects.create(name='third', speciality='test surgeon')
+        self.assertEqual(Speciality.objects.count(), 2)
+        self.assertEqual(first.speciality_id, second.speciality_id)
+        self.assertEqual(WorkerSerializer(first).data['speciality'], 'test dantist')
+
+        Schedule.objects.create(worker=first, day=1, time_in='08:00', time_out='09:00')
+        Schedule.objects.create(worker=Worker.objects.get(name='third'), day=1, 
+                                time_in='10:00', time_out='11:00')
+        resp = self.client.get(reverse('html_schedule'), {'worker__speciality': 'test surgeon'})
+        self.assertEqual([row.record.worker.name for row in resp.context['data'].page.object_list], 
+                         ['third'])
+
+    def test_validation(self):
+        # a new speciality is created only when the worker is saved
+        form = WorkerForm(data={'name': '', 'speciality': 'test surgeon'})
+        self.assertFalse(form.is_valid())
+        serializer = WorkerSerializer(data={'name': '', 'speciality': 'test surgeon'})
+        self.assertFalse(serializer.is_valid())
+        self.assertFalse(Speciality.objects.exists())
+
+        form = WorkerForm(data={'name': 'first', 'speciality': 'test surgeon'})
+        self.assertTrue(form.is_valid())
+        self.assertFalse(Speciality.objects.exists())
+        self.assertEqual(form.save().speciality.name, 'test surgeon')
+        serializer = WorkerSerializer(data={'name': 'second', 'speciality': 'test surgeon'})
+        self.assertTrue(serializer.is_valid())
+        self.assertEqual(serializer.save().speciality_id, Worker.objects.get(name='first').speciality_id)
+        self.assertEqual(Speciality.objects.count(), 1)
+
+class SpecialityCacheTest(TransactionTestCase):
+    '''
+    Cached list of specialities
+    '''
+
+    def test_cache(self):
+        cache.delete(speciality_cache_key('default'))
+        Worker.objects.create(name='first', speciality='test dantist')
+        self.assertIn('test dantist', Speciality.objects.cached_map())
+        with self.assertNumQueries(0):
+            self.assertIsNotNone(Speciality.objects.id_for_name('test dantist'))
+        Speciality.objects.create(name='test surgeon') # invalidates the cache
+        self.assertIn('test surgeon', Speciality.objects.cached_map())
+
+class SearchTest(TestCase):
+    '''
+    Search of workers
+    '''
+
+    def setUp(self):
+        Worker.objects.create(name='Ivan Petrov', speciality='dantist')
+        Worker.objects.create(name='Petr Ivanov', speciality='surgeon')
+        Worker.objects.create(name='Anna Smirnova', speciality='dantist surgeon')
+
+    def test_fts_search(self):
+        self.assertTrue(fts_available('default'))
+        resp = self.client.get(reverse('api_search_workers'), {'q': 'iva'})
+        self.assertEqual(sorted(x['name'] for x in resp.json()), ['Ivan Petrov', 'Petr Ivanov'])
+        resp = self.client.get(reverse('api_search_workers'), {'q': 'pet dant'})
+        self.assertEqual([x['name'] for x in resp.json()], ['Ivan Petrov'])
+        resp = self.client.get(reverse('api_search_workers'), {'q': 'surg'})
+        self.assertEqual(resp.json()[0]['name'], 'Petr Ivanov') # single speciality ranks first
+
+        Worker.objects.get(name='Ivan Petrov').delete()
+        resp = self.client.get(reverse('api_search_workers'), {'q': 'iva'})
+        self.assertEqual([x['name'] for x in resp.json()], ['Petr Ivanov'])
+
+    def test_trigram_search(self):
+        index = TrigramIndex('default')
+        self.assertEqual(index.search('smi dan'), [Worker.objects.get(name='Anna Smirnova').pk])
+        self.assertEqual(index.search('vanov'), []) # only beginnings of words
+        worker = Worker.objects.get(name='Ivan Petrov')
+        index.update(worker.pk, 'Ivan Sidorov', 'dantist')
+        self.assertEqual(index.search('sid'), [worker.pk])
+        self.assertEqual(len(index.search('i')), 2) # too short for trigrams
+
+@override_settings(SCHED_FACILITIES={'north': {'DATABASE': 'default', 'TOKEN': 'north-token'}})
+class TenancyTest(TestCase):
+    '''
+    Facilities with their own databases
+    '''
+
+    def test_router(self):
+        router = FacilityRouter()
+        self.assertIsNone(router.db_for_read(Worker))
+        with use_facility('north'):
+            self.assertEqual(router.db_for_write(Worker), 'default')
+            self.assertEqual(get_current_facility(), 'north')
+        self.assertIsNone(get_current_facility())
+        with self.assertRaises(Http404):
+            set_current_facility('south')
+
+    def test_facility_requests(self):
+        Worker.objects.create(name='test worker', speciality='test dantist')
+        resp = self.client.get('/f/north/workers')
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn('test worker', resp.content.decode())
+        self.assertIn('href="/f/north/schedule"', resp.content.decode()) # links keep facility
+        self.assertEqual(self.client.get('/f/south/workers').status_code, 404)
+
+        resp = self.client.get(reverse('api_workers'), HTTP_X_FACILITY_TOKEN='north-token')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(self.client.get(reverse('api_workers'), 
+                         HTTP_X_FACILITY_TOKEN='wrong').status_code, 404)
+        self.assertIsNone(get_current_facility())
+
+@override_settings(SCHED_FACILITIES={'north': {'DATABASE': 'facility'}})
+class FacilityDatabaseTest(TransactionTestCase):
+    '''
+    Data of a facility in its own database (second test database, see Sched/test_runner.py)
+    '''
+    databases = {'default', 'facility'}
+
+    def setUp(self):
+        # the rows of the previous test are flushed, the cached ids of them are stale
+        cache.clear()
+        refcache.forget('facility')
+
+    def test_migrate_facilities(self):
+        # a facility database with workers from before the Speciality table
+        call_command('migrate', 'sched_api', '0002', database='facility', verbosity=0)
+        with connections['facility'].cursor() as cursor:
+            cursor.execute("INSERT INTO sched_api_worker (name, speciality) VALUES ('north worker', 'surgeon')")
+        call_command('migrate_facilities', verbosity=0, stdout=StringIO())
+
+        with use_facility('north'):
+            worker = Worker.objects.select_related('speciality').get()
+        self.assertEqual(worker.speciality.name, 'surgeon')
+        self.assertFalse(Worker.objects.exists())
+        for alias, rows in (('facility', [(worker.pk, 'north worker')]), ('default', [])):
+            with connections[alias].cursor() as cursor:
+                cursor.execute('SELECT rowid, name FROM sched_api_worker_fts')
+                self.assertEqual(cursor.fetchall(), rows)
+
+    def monday(self):
+        today = timezone.localdate()
+        return today + datetime.timedelta(days=7 - today.weekday())
+
+    def test_materialize_series(self):
+        with use_facility('north'):
+            worker = Worker.objects.create(name='north worker', speciality='test dantist')
+            place = Location.objects.create(name='north place', room=2)
+            Schedule.objects.create(worker=worker, day=1, time_in='09:00', time_out='12:00')
+            AppointmentSeries.objects.create(worker=worker, place=place, first_day=self.monday(), count=2,
+                                             time_in='09:00', time_out='10:00', title='therapy')
+        out = StringIO()
+        call_command('materialize_series', stdout=out)
+        self.assertIn('Facility north: Series: 1, appointments created: 2', out.getvalue())
+        with use_facility('north'):
+            self.assertEqual(AppointmentRow.objects.filter(title='therapy').count(), 2)
+        self.assertFalse(Appointments.objects.exists())
+        with self.assertRaisesMessage(CommandError, 'south'):
+            call_command('materialize_series', facility='south')
+
+    def test_reconcile(self):
+        with use_facility('north'):
+            worker = Worker.objects.create(name='north worker', speciality='test dantist')
+            colleague = Worker.objects.create(name='north colleague', speciality='test dantist')
+            place = Location.objects.create(name='north place', room=2)
+            Schedule.objects.create(worker=colleague, day=1, time_in='09:00', time_out='12:00')
+            Appointments.objects.create(number=1, worker=worker, place=place, day=self.monday(),
+                                        time_in='09:00', time_out='10:00', title='north_app')
+        out = StringIO()
+        call_command('reconcile_appointments', move=True, facility='north', stdout=out)
+        self.assertEqual(out.getvalue().strip(), 'Facility north: Outside working hours: 0, moved: 1')
+        with use_facility('north'):
+            self.assertEqual(Appointments.objects.get().worker_id, colleague.pk)
+            self.assertEqual(AppointmentRow.objects.get().worker_name, 'north colleague')
+
+    def test_solve_bookings(self):
+        with use_facility('north'):
+            worker = Worker.objects.create(name='north worker', speciality='nurse')
+            Location.objects.create(name='north place', room=2)
+            Schedule.objects.create(worker=worker, day=1, time_in='09:00', time_out='12:00')
+        requests = [{'speciality': 'nurse', 'day': str(self.monday()), 'time_from': '09:00', 
+                     'time_to': '10:00', 'duration': 20, 'title': 'vaccine %d' % i} for i in range(2)]
+        with tempfile.NamedTemporaryFile('w', suffix='.json') as file:
+            json.dump(requests, file)
+            file.flush()
+            out = StringIO()
+            call_command('solve_bookings', file.name, facility='north', stdout=out)
+        self.assertIn('Placed 2 of 2', out.getvalue())
+        with use_facility('north'):
+            self.assertEqual(AppointmentRow.objects.filter(worker_id=worker.pk).count(), 2)
+        self.assertFalse(Appointments.objects.exists())
+
+    @override_settings(SCHED_REMINDER_BACKEND='sched_api.reminders.StubBackend', SCHED_REMINDER_HOURS=(24,))
+    def test_send_reminders(self):
+        start = timezone.localtime(timezone.now() + datetime.timedelta(hours=24, minutes=-5))
+        with use_facility('north'):
+            user = Users.objects.create_user(username='north', password='secret', email='north@example.com')
+            worker = Worker.objects.create(name='north worker', speciality='test dantist')
+            place = Location.objects.create(name='north place', room=2)
+            Appointments.objects.create(number=1, worker=worker, place=place, day=start.date(), time_in=start.time(),
+                                        time_out=(start + datetime.timedelta(minutes=10)).time(),
+                                        title='north_app', creator=user)
+        StubBackend.outbox.clear()
+        out = StringIO()
+        call_command('send_reminders', once=True, stdout=out)
+        self.assertIn('Reminders sent: 1', out.getvalue())
+        self.assertEqual([x.email for x in StubBackend.outbox], ['north@example.com'])
+        with use_facility('north'):
+            self.assertTrue(SentReminder.objects.filter(sent_at__isnull=False).exists())
+
+@override_settings(SCHED_READ_REPLICAS={'default': 'replica'})
+class ReplicaTest(TestCase):
+    '''
+    Reads of read only views from the replica
+    '''
+
+    def test_router(self):
+        router = ReplicaRouter()
+        self.assertIsNone(router.db_for_read(AppointmentRow))
+        with use_replica():
+            self.assertEqual(router.db_for_read(AppointmentRow), 'replica')
+            self.assertIsNone(router.db_for_read(Worker)) # reference data has its caches
+        self.assertFalse(router.allow_migrate('replica', 'sched_api'))
+        worker, place = Worker(name='first'), Location(name='test place')
+        worker._state.db, place._state.db = 'default', 'replica'
+        self.assertTrue(router.allow_relation(worker, place))
+
+    def test_pragmas(self):
+        connection = sqlite3.connect(':memory:')
+        apply_pragmas(connection, {'busy_timeout': 1234, 'cache_size': -1000})
+        self.assertEqual(connection.execute('PRAGMA busy_timeout').fetchone()[0], 1234)
+
+class AvailabilityTest(TestCase):
+    '''
+    Weekly schedule merged with closures and extra shifts
+    '''
+
+    def setUp(self):
+        self.worker = Worker.objects.create(name='test worker', speciality='test dantist')
+        self.place = Location.objects.create(name='test place', room=2)
+        Schedule.objects.create(worker=self.worker, day=1, time_in='09:00', time_out='18:00')
+        self.monday = datetime.date(2022,6,20)
+
+    def test_intervals(self):
+        t = datetime.time
+        self.assertEqual(merge([(t(12), t(14)), (t(9), t(10)), (t(10), t(11))]), 
+                         [(t(9), t(11)), (t(12), t(14))])
+        self.assertEqual(subtract([(t(9), t(18))], [(t(12), t(13)), (t(17), t(19))]), 
+                         [(t(9), t(12)), (t(13), t(17))])
+
+    def test_exceptions(self):
+        ScheduleException.objects.create(worker=self.worker, day=self.monday, 
+                                         time_in='12:00', time_out='13:00')
+        ScheduleException.objects.create(kind=ScheduleException.EXTRA, worker=self.worker, 
+                                         day=self.monday + datetime.timedelta(days=1), 
+                                         time_in='10:00', time_out='12:00')
+        ScheduleException.objects.create(day=self.monday + datetime.timedelta(days=7)) # holiday
+        with self.assertNumQueries(2):
+            availability = Availability([self.worker.pk], self.monday, 
+                                        self.monday + datetime.timedelta(days=13))
+            hours = availability.all_hours()
+        self.assertEqual(hours[(self.worker.pk, self.monday)], 
+                         [(datetime.time(9), datetime.time(12)), (datetime.time(13), datetime.time(18))])
+        self.assertEqual(len(hours[(self.worker.pk, self.monday + datetime.timedelta(days=1))]), 1)
+        self.assertEqual(hours[(self.worker.pk, self.monday + datetime.timedelta(days=7))], [])
+
+        user = Users.objects.create(username='test', is_admin=True)
+
+        def appointment(day, time_in, time_out):
+            return Appointments(number=1, worker=self.worker, place=self.place, day=day, 
+                                time_in=time_in, time_out=time_out, title='test_app', creator=user)
+
+        appointment(self.monday, '11:00', '12:00').clean()
+        appointment(self.monday + datetime.timedelta(days=1), '10:00', '11:00').clean()
+        with self.assertRaises(ValidationError):
+            appointment(self.monday, '12:30', '13:30').clean()
+        with self.assertRaises(ValidationError):
+            appointment(self.monday + datetime.timedelta(days=7), '10:00', '11:00').clean()
+
+        ScheduleException.objects.create(place=self.place, day=self.monday + datetime.timedelta(days=14))
+        with self.assertRaises(ValidationError):
+            appointment(self.monday + datetime.timedelta(days=14), '10:00', '11:00').clean()
+
+    def test_availability_view(self):
+        Appointments.objects.create(number=1, worker=self.worker, place=self.place, day=self.monday,
+                                    time_in='10:00', time_out='11:00', title='test_app')
+        resp = self.client.get(reverse('api_availability'), {'worker': self.worker.pk, 
+                               'date_from': '2022-06-20', 'date_to': '2022-06-21'})
+        self.assertEqual(resp.json()[0]['free'], [['09:00:00', '10:00:00'], ['11:00:00', '18:00:00']])
+        self.assertEqual(resp.json()[1]['free'], [])
+
+class WaitlistTest(TestCase):
+    '''
+    Booking of the waitlist into freed time
+    '''
+
+    def setUp(self):
+        self.worker = Worker.objects.create(name='test worker', speciality='test dantist')
+        self.place = Location.objects.create(name='test place', room=2)
+        self.user = Users.objects.create(username='test', is_admin=True)
+        Schedule.objects.create(worker=self.worker, day=1, time_in='09:00', time_out='12:00')
+        today = datetime.date.today()
+        self.monday = today + datetime.timedelta(days=7 - today.weekday())
+        self.appointment = Appointments.objects.create(number=1, worker=self.worker, place=self.place,
+                                day=self.monday, time_in='09:00', time_out='12:00', title='test_app',
+                                creator=self.user)
+
+    def request(self, **kwargs):
+        data = dict(speciality=self.worker.speciality, day_from=self.monday, day_to=self.monday,
+                    time_from=datetime.time(9), time_to=datetime.time(12), duration=60, 
+                    title='waiting', creator=self.user)
+        data.update(kwargs)
+        return WaitlistRequest.objects.create(**data)
+
+    def test_backfill_on_cancel(self):
+        first = self.request(duration=90)
+        second = self.request(worker=self.worker, speciality=None, time_from=datetime.time(11))
+        late = self.request(time_from=datetime.time(13), time_to=datetime.time(15))
+        with self.captureOnCommitCallbacks(execute=True):
+            self.appointment.delete()
+
+        first.refresh_from_db()
+        second.refresh_from_db()
+        late.refresh_from_db()
+        self.assertEqual(first.status, WaitlistRequest.BOOKED)
+        self.assertEqual((first.appointment.time_in, first.appointment.time_out), 
+                         (datetime.time(9), datetime.time(10, 30)))
+        self.assertEqual(second.status, WaitlistRequest.BOOKED)
+        self.assertEqual(second.appointment.time_in, datetime.time(11))
+        self.assertEqual(late.status, WaitlistRequest.WAITING)
+
+    def test_backfill_on_schedule(self):
+        waiting = self.request(day_to=self.monday + datetime.timedelta(days=1), 
+                               time_from=datetime.time(13), time_to=datetime.time(15))
+        with self.captureOnCommitCallbacks(execute=True):
+            Schedule.objects.create(worker=self.worker, day=2, time_in='13:00', time_out='14:00')
+        waiting.refresh_from_db()
+        self.assertEqual(waiting.status, WaitlistRequest.BOOKED)
+        self.assertEqual(waiting.appointment.day, self.monday + datetime.timedelta(days=1))
+        self.assertEqual(waiting.appointment.place, self.place)
+
+    def test_new_worker(self):
+        # no appointments yet, the booking is made in the room of the shift
+        worker = Worker.objects.create(name='new worker', speciality='test dantist')
+        room = Location.objects.create(name='new room', room=3)
+        waiting = self.request(day_to=self.monday + datetime.timedelta(days=1), 
+                               time_from=datetime.time(13), time_to=datetime.time(15))
+        with self.captureOnCommitCallbacks(execute=True):
+            Schedule.objects.create(worker=worker, place=room, day=2, time_in='13:00', time_out='14:00')
+        waiting.refresh_from_db()
+        self.assertEqual(waiting.status, WaitlistRequest.BOOKED)
+        self.assertEqual((waiting.appointment.worker, waiting.appointment.place), (worker, room))
+
+    def test_first_fit(self):
+        Appointments.objects.filter(pk=self.appointment.pk).update(time_out='10:00')
+        waiting = self.request()
+        # the first interval is taken meanwhile, the next one is booked
+        free = {(self.worker.pk, self.monday): [(datetime.time(9), datetime.time(10)), 
+                                                (datetime.time(10), datetime.time(12))]}
+        appointment = first_fit(waiting, free, self.worker.pk, self.place.pk, self.monday, self.monday)
+        self.assertEqual(appointment.time_in, datetime.time(10))
+        with self.assertRaisesMessage(ValidationError, 'longer than'):
+            WaitlistRequest(speciality=self.worker.speciality, day_from=self.monday, 
+                            day_to=self.monday + datetime.timedelta(days=100), time_from=datetime.time(9),
+                            time_to=datetime.time(12), duration=60, title='long', creator=self.user).clean()
+
+class SolverTest(TestCase):
+    '''
+    Batch assignment of booking requests
+    '''
+
+    def setUp(self):
+        self.first = Worker.objects.create(name='first', speciality='nurse')
+        self.second = Worker.objects.create(name='second', speciality='nurse')
+        self.place = Location.objects.create(name='first room', room=1)
+        self.other_place = Location.objects.create(name='second room', room=2)
+        for worker in (self.first, self.second):
+            Schedule.objects.create(worker=worker, day=1, time_in='09:00', time_out='10:00')
+        self.monday = datetime.date(2022,6,20)
+        Appointments.objects.create(number=1, worker=self.first, place=self.place, day=self.monday,
+                                    time_in='09:00', time_out='09:20', title='existing')
+
+    def test_solver(self):
+        requests = [{'speciality': 'nurse', 'day': '2022-06-20', 'time_from': '09:00', 
+                     'time_to': '10:00', 'duration': 20, 'title': 'vaccine %d' % i} for i in range(6)]
+        solver = Solver(requests)
+        self.assertEqual(solver.solve(), 5) # 3 hours of workers minus the existing appointment
+        self.assertEqual(solver.report()['unplaced'], [5])
+        solver.save()
+
+        appointments = list(Appointments.objects.filter(day=self.monday))
+        self.assertEqual(len(appointments), 6)
+        self.assertEqual(AppointmentRow.objects.filter(day=self.monday).count(), 6)
+        for appointment in appointments: # saved appointments do not overlap
+            for other in appointments:
+                if other.pk == appointment.pk: continue
+                crossing = other.time_in < appointment.time_out and appointment.time_in < other.time_out
+                self.assertFalse(crossing and other.worker_id == appointment.worker_id)
+                self.assertFalse(crossing and other.place_id == appointment.place_id)
+
+    def test_occupancy(self):
+        user = Users.objects.create_user(username='test', password='secret', is_admin=True)
+        Schedule.objects.filter(worker=self.second).update(place=self.place) # room of the shift
+        request = {'worker': self.first.pk, 'day': '2022-06-20', 'time_from': '09:20', 
+                   'time_to': '10:00', 'duration': 20, 'title': 'vaccine'}
+        solver = Solver([request])
+        self.assertEqual(solver.solve(), 1)
+        self.assertEqual(solver.placed[0][2:], (self.other_place.pk, 9 * 60 + 20, 9 * 60 + 40))
+
+        # held meanwhile by another desk
+        place_hold(self.first, self.other_place, self.monday, datetime.time(9, 20), datetime.time(9, 40), user)
+        self.assertEqual(solver.save(), [])
+        self.assertEqual(solver.report()['rejected'], [{'index': 0, 'reason': 'The time is held by another booking'}])
+
+        AppointmentSeries.objects.create(worker=self.first, place=self.other_place, first_day=self.monday, 
+                                         time_in='09:40', time_out='10:00', count=2, title='series')
+        self.assertEqual(Solver([request]).solve(), 0) # held and in the series
+
+    def test_solver_view(self):
+        user = Users.objects.create_user(username='test', password='secret', is_admin=True)
+        self.client.force_login(user)
+        data = {'dry_run': True, 'requests': [{'worker': self.first.pk, 'day': '2022-06-20', 
+                'time_from': '09:00', 'time_to': '09:40', 'duration': 20, 'title': 'vaccine'}]}
+        resp = self.client.post(reverse('api_admin_solver'), data, content_type='application/json')
+        self.assertEqual(resp.json()['placed'], 1)
+        self.assertEqual(Appointments.objects.count(), 1) # dry run
+
+class ReconcileTest(TestCase):
+    '''
+    Appointments left outside working hours
+    '''
+
+    def setUp(self):
+        self.worker = Worker.objects.create(name='first', speciality='test dantist')
+        self.colleague = Worker.objects.create(name='second', speciality='test dantist')
+        self.place = Location.objects.create(name='test place', room=2)
+        self.schedule = Schedule.objects.create(worker=self.worker, day=1, time_in='09:00', time_out='12:00')
+        Schedule.objects.create(worker=self.worker, day=1, time_in='12:00', time_out='15:00')
+        Schedule.objects.create(worker=self.colleague, day=1, time_in='09:00', time_out='11:00')
+        today = datetime.date.today()
+        self.monday = today + datetime.timedelta(days=7 - today.weekday())
+        self.early = Appointments.objects.create(number=1, worker=self.worker, place=self.place,
+                                day=self.monday, time_in='09:00', time_out='10:00', title='early')
+        self.noon = Appointments.objects.create(number=2, worker=self.worker, place=self.place,
+                                day=self.monday, time_in='11:30', time_out='12:30', title='noon')
+
+    def test_reconcile(self):
+        self.assertEqual(find_orphans(), []) # touching segments cover the noon appointment
+        with self.captureOnCommitCallbacks(execute=True):
+            self.schedule.delete()
+        self.early.refresh_from_db()
+        self.noon.refresh_from_db()
+        self.assertTrue(self.early.orphaned)
+        self.assertTrue(self.noon.orphaned)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Schedule.objects.create(worker=self.worker, day=1, time_in='09:00', time_out='12:00')
+        self.assertFalse(Appointments.objects.filter(orphaned=True).exists())
+
+    def test_move(self):
+        ScheduleException.objects.create(worker=self.worker, day=self.monday)
+        self.assertEqual(reconcile(move=True), (1, 1))
+        self.early.refresh_from_db()
+        self.assertEqual(self.early.worker, self.colleague)
+        self.assertEqual(AppointmentRow.objects.get(pk=self.early.pk).worker_name, 'second')
+        self.assertTrue(AppointmentRow.objects.get(pk=self.noon.pk).orphaned)
+        self.assertTrue(Appointments.objects.get(pk=self.noon.pk).orphaned) # colleague is busy
+
+    def test_checks(self):
+        other = Location.objects.create(name='other place', room=3)
+        ScheduleException.objects.create(place=other, day=self.monday)
+        self.noon.place = other
+        self.noon.save()
+        self.assertEqual(find_orphans(), [self.noon]) # the place is closed
+
+        ScheduleException.objects.create(worker=self.worker, day=self.monday)
+        SlotHold.objects.create(token='abc', worker=self.colleague, place=self.place, day=self.monday,
+                                time_in='09:30', time_out='10:30', expires_at=timezone.now() + datetime.timedelta(minutes=5))
+        self.assertEqual(reconcile(move=True), (2, 0)) # the colleague's time is held
+        SlotHold.objects.all().delete()
+        Schedule.objects.create(worker=Worker.objects.create(name='third', speciality='test surgeon'), place=self.place,
+                                day=1, time_in='08:00', time_out='11:00')
+        self.assertEqual(reconcile(move=True), (2, 0)) # the place is the room of another shift
+        self.assertEqual(Appointments.objects.get(pk=self.early.pk).worker, self.worker)
+
+class IdempotencyTest(TestCase):
+    '''
+    Retries of write requests with the Idempotency-Key header
+    '''
+
+    def test_replay(self):
+        user = Users.objects.create_user(username='test', password='secret', is_serviceman=True)
+        self.client.force_login(user)
+        url = reverse('api_admin_location')
+        data = {'name': 'test place', 'room': 2}
+        first = self.client.post(url, data, HTTP_IDEMPOTENCY_KEY='abc')
+        second = self.client.post(url, data, HTTP_IDEMPOTENCY_KEY='abc')
+        self.assertEqual(Location.objects.count(), 1)
+        self.assertEqual(first.content, second.content)
+        self.assertEqual(second['Idempotent-Replayed'], 'true')
+
+        self.client.post(url, {'name': 'other place', 'room': 3}, HTTP_IDEMPOTENCY_KEY='def')
+        self.assertEqual(Location.objects.count(), 2)
+        IdempotencyRecord.objects.update(expires_at=timezone.now()) # expired keys are evicted
+        self.client.post(url, {'name': 'third place', 'room': 4}, HTTP_IDEMPOTENCY_KEY='ghi')
+        self.assertEqual(list(IdempotencyRecord.objects.values_list('key', flat=True)), ['ghi'])
+
+    def test_reservation(self):
+        user = Users.objects.create_user(username='test', password='secret', is_serviceman=True)
+        self.client.force_login(user)
+        url = reverse('api_admin_location')
+        data = {'name': 'test place', 'room': 2}
+        with mock.patch('sched_api.forms.LocationForm.save', side_effect=OperationalError('database is locked')):
+            self.assertIn('database is locked', self.client.post(url, data, HTTP_IDEMPOTENCY_KEY='abc').json()['error'])
+        self.assertFalse(IdempotencyRecord.objects.exists()) # errors are not replayed
+        self.client.post(url, data, HTTP_IDEMPOTENCY_KEY='abc')
+        self.assertEqual(Location.objects.count(), 1)
+        self.assertEqual(self.client.post(url, {'name': 'other place', 'room': 3}, 
+                                          HTTP_IDEMPOTENCY_KEY='abc').status_code, 422)
+
+        # the first request with the key is still running
+        IdempotencyRecord.objects.update(status=None, key='def')
+        self.assertEqual(self.client.post(url, data, HTTP_IDEMPOTENCY_KEY='def').status_code, 409)
+        self.assertEqual(Location.objects.count(), 1)
+
+    def test_csrf(self):
+        user = Users.objects.create_user(username='test', password='secret', is_serviceman=True)
+        client = Client(enforce_csrf_checks=True)
+        client.force_login(user)
+        url = reverse('api_admin_location')
+        client.get(url) # the form sets the csrf cookie
+        token = client.cookies['csrftoken'].value
+        self.assertEqual(client.post(url, {'name': 'test place', 'room': 2}, 
+                                     HTTP_IDEMPOTENCY_KEY='abc').status_code, 403) # no token
+        for i in range(2): # multipart body, then the retry
+            response = client.post(url, {'name': 'test place', 'room': 2},
+                                   HTTP_IDEMPOTENCY_KEY='abc', HTTP_X_CSRFTOKEN=token)
+            self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Idempotent-Replayed'], 'true')
+        response = client.post(url, 'name=other+place&room=3', content_type='application/x-www-form-urlencoded',
+                               HTTP_IDEMPOTENCY_KEY='def', HTTP_X_CSRFTOKEN=token)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(Location.objects.count(), 2)
+
+class MetricsTest(TestCase):
+    '''
+    Metrics of requests and bookings
+    '''
+
+    def test_metrics(self):
+        self.client.get(reverse('html_workers'))
+        appointment = Appointments(number=1, worker=Worker.objects.create(name='first', speciality='test dantist'),
+                                   place=Location.objects.create(name='test place', room=2),
+                                   day=datetime.date(2022, 6, 20), time_in='09:00', time_out='10:00',
+                                   title='test_app', creator=Users.objects.create_user(username='test', password='secret'))
+        with self.assertRaisesMessage(ValidationError, 'working hours'):
+            appointment.clean()
+
+        text = self.client.get(reverse('metrics')).content.decode()
+        self.assertIn('sched_requests_total{status="200",view="html_workers"}', text)
+        self.assertIn('sched_request_queries_count{view="html_workers"}', text)
+        self.assertIn('sched_booking_rejections_total{reason="no_working_hours"}', text)
+        self.assertIn('sched_request_seconds_bucket{view="html_workers",le="+Inf"}', text)
+
+    def test_histogram(self):
+        metrics.observe('sched_request_seconds', 0.003, view='test_histogram')
+        metrics.observe('sched_request_seconds', 0.03, view='test_histogram')
+        metrics.observe('sched_request_seconds', 30, view='test_histogram')
+        text = metrics.render()
+        for bound, count in (('0.005', 1), ('0.01', 1), ('0.025', 1), ('0.05', 2), ('10', 2), ('+Inf', 3)):
+            self.assertIn('sched_request_seconds_bucket{view="test_histogram",le="%s"} %d\n' % (bound, count), text)
+        self.assertIn('sched_request_seconds_count{view="test_histogram"} 3\n', text)
+
+    def test_multiprocess(self):
+        with tempfile.TemporaryDirectory() as directory, override_settings(SCHED_METRICS_DIR=directory):
+            with open(os.path.join(directory, '1.json'), 'w') as file:
+                json.dump([['sched_cache_requests_total', [['cache', 'test'], ['result', 'hit']], 3]], file)
+            metrics.cache_lookup('test', True)
+            self.assertIn('sched_cache_requests_total{cache="test",result="hit"} 4', metrics.render())
+
+    def test_finished_threads(self):
+        shards = len(metrics._shards)
+        threads = [threading.Thread(target=metrics.cache_lookup, args=('test_threads', True)) for i in range(20)]
+        for thread in threads: thread.start()
+        for thread in threads: thread.join()
+        self.assertIn('sched_cache_requests_total{cache="test_threads",result="hit"} 20', metrics.render())
+        self.assertLessEqual(len(metrics._shards), shards) # shards of the finished threads are dropped
+
+    def test_dead_process(self):
+        with tempfile.TemporaryDirectory() as directory, override_settings(SCHED_METRICS_DIR=directory):
+            for pid in ('99999998', '99999999'): # no such processes
+                with open(os.path.join(directory, pid + '.json'), 'w') as file:
+                    json.dump([['sched_cache_requests_total', [['cache', 'test_dead'], ['result', 'hit']], 3]], file)
+            for i in range(2): # the files are added to retired.json once
+                self.assertIn('sched_cache_requests_total{cache="test_dead",result="hit"} 6', metrics.render())
+            self.assertEqual(sorted(x for x in os.listdir(directory) if x.endswith('.json')), ['retired.json'])
+
+class ProfilingTest(TestCase):
+    '''
+    Profiling of requests and the slow query log
+    '''
+
+    def test_profile(self):
+        with tempfile.TemporaryDirectory() as directory:
+            with override_settings(SCHED_PROFILE_DIR=directory, SCHED_PROFILE_TOKEN='secret', 
+                                   SCHED_PROFILE_KEEP=1):
+                self.client.get(reverse('html_workers'), HTTP_X_PROFILE='secret')
+                self.client.get(reverse('html_schedule'), HTTP_X_PROFILE='wrong')
+                self.client.get(reverse('html_schedule'), HTTP_X_PROFILE='secret')
+            names = sorted(os.listdir(directory))
+            self.assertEqual(len(names), 2) # only the last request is kept
+            self.assertTrue(names[0].endswith('html_schedule.prof'))
+            pstats.Stats(os.path.join(directory, names[0]))
+            with open(os.path.join(directory, names[1])) as file:
+                self.assertIn('SELECT', file.read())
+
+    def test_slow_query(self):
+        with override_settings(SCHED_SLOW_QUERY_MS=0), self.assertLogs('sched_api.slow_queries') as logs:
+            self.client.get(reverse('html_workers'))
+        self.assertIn('html_workers at sched_api/', logs.output[0])
+
+@override_settings(ROOT_URLCONF='Sched.urls_api')
+class ApiProfileTest(TestCase):
+    '''
+    URLs of API-only workers
+    '''
+
+    def test_urls(self):
+        self.assertEqual(self.client.get('/api/workers').status_code, 200)
+        self.assertEqual(self.client.get('/metrics').status_code, 200)
+        self.assertEqual(self.client.get('/workers').status_code, 404) # html pages are not served
+
+class SnapshotTest(TestCase):
+    '''
+    Shared memory-mapped snapshot of weekly schedules
+    '''
+
+    def test_snapshot(self):
+        first = Worker.objects.create(name='first', speciality='test dantist')
+        second = Worker.objects.create(name='second', speciality='test dantist')
+        with tempfile.TemporaryDirectory() as directory, override_settings(SCHED_SNAPSHOT_DIR=directory):
+            with self.captureOnCommitCallbacks(execute=True):
+                Schedule.objects.create(worker=second, day=3, time_in='14:00', time_out='18:30')
+                Schedule.objects.create(worker=second, day=3, time_in='09:00', time_out='12:00')
+                removed = Schedule.objects.create(worker=first, day=1, time_in='08:00', time_out='10:00')
+            snapshot = get_snapshot()
+            self.assertEqual(snapshot.segments_of(second.pk, 3), [(datetime.time(9), datetime.time(12)),
+                                                                  (datetime.time(14), datetime.time(18, 30))])
+            self.assertEqual(snapshot.segments_of(first.pk, 1), [(datetime.time(8), datetime.time(10))])
+            self.assertEqual(snapshot.segments_of(first.pk, 2), [])
+
+            with self.captureOnCommitCallbacks(execute=True):
+                removed.delete()
+            wednesday = datetime.date(2022, 6, 22)
+            with self.assertNumQueries(1): # only the exceptions are read from the database
+                availability = Availability([first.pk, second.pk], wednesday - datetime.timedelta(days=2), wednesday)
+            self.assertEqual(availability.hours(first.pk, wednesday - datetime.timedelta(days=2)), [])
+            self.assertEqual(len(availability.hours(second.pk, wednesday)), 2)
+
+class BatchTest(TestCase):
+    '''
+    Schedules and appointments of many workers in one request
+    '''
+
+    def test_batch(self):
+        first = Worker.objects.create(name='first', speciality='test dantist')
+        second = Worker.objects.create(name='second', speciality='test dantist')
+        place = Location.objects.create(name='test place', room=2)
+        Schedule.objects.create(worker=first, day=1, time_in='09:00', time_out='12:00')
+        Schedule.objects.create(worker=second, day=2, time_in='10:00', time_out='11:00')
+        Appointments.objects.create(number=1, worker=first, place=place, day=datetime.date(2022, 6, 20),
+                                    time_in='09:00', time_out='10:00', title='test_app')
+        ScheduleException.objects.create(worker=first, day=datetime.date(2022, 6, 20), time_in='11:00', time_out='12:00')
+        ScheduleException.objects.create(worker=first, day=datetime.date(2022, 6, 21), kind=ScheduleException.EXTRA,
+                                         time_in='14:00', time_out='15:00')
+        with self.assertNumQueries(4):
+            resp = self.client.get(reverse('api_batch'), {'worker': '%d,%d' % (first.pk, second.pk),
+                                                          'day': '2022-06-20,2022-06-21'})
+        data = resp.json()
+        self.assertEqual([x['name'] for x in data], ['first', 'second'])
+        self.assertEqual(data[0]['days'][0]['schedule'], [['09:00:00', '11:00:00']]) # closure
+        self.assertEqual(data[0]['days'][0]['appointments'][0]['title'], 'test_app')
+        self.assertEqual(data[0]['days'][1], {'day': '2022-06-21', 'schedule': [['14:00:00', '15:00:00']], 
+                                              'appointments': []}) # extra shift
+        self.assertEqual(data[1]['days'][1]['schedule'], [['10:00:00', '11:00:00']])
+
+class ListingTest(TestCase):
+    '''
+    Flat rows of appointments for the lists
+    '''
+
+    def test_rows(self):
+        user = Users.objects.create_user(username='test', password='secret', is_admin=True)
+        worker = Worker.objects.create(name='first', speciality='test dantist')
+        place = Location.objects.create(name='test place', room=2)
+        appointment = Appointments.objects.create(number=1, worker=worker, place=place, creator=user,
+                                    day=datetime.date(2022, 6, 20), time_in='09:00', time_out='10:00', title='test_app')
+        worker.name = 'renamed'
+        worker.save()
+        row = AppointmentRow.objects.get()
+        self.assertEqual((row.worker_name, row.place_name, row.creator_username), ('renamed', 'test place', 'test'))
+
+        with self.assertNumQueries(1): # one table, no joins
+            data = self.client.get(reverse('api_view_appointments')).json()
+        self.assertEqual(data[0]['worker'], 'renamed')
+        self.assertEqual(data[0]['id'], appointment.pk)
+        self.assertEqual(set(data[0]), set(AppointmentsSerializer(appointment).data)) # same fields
+        self.assertEqual(data[0]['creator'], 'test')
+
+        appointment.creator = None
+        appointment.save()
+        self.assertIsNone(AppointmentRowSerializer(AppointmentRow.objects.get()).data['creator'])
+        self.assertIsNone(self.client.get(reverse('api_view_appointments')).json()[0]['creator'])
+        appointment.delete()
+        self.assertFalse(AppointmentRow.objects.exists())
+
+class ReferenceCacheTest(TransactionTestCase):
+    '''
+    Process cache of workers, places and choices
+    '''
+
+    def test_cache(self):
+        worker = Worker.objects.create(name='first', speciality='test dantist')
+        self.assertEqual(refcache.choices(Worker), [(worker.pk, str(worker))])
+        field = ScheduleForm().fields['worker']
+        self.assertEqual(field.clean(str(worker.pk)), worker)
+        with self.assertNumQueries(0):
+            self.assertEqual(refcache.choices(Worker), [(worker.pk, str(worker))])
+            self.assertEqual(field.clean(str(worker.pk)), worker)
+            self.assertEqual(len(list(field.choices)), 2) # with the empty choice
+
+        worker.name = 'renamed' # invalidated on commit
+        worker.save()
+        self.assertEqual(refcache.instance(Worker, worker.pk).name, 'renamed')
+
+        refcache.choices(Worker)
+        cache.set(refcache.VERSION_KEY + 'default', 'other') # change in another process
+        refcache.sync()
+        with self.assertNumQueries(1):
+            refcache.choices(Worker)
+
+        # every request gets its own objects
+        refcache.instance(Worker, worker.pk).name = 'changed'
+        refcache.instance(Worker, worker.pk).speciality.name = 'changed'
+        with self.assertNumQueries(0):
+            cached = refcache.instance(Worker, worker.pk)
+        self.assertEqual((cached.name, cached.speciality.name), ('renamed', 'test dantist'))
+        refcache.workers()[0].name = 'changed'
+        self.assertEqual(refcache.workers()[0].name, 'renamed')
+
+class HoldTest(TestCase):
+    '''
+    Short holds of the time while booking
+    '''
+
+    def setUp(self):
+        self.user = Users.objects.create_user(username='test', password='secret', is_admin=True)
+        self.worker = Worker.objects.create(name='first', speciality='test dantist')
+        self.place = Location.objects.create(name='test place', room=2)
+        Schedule.objects.create(worker=self.worker, day=1, time_in='09:00', time_out='12:00')
+        self.monday = datetime.date(2022, 6, 20)
+
+    def test_hold(self):
+        other = Users.objects.create_user(username='other', password='secret', is_admin=True)
+        hold = place_hold(self.worker, self.place, self.monday, datetime.time(9), datetime.time(10), self.user)
+        with self.assertRaises(ValidationError): # another desk
+            place_hold(self.worker, self.place, self.monday, datetime.time(9, 30), datetime.time(11), other)
+        with self.assertRaises(ValidationError):
+            Appointments(number=5, worker=self.worker, place=self.place, day=self.monday, time_in='09:30',
+                         time_out='10:30', title='test_app', creator=other).clean()
+
+        appointment = confirm_hold(hold.token, 'test_app')
+        self.assertEqual((appointment.time_in, appointment.creator), (datetime.time(9), self.user))
+        self.assertFalse(SlotHold.objects.exists())
+        with self.assertRaises(ValidationError): # confirmed once only
+            confirm_hold(hold.token, 'test_app')
+
+    def test_own_hold(self):
+        place_hold(self.worker, self.place, self.monday, datetime.time(10), datetime.time(11), self.user)
+        # the holder books through the usual form, the hold is used up
+        form = AppointmentsForm(data={'number': 1, 'worker': self.worker.pk, 'place': self.place.pk, 
+                                      'day': self.monday, 'time_in': '10:00', 'time_out': '11:00', 
+                                      'title': 'test_app'}, initial={'creator': self.user})
+        self.assertTrue(form.is_valid(), form.errors)
+        form.save()
+        self.assertFalse(SlotHold.objects.exists())
+
+    def test_expiry(self):
+        hold = place_hold(self.worker, self.place, self.monday, datetime.time(9), datetime.time(10), self.user)
+        SlotHold.objects.update(expires_at=timezone.now() - datetime.timedelta(seconds=1))
+        with self.assertRaises(ValidationError):
+            confirm_hold(hold.token, 'test_app')
+        place_hold(self.worker, self.place, self.monday, datetime.time(9), datetime.time(10), self.user)
+        self.assertEqual(sweep(hold.expires_at), 1) # the first hold is due, the expired row is deleted
+        self.assertEqual(SlotHold.objects.count(), 1)
+
+class SeriesTest(TestCase):
+    '''
+    Recurring appointments created within the booking horizon
+    '''
+
+    def setUp(self):
+        self.user = Users.objects.create_user(username='test', password='secret', is_admin=True)
+        self.worker = Worker.objects.create(name='first', speciality='test dantist')
+        self.place = Location.objects.create(name='test place', room=2)
+        Schedule.objects.create(worker=self.worker, day=1, time_in='09:00', time_out='12:00')
+        today = timezone.localdate()
+        self.monday = today + datetime.timedelta(days=7 - today.weekday())
+
+    def data(self, **kwargs):
+        data = {'worker': self.worker.pk, 'place': self.place.pk, 'first_day': self.monday, 
+                'time_in': '09:00', 'time_out': '10:00', 'interval_days': 7, 'count': 52, 
+                'title': 'therapy'}
+        data.update(kwargs)
+        return data
+
+    def test_batched_check(self):
+        Appointments.objects.create(number=1, worker=self.worker, place=self.place, title='test_app',
+                                    day=self.monday + datetime.timedelta(days=14), 
+                                    time_in='09:30', time_out='10:30')
+        series = AppointmentSeries(worker=self.worker, place=self.place, first_day=self.monday, 
+                                   time_in=datetime.time(9), time_out=datetime.time(10), count=52, title='therapy',
+                                   creator=self.user)
+        # 52 dates: related objects, appointments, holds, series and working hours
+        with self.assertNumQueries(8):
+            with self.assertRaisesMessage(ValidationError, str(self.monday + datetime.timedelta(days=14))):
+                series.clean()
+        self.assertFalse(SeriesForm(data=self.data(time_in='08:00')).is_valid()) # no working hours
+
+    def test_horizon(self):
+        form = SeriesForm(data=self.data(), initial={'creator': self.user})
+        self.assertTrue(form.is_valid(), form.errors)
+        series = form.save()
+        created = len([x for x in series.days() if x <= horizon()])
+        self.assertEqual(series.appointments.count(), created)
+        self.assertEqual(AppointmentRow.objects.filter(title='therapy', series_id=series.pk).count(), created)
+        self.assertLess(created, 52)
+
+        def appointment(day):
+            return Appointments(number=100, worker=self.worker, place=self.place, day=day, 
+                                time_in='09:30', time_out='10:30', title='test_app', creator=self.user)
+
+        with self.assertRaises(ValidationError): # created occurrence
+            appointment(self.monday).clean()
+        with self.assertRaisesMessage(ValidationError, 'series'): # not created yet
+            appointment(self.monday + datetime.timedelta(days=7 * 40)).clean()
+        with self.assertRaises(ValidationError): # another series over the same weeks
+            AppointmentSeries(worker=self.worker, place=self.place, first_day=self.monday + datetime.timedelta(days=7 * 30),
+                              time_in=datetime.time(9), time_out=datetime.time(10), count=2, title='other',
+                              creator=self.user).clean()
+
+        # booked without the checks after the series was saved
+        booked = next(x for x in series.days() if x > horizon())
+        Appointments.objects.create(number=100, worker=self.worker, place=self.place, day=booked,
+                                    time_in='09:30', time_out='10:30', title='test_app')
+        with self.assertLogs('sched_api.series', 'WARNING') as logs:
+            self.assertEqual(materialize_due(timezone.localdate() + datetime.timedelta(days=14)), {series.pk: 1})
+        self.assertIn('%s is skipped: booked' % booked, logs.output[0])
+        self.assertEqual(materialize_due(timezone.localdate() + datetime.timedelta(days=14)), {})
+        self.assertEqual(series.appointments.count(), created + 1)
+        self.assertFalse(series.appointments.filter(day=booked).exists())
+
+    def test_count(self):
+        form = SeriesForm(data=self.data(count=0), initial={'creator': self.user})
+        self.assertIn('at least 1', str(form.errors))
+        self.assertTrue(SeriesForm(data=self.data(count=1), initial={'creator': self.user}).is_valid())
+
+class ReminderTest(TestCase):
+    '''
+    Reminders sent once before appointments
+    '''
+
+    def setUp(self):
+        self.user = Users.objects.create_user(username='test', password='secret', email='test@example.com')
+        self.worker = Worker.objects.create(name='first', speciality='test dantist')
+        self.place = Location.objects.create(name='test place', room=2)
+        self.now = timezone.make_aware(datetime.datetime(2022, 6, 19, 23, 50))
+        for i in range(5): # the next day from 23:50, every 2 minutes
+            start = timezone.localtime(self.now + datetime.timedelta(hours=24, minutes=2 * i))
+            Appointments.objects.create(number=i + 1, worker=self.worker, place=self.place, day=start.date(),
+                                        time_in=start.time(), time_out=(start + datetime.timedelta(minutes=2)).time(),
+                                        title='test_app', creator=self.user)
+        StubBackend.outbox.clear()
+
+    def test_batches(self):
+        calls = []
+
+        class Backend(StubBackend):
+            def send_messages(self, messages):
+                calls.append(len(messages))
+                return super().send_messages(messages)
+
+        scheduler = ReminderScheduler(Backend(), hours=(24,), batch=2)
+        other = ReminderScheduler(StubBackend(), hours=(24,))
+        with self.assertNumQueries(1): # one range over midnight
+            self.assertEqual(scheduler.scan(self.now), 2)
+        self.assertEqual(other.scan(self.now), 2)
+        self.assertEqual(scheduler.run_pending(self.now), 1)
+        self.assertEqual(scheduler.scan(self.now + datetime.timedelta(minutes=9)), 3)
+        self.assertEqual(scheduler.run_pending(self.now + datetime.timedelta(minutes=9)), 4)
+        self.assertEqual(calls, [1, 2, 2])
+        self.assertEqual(StubBackend.outbox[0].email, 'test@example.com')
+        self.assertEqual(other.run_pending(self.now + datetime.timedelta(minutes=9)), 0) # sent already
+        self.assertEqual(SentReminder.objects.filter(sent_at__isnull=False).count(), 5)
+
+    def test_failed_delivery(self):
+        class Backend(StubBackend):
+            def send_messages(self, messages):
+                raise ConnectionError('gateway is down')
+
+        scheduler = ReminderScheduler(Backend(), hours=(24,))
+        scheduler.scan(self.now)
+        with self.assertLogs('sched_api.reminders'):
+            self.assertEqual(scheduler.run_pending(self.now), 0)
+        self.assertFalse(SentReminder.objects.exists()) # retried by the next scan
+        Appointments.objects.filter(number=2).delete()
+        scheduler = ReminderScheduler(StubBackend(), hours=(24,))
+        scheduler.scan(self.now)
+        self.assertEqual(scheduler.run_pending(self.now + datetime.timedelta(minutes=2)), 1)
+
+class FormatTest(TestCase):
+    '''
+    Columnar and binary lists chosen by Accept, compression of large responses
+    '''
+
+    def setUp(self):
+        worker = Worker.objects.create(name='first', speciality='test dantist')
+        place = Location.objects.create(name='test place', room=2)
+        for i in range(30):
+            Appointments.objects.create(number=i + 1, worker=worker, place=place, day=datetime.date(2022, 6, 20),
+                                        time_in=datetime.time(8 + i // 4, i % 4 * 15), 
+                                        time_out=datetime.time(8 + i // 4, i % 4 * 15 + 10), title='test_app')
+
+    def test_columnar(self):
+        self.assertEqual(columnar([{'id': 1, 'worker': 'a'}, {'id': 2, 'worker': 'a'}]), 
+                         {'length': 2, 'columns': {'id': [1, 2], 'worker': [0, 0]}, 'dictionaries': {'worker': ['a']}})
+        rows = self.client.get(reverse('api_view_appointments'), HTTP_ACCEPT='application/json').json()
+        resp = self.client.get(reverse('api_view_appointments'), HTTP_ACCEPT='application/vnd.sched.columnar+json')
+        self.assertEqual(resp['Content-Type'], 'application/vnd.sched.columnar+json')
+        data = resp.json()
+        decoded = [{x: data['dictionaries'][x][values[i]] if x in data['dictionaries'] else values[i] 
+                    for x, values in data['columns'].items()} for i in range(data['length'])]
+        self.assertEqual(decoded, rows)
+        self.assertLess(len(resp.content), len(json.dumps(rows)) / 2)
+
+    @unittest.skipUnless(msgpack, 'msgpack is not installed')
+    def test_msgpack(self):
+        resp = self.client.get(reverse('api_schedule'), HTTP_ACCEPT='application/msgpack')
+        self.assertEqual(msgpack.unpackb(resp.content), {'length': 0, 'columns': {}, 'dictionaries': {}})
+
+    def test_compression(self):
+        resp = self.client.get(reverse('api_view_appointments'), HTTP_ACCEPT='application/json', 
+                               HTTP_ACCEPT_ENCODING='gzip, deflate')
+        self.assertEqual(resp['Content-Encoding'], 'gzip')
+        self.assertEqual(len(json.loads(gzip.decompress(resp.content))), 30)
+        resp = self.client.get(reverse('api_view_appointments'), HTTP_ACCEPT='application/json', 
+                               HTTP_ACCEPT_ENCODING='gzip;q=0')
+        self.assertFalse(resp.has_header('Content-Encoding'))
+        self.assertIn('Accept-Encoding', resp['Vary'])
+        self.assertIsNone(choose_encoding('identity'))
+
+class GroupCommitTest(TransactionTestCase):
+    '''
+    Bookings written in groups by one thread
+    '''
+
+    def setUp(self):
+        # cached specialities and workers are not valid after the flush
+        for clear in (cache.clear, refcache.forget):
+            clear()
+            self.addCleanup(clear)
+        self.user = Users.objects.create_user(username='test', password='secret', is_admin=True)
+        self.worker = Worker.objects.create(name='first', speciality='test dantist')
+        self.place = Location.objects.create(name='test place', room=2)
+        Schedule.objects.create(worker=self.worker, day=1, time_in='09:00', time_out='12:00')
+
+    def appointment(self, number, time_in, time_out):
+        return Appointments(number=number, worker=self.worker, place=self.place, day=datetime.date(2022, 6, 20),
+                            time_in=time_in, time_out=time_out, title='test_app', creator=self.user)
+
+    def test_group(self):
+        Appointments.objects.create(number=3, worker=self.worker, place=self.place, day=datetime.date(2022, 6, 21),
+                                    time_in='09:00', time_out='10:00', title='test_app')
+        # one transaction for the whole group (appointments, holds, series and rooms), then the calendar feeds
+        with self.assertNumQueries(17):
+            results = write_group([self.appointment(1, datetime.time(9), datetime.time(10)),
+                                   self.appointment(2, datetime.time(9, 30), datetime.time(10, 30)),
+                                   self.appointment(3, datetime.time(10), datetime.time(11))])
+        self.assertIsInstance(results[1], ValidationError)
+        self.assertEqual(results[2].number, 4) # taken by another booking
+        self.assertEqual(AppointmentRow.objects.filter(appointment_id=results[2].pk).count(), 1)
+
+        # holds, series and rooms which appeared after clean()
+        other = Users.objects.create_user(username='other', password='secret', is_admin=True)
+        place_hold(self.worker, self.place, datetime.date(2022, 6, 20), datetime.time(11), datetime.time(12), other)
+        results = write_group([self.appointment(5, datetime.time(11), datetime.time(11, 30))])
+        self.assertIn('held', str(results[0]))
+        SlotHold.objects.all().delete()
+        AppointmentSeries.objects.create(worker=self.worker, place=self.place, first_day=datetime.date(2022, 6, 20),
+                                         time_in='11:00', time_out='12:00', count=1, title='series', creator=other)
+        room = Location.objects.create(name='test place', room=3)
+        Schedule.objects.create(worker=Worker.objects.create(name='second', speciality='test dantist'), 
+                                day=1, time_in='09:00', time_out='12:00', place=room)
+        self.assertIn('series', str(write_group([self.appointment(5, datetime.time(11), datetime.time(11, 30))])[0]))
+        appointment = self.appointment(5, datetime.time(10), datetime.time(10, 30))
+        appointment.place = room
+        self.assertIn('room of another shift', str(write_group([appointment])[0]))
+
+    def test_writer(self):
+        writer = GroupWriter(wait=5)
+        results = []
+
+        def book():
+            try:
+                results.append(writer.book(self.appointment(None, datetime.time(9), datetime.time(10))))
+            except ValidationError as err:
+                results.append(err)
+
+        threads = [threading.Thread(target=book) for _ in range(5)]
+        for thread in threads: thread.start()
+        for thread in threads: thread.join()
+        self.assertEqual(len([x for x in results if isinstance(x, Appointments)]), 1)
+        self.assertEqual(Appointments.objects.count(), 1)
+
+        # the caller stops waiting before the writer takes the booking
+        busy = threading.Event()
+        queued = GroupWriter()
+        queued.thread = threading.Thread(target=busy.wait) # the writer does not take new bookings
+        queued.thread.start()
+        with self.assertRaisesMessage(ValidationError, 'not saved in time'):
+            queued.book(self.appointment(None, datetime.time(10), datetime.time(11)), timeout=0.01)
+        busy.set()
+        self.assertFalse(queued.queue.get()[2].set_running_or_notify_cancel()) # skipped by the writer
+
+        with override_settings(SCHED_GROUP_COMMIT=True):
+            form = AppointmentsForm(data={'number': 7, 'worker': self.worker.pk, 'place': self.place.pk,
+                                          'day': '2022-06-20', 'time_in': '11:00', 'time_out': '11:30',
+                                          'title': 'test_app'}, initial={'creator': self.user})
+            self.assertTrue(form.is_valid(), form.errors)
+            self.assertEqual(Appointments.objects.get(pk=form.save().pk).number, 7)
+
+class FeedTest(TestCase):
+    '''
+    Cached iCalendar feeds
+    '''
+
+    def setUp(self):
+        cache.clear()
+        self.worker = Worker.objects.create(name='first', speciality='test dantist')
+        self.place = Location.objects.create(name='test place', room=2)
+        self.day = timezone.localdate() + datetime.timedelta(days=1)
+        Schedule.objects.create(worker=self.worker, day=self.day.isoweekday(), time_in='09:00', time_out='12:00')
+        Appointments.objects.create(number=1, worker=self.worker, place=self.place, day=self.day,
+                                    time_in='09:00', time_out='10:00', title='checkup; teeth')
+
+    def url(self, name, pk):
+        return reverse(name, args=[pk, token(name[len('feed_'):], pk)])
+
+    def get(self, name, pk, **headers):
+        resp = self.client.get(self.url(name, pk), **headers)
+        content = b''.join(resp.streaming_content) if resp.streaming else resp.content
+        return resp, content.decode()
+
+    def test_feed(self):
+        resp, text = self.get('feed_worker', self.worker.pk)
+        self.assertTrue(resp.streaming)
+        self.assertTrue(text.startswith('BEGIN:VCALENDAR\r\n') and text.endswith('END:VCALENDAR\r\n'))
+        self.assertIn('SUMMARY:checkup\\; teeth', text)
+        self.assertIn('Working hours: first', text)
+        self.assertIn('DTSTART:' + self.day.strftime('%Y%m%d') + 'T090000Z', text)
+
+        with self.assertNumQueries(0): # cached
+            resp, cached = self.get('feed_worker', self.worker.pk)
+        self.assertEqual(cached, text)
+        resp = self.client.get(self.url('feed_worker', self.worker.pk), HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(gzip.decompress(resp.content).decode(), text)
+        resp, _ = self.get('feed_worker', self.worker.pk, HTTP_IF_NONE_MATCH=resp['ETag'])
+        self.assertEqual(resp.status_code, 304)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Appointments.objects.create(number=2, worker=self.worker, place=self.place, day=self.day,
+                                        time_in='10:00', time_out='11:00', title='second')
+        resp, text = self.get('feed_worker', self.worker.pk)
+        self.assertTrue(resp.streaming)
+        self.assertIn('SUMMARY:second', text)
+        self.assertIn('SUMMARY:second (first)', self.get('feed_place', self.place.pk)[1])
+        self.assertIn('SUMMARY:second (first)', self.get('feed_speciality', self.worker.speciality_id)[1])
+        self.assertEqual(self.get('feed_worker', self.worker.pk + 100)[0].status_code, 404)
+
+    def test_token(self):
+        self.assertEqual(self.client.get(reverse('feed_worker', args=[self.worker.pk, 'wrong'])).status_code, 404)
+        other = token('worker', self.worker.pk + 1)
+        self.assertEqual(self.client.get(reverse('feed_worker', args=[self.worker.pk, other])).status_code, 404)
+        user = Users.objects.create_user(username='test', password='secret', is_admin=True)
+        self.client.force_login(user)
+        url = self.client.get(reverse('api_admin_feed'), {'kind': 'worker', 'id': self.worker.pk}).json()['url']
+        self.assertEqual(url, 'http://testserver' + self.url('feed_worker', self.worker.pk))
+        self.assertEqual(self.client.get(reverse('api_admin_feed'), {'kind': 'worker', 'id': 0}).status_code, 404)
+
+    @override_settings(SCHED_FACILITIES={'north': {'DATABASE': 'default'}})
+    def test_facility(self):
+        def events(kind, obj):
+            yield 'BEGIN:VCALENDAR\r\n'
+            yield '%s %s\r\n' % (get_current_facility(), router.db_for_read(AppointmentRow))
+
+        with mock.patch('sched_api.feeds.events', events), \
+                override_settings(SCHED_READ_REPLICAS={'default': 'replica'}):
+            with use_facility('north'):
+                url = self.url('feed_worker', self.worker.pk)
+            resp = self.client.get('/f/north' + url)
+            self.assertTrue(resp.streaming)
+            self.assertIsNone(get_current_facility()) # the middleware has finished
+            text = b''.join(resp.streaming_content).decode()
+        # the facility and its replica while the feed is built
+        self.assertIn('north replica', text)
+        self.assertIsNone(get_current_facility())
+
+    def test_fold(self):
+        lines = fold('SUMMARY:' + 'ж' * 100).split('\r\n')
+        self.assertTrue(all(len(x.encode()) <= 75 for x in lines))
+        self.assertEqual(''.join(x[1:] if i else x for i, x in enumerate(lines)), 'SUMMARY:' + 'ж' * 100)
+
+
+class RoomTest(TestCase):
+    '''
+    Rooms of the shifts and the place of the bookings taken from them
+    '''
+
+    def setUp(self):
+        self.user = Users.objects.create_user(username='test', password='secret', is_admin=True)
+        self.first = Worker.objects.create(name='first', speciality='test dantist')
+        self.second = Worker.objects.create(name='second', speciality='test dantist')
+        self.room = Location.objects.create(name='test place', room=2)
+        self.other = Location.objects.create(name='test place', room=3)
+        Schedule.objects.create(worker=self.first, day=1, time_in='09:00', time_out='12:00', place=self.room)
+        Schedule.objects.create(worker=self.second, day=1, time_in='09:00', time_out='12:00')
+        today = timezone.localdate()
+        self.monday = today + datetime.timedelta(days=7 - today.weekday())
+
+    def appointment(self, worker, place=None, number=1):
+        return Appointments(number=number, worker=worker, place=place, day=self.monday, 
+                            time_in=datetime.time(10), time_out=datetime.time(11), title='test_app', 
+                            creator=self.user)
+
+    def test_room_of_one_shift(self):
+        third = Worker.objects.create(name='third', speciality='test dantist')
+        data = {'worker': third.pk, 'day': 1, 'time_in': '11:00', 'time_out': '13:00'}
+        self.assertFalse(ScheduleForm(data=dict(data, place=self.room.pk)).is_valid())
+        self.assertTrue(ScheduleForm(data=dict(data, place=self.other.pk)).is_valid())
+        self.assertTrue(ScheduleForm(data=dict(data, day=2, place=self.room.pk)).is_valid())
+
+        self.appointment(self.second, self.other).save()
+        shift = Schedule.objects.get(worker=self.first)
+        shift.place = self.other
+        with self.assertRaisesMessage(ValidationError, 'appointments of other workers'):
+            shift.clean()
+
+    def test_place_from_shift(self):
+        appointment = self.appointment(self.first)
+        appointment.clean()
+        self.assertEqual(appointment.place_id, self.room.pk)
+        with self.assertRaisesMessage(ValidationError, 'room of another shift'):
+            self.appointment(self.second, self.room).clean()
+        with self.assertRaisesMessage(ValidationError, 'Choose the place'):
+            self.appointment(self.second).clean()
+
+    def test_owned_room_skips_place_overlap(self):
+        with CaptureQueriesContext(connection) as owned:
+            self.appointment(self.first, self.room).clean()
+        with CaptureQueriesContext(connection) as shared:
+            self.appointment(self.second, self.other).clean()
+        # no lookup of the shifts in the room and no overlap check of the place (two queries)
+        self.assertEqual(len(owned), len(shared) - 3)
@@ -1,7 +1,10 @@
 from django.urls import path
 from .views import api_view_workers, api_worker_schedule, log_out, api_view_appointments
 from .views import api_admin_worker, api_admin_location, api_admin_schedule, api_admin_appointments
-from .views import LogInView, SignUpView, UserList, WorkerList, ScheduleList, AppointmentList
+from .views import api_admin_schedule_exception, api_admin_waitlist, api_admin_solver
+from .views import api_admin_hold, api_admin_hold_confirm, api_admin_series, api_admin_feed
+from .views import LogInView, SignUpView
+from .urls_api import urlpatterns as api_urlpatterns
 from django.views.generic.base import TemplateView
 
 urlpatterns = [
@@ -18,12 +21,15 @@ urlpatterns = [
     path('api_admin_worker', api_admin_worker, name='api_admin_worker'),
     path('api_admin_location', api_admin_location, name='api_admin_location'),
     path('api_admin_schedule', api_admin_schedule, name='api_admin_schedule'),
+    path('api_admin_schedule_exception', api_admin_schedule_exception, name='api_admin_schedule_exception'),
     path('api_admin_appointments', api_admin_appointments, name='api_admin_appointments'),
+    path('api_admin_waitlist', api_admin_waitlist, name='api_admin_waitlist'),
+    path('api_admin_series', api_admin_series, name='api_admin_series'), # recurring appointments
+    path('api_admin_solver', api_admin_solver, name='api_admin_solver'), # batch of bookings
+    path('api_admin_hold', api_admin_hold, name='api_admin_hold'), # hold the time while booking
+    path('api_admin_hold_confirm', api_admin_hold_confirm, name='api_admin_hold_confirm'),
+    path('api_admin_feed', api_admin_feed, name='api_admin_feed'), # URL of the calendar feed
 
-    path('api/users', UserList.as_view(), name = 'api_users'),
-    path('api/workers', WorkerList.as_view(), name = 'api_workers'),
-    # path('api/schedule', api_worker_schedule, {'type_result': 'json'}, name='api_schedule'),
-    path('api/schedule', ScheduleList.as_view(), name='api_schedule'),
-    path('api/appointments', AppointmentList.as_view(), name='api_view_appointments'),
+    *api_urlpatterns, # api/* and metrics
 
 ]
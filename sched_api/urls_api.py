@@ -0,0 +1,22 @@
+from django.urls import path
+from .views import api_search_workers, api_availability, api_batch, api_metrics, api_feed
+from .views import UserList, WorkerList, ScheduleList, AppointmentList
+
+# JSON endpoints, served also by API-only workers (Sched.settings_api)
+urlpatterns = [
+    path('api/users', UserList.as_view(), name = 'api_users'),
+    path('api/workers', WorkerList.as_view(), name = 'api_workers'),
+    path('api/workers/search', api_search_workers, name = 'api_search_workers'), # ?q=
+    # path('api/schedule', api_worker_schedule, {'type_result': 'json'}, name='api_schedule'),
+    path('api/schedule', ScheduleList.as_view(), name='api_schedule'),
+    path('api/availability', api_availability, name='api_availability'), # free time of workers
+    path('api/batch', api_batch, name='api_batch'), # schedules and appointments, ?worker=1,2&day=...
+    path('api/appointments', AppointmentList.as_view(), name='api_view_appointments'),
+
+    # iCalendar feeds for calendar apps
+    path('feeds/worker/<int:pk>/<str:token>.ics', api_feed, {'kind': 'worker'}, name='feed_worker'),
+    path('feeds/place/<int:pk>/<str:token>.ics', api_feed, {'kind': 'place'}, name='feed_place'),
+    path('feeds/speciality/<int:pk>/<str:token>.ics', api_feed, {'kind': 'speciality'}, name='feed_speciality'),
+
+    path('metrics', api_metrics, name='metrics'), # Prometheus
+]
@@ -1,41 +1,63 @@
+'''
+Views of the site and of the API.
+
+Forms, html tables, filters and the solver are imported inside the views
+which use them, so API-only workers (Sched.settings_api) do not load
+django_tables2, django_filters and the forms at startup.
+'''
+
+import datetime
+from collections import defaultdict
+
 from django.shortcuts import render
-from django.http import JsonResponse
+from django.http import JsonResponse, HttpResponse, HttpResponseNotModified, StreamingHttpResponse, Http404
 from rest_framework import generics
 from rest_framework.decorators import api_view, permission_classes
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.response import Response
-from .models import Appointments, Worker, Users, Schedule, Users
-from .serializers import AppointmentsSerializer, WorkerSerializer, ScheduleSerializer, UsersSerializer
+from .models import Appointments, AppointmentRow, Worker, Users, Schedule, Speciality
+from .serializers import AppointmentRowSerializer, WorkerSerializer, ScheduleSerializer, UsersSerializer
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth import login
 from django.views.generic import CreateView, View
 from django.shortcuts import redirect
-from .forms import SignUpForm, LogInForm, WorkerForm, LocationForm, ScheduleForm, AppointmentsForm
+from django.urls import reverse
+from .availability import Availability, free_intervals
 from django.contrib.auth import authenticate, logout
-from .decorators import serviceman_required, admin_required
+from .decorators import serviceman_required, admin_required, idempotent, replica_reads
 from django.utils.decorators import method_decorator
-from .filters import ScheduleFilter, ScheduleTable
+from .search import search_workers, SEARCH_LIMIT
+from .renderers import list_renderers
+from . import metrics, refcache
+
+MAX_AVAILABILITY_DAYS = 62 # longest range of dates for the availability
+MAX_BATCH_WORKERS = 100 # workers in one batch request
+MAX_BATCH_DAYS = 31 # days in one batch request
 
 class WorkerList(generics.ListAPIView):
     '''
     Work with Worker model using API
     '''
-    queryset = Worker.objects.all()
+    queryset = Worker.objects.select_related('speciality')
     serializer_class = WorkerSerializer
 
+@method_decorator(replica_reads, name='dispatch')
 class ScheduleList(generics.ListAPIView):
     '''
     Work with Schedule model using API
     '''    
     queryset = Schedule.objects.all()
     serializer_class = ScheduleSerializer
+    renderer_classes = list_renderers() # JSON, columnar JSON, MessagePack by Accept
 
+@method_decorator(replica_reads, name='dispatch')
 class AppointmentList(generics.ListAPIView):
     '''
     Work with Appointments model using API
     '''    
-    queryset = Appointments.objects.all()
-    serializer_class = AppointmentsSerializer    
+    queryset = AppointmentRow.objects.order_by('day', 'time_in')
+    serializer_class = AppointmentRowSerializer
+    renderer_classes = list_renderers()
 
 @api_view(['GET', ])
 def api_view_workers(request, type_result='html'):
@@ -52,19 +74,45 @@ def api_view_workers(request, type_result='html'):
     try:
         message = "List of workers"
         worker_speciality = request.data['speciality'] if len(request.data)>0 else ''
-        if worker_speciality != '': workers_list = Worker.objects.filter(speciality=worker_speciality)
+        speciality_id = Speciality.objects.id_for_name(worker_speciality) if worker_speciality != '' else None
+
+        if type_result != 'html': # reference data from the process cache
+            workers_list = [x for x in refcache.workers() 
+                            if worker_speciality == '' or x.speciality_id == speciality_id]
+            return JsonResponse(WorkerSerializer(workers_list, many=True).data, safe=False)
+
+        if worker_speciality != '': workers_list = Worker.objects.filter(speciality_id=speciality_id)
         else: workers_list = Worker.objects.filter()
+        workers_list = workers_list.select_related('speciality')
 
-        serialized_workers_list = WorkerSerializer(workers_list, many=True)
+        from .filters import WorkerTable, paginate_table
+        data = paginate_table(request, WorkerTable(workers_list))
+        return render(request, 'view_list.html', context={'data': data, 'message': message})
+    except Exception as err:
+        return JsonResponse({'error':str(err)})
 
-        if type_result == 'html':
-            return render(request, 'view_list.html', context={'data': workers_list, 'message': message})
-        else: return JsonResponse(serialized_workers_list.data, safe=False)
+
+@api_view(['GET', ])
+def api_search_workers(request):
+    '''
+    Search of specialists by beginnings of words of the name and speciality
+
+            Parameters:
+                    request (Request): Request with 'q' (search string) and 'limit' parameters
+
+            Returns:
+                   JSON with found workers, best matches first
+    '''
+    try:
+        limit = min(int(request.GET.get('limit', SEARCH_LIMIT)), 100)
+        workers_list = search_workers(request.GET.get('q', ''), limit)
+        return JsonResponse(WorkerSerializer(workers_list, many=True).data, safe=False)
     except Exception as err:
         return JsonResponse({'error':str(err)})
 
 
 @api_view(['GET', ])
+@replica_reads
 def api_worker_schedule(request, type_result='html'):
     '''
     Get the specilist's schedule
@@ -80,22 +128,89 @@ def api_worker_schedule(request, type_result='html'):
         worker_speciality = request.data['speciality'] if len(request.data)>0 else ''
         day_schedule = (request.data['day']).isoweekday() if len(request.data)>0 else 0
 
-        worker_speciality_list = Schedule.objects.filter(worker__speciality = worker_speciality) if (
+        worker_speciality_list = Schedule.objects.filter(
+            worker__speciality_id = Speciality.objects.id_for_name(worker_speciality)) if (
             not worker_speciality == '') else Schedule.objects.filter()
         
         worker_day_schedule = worker_speciality_list.filter(day = day_schedule) if (
             not day_schedule == 0) else worker_speciality_list
 
-        filter = ScheduleFilter(request.GET, queryset = worker_speciality_list)
-        data = ScheduleTable(data=filter.qs)
-        serialized_schedule_list = ScheduleSerializer(worker_day_schedule, many=True)
-        
         if type_result == 'html':
+            from .filters import ScheduleFilter, ScheduleTable, paginate_table
+            filter = ScheduleFilter(request.GET, queryset = worker_speciality_list.select_related('worker__speciality'))
+            data = paginate_table(request, ScheduleTable(data=filter.qs))
             return render(request, 'schedule.html', context={'filter': filter, 'data': data})
-        else: return JsonResponse(serialized_schedule_list.data, safe=False)
+        else: return JsonResponse(ScheduleSerializer(worker_day_schedule.select_related('worker'), 
+                                                     many=True).data, safe=False)
     except Exception as err:
         return JsonResponse({'error':str(err)})    
 
+@api_view(['GET', ])
+@replica_reads
+def api_availability(request):
+    '''
+    Get free time of specialists for the range of dates
+
+            Parameters:
+                    request (Request): Request with 'worker' (ids separated by comma),
+                                'date_from' and 'date_to' (ISO format) parameters
+
+            Returns:
+                   JSON with free intervals for every worker and date    
+    '''
+    try:
+        worker_ids = [int(x) for x in request.GET.get('worker', '').split(',') if x]
+        date_from = datetime.date.fromisoformat(request.GET['date_from'])
+        date_to = datetime.date.fromisoformat(request.GET.get('date_to', request.GET['date_from']))
+        if not 0 <= (date_to - date_from).days <= MAX_AVAILABILITY_DAYS:
+            raise ValueError('Wrong range of dates')
+
+        free = free_intervals(worker_ids, date_from, date_to)
+        data = [{'worker': worker_id, 'day': str(day), 
+                 'free': [[str(x), str(y)] for x, y in intervals]} 
+                for (worker_id, day), intervals in sorted(free.items())]
+        return JsonResponse(data, safe=False)
+    except Exception as err:
+        return JsonResponse({'error':str(err)})
+
+@api_view(['GET', ])
+@replica_reads
+def api_batch(request):
+    '''
+    Get schedules and appointments of many specialists for many days at once
+
+            Parameters:
+                    request (Request): Request with 'worker' (ids separated by comma)
+                                and 'day' (dates in ISO format separated by comma) parameters
+
+            Returns:
+                   JSON with working hours (weekly segments with extra shifts and closures)
+                   and appointments of every worker for every day    
+    '''
+    try:
+        worker_ids = sorted({int(x) for x in request.GET.get('worker', '').split(',') if x})
+        days = sorted({datetime.date.fromisoformat(x) for x in request.GET.get('day', '').split(',') if x})
+        if len(worker_ids) > MAX_BATCH_WORKERS or len(days) > MAX_BATCH_DAYS:
+            raise ValueError('Too many workers or days')
+
+        # four IN queries for the whole batch, the hours are the ones of api_availability
+        names = dict(Worker.objects.filter(pk__in=worker_ids).values_list('id', 'name'))
+        availability = Availability(names, days[0], days[-1]) if days else None
+        booked = defaultdict(list)
+        for row in Appointments.objects.filter(worker_id__in=names, day__in=days).order_by('time_in').values(
+                'id', 'number', 'worker_id', 'place_id', 'day', 'time_in', 'time_out', 'title'):
+            booked[(row.pop('worker_id'), row.pop('day'))].append(
+                dict(row, time_in=str(row['time_in']), time_out=str(row['time_out'])))
+
+        data = [{'worker': worker_id, 'name': names[worker_id], 
+                 'days': [{'day': str(day), 'schedule': [[str(x), str(y)] for x, y in availability.hours(worker_id, day)],
+                           'appointments': booked[(worker_id, day)]} for day in days]}
+                for worker_id in worker_ids if worker_id in names]
+        return JsonResponse(data, safe=False)
+    except Exception as err:
+        return JsonResponse({'error':str(err)})
+
+@replica_reads
 def api_view_appointments(request, type_result='html'):
     '''
     Get the list of appointments
@@ -109,12 +224,13 @@ def api_view_appointments(request, type_result='html'):
     '''
     try:  
         message = "List of appointments"
-        appointments_list = Appointments.objects.all()
-        serialized_appointments_list = AppointmentsSerializer(appointments_list, many=True)
+        appointments_list = AppointmentRow.objects.order_by('day', 'time_in') # flat rows, no joins
 
         if type_result == 'html':
-            return render(request, 'view_list.html', context={'data': appointments_list, 'message': message})
-        else: return JsonResponse(serialized_appointments_list.data, safe=False)
+            from .filters import AppointmentsTable, paginate_table
+            data = paginate_table(request, AppointmentsTable(appointments_list))
+            return render(request, 'view_list.html', context={'data': data, 'message': message})
+        else: return JsonResponse(AppointmentRowSerializer(appointments_list, many=True).data, safe=False)
     except Exception as err:
         return JsonResponse({'error':str(err)})    
 
@@ -157,33 +273,51 @@ def api_admin_add_staff(request, form_model, staff, initial={}):
     except Exception as err:
         return JsonResponse({'error':str(err)})                    
 
+@idempotent
 @api_view(['GET', 'POST'])
 @login_required(login_url='login')
 @serviceman_required
 def api_admin_worker(request):
     # Add workers
 
+    from .forms import WorkerForm
     answer = api_admin_add_staff(request, WorkerForm, 'worker')
     return answer
 
+@idempotent
 @api_view(['GET', 'POST'])
 @login_required(login_url='login')
 @serviceman_required
 def api_admin_location(request):
     # Add Location
     
+    from .forms import LocationForm
     answer = api_admin_add_staff(request, LocationForm, 'location')
     return answer
 
+@idempotent
 @api_view(['GET', 'POST'])
 @login_required(login_url='login')
 @serviceman_required
 def api_admin_schedule(request):
     # Add schedule
 
+    from .forms import ScheduleForm
     answer = api_admin_add_staff(request, ScheduleForm, 'schedule')
     return answer
 
+@idempotent
+@api_view(['GET', 'POST'])
+@login_required(login_url='login')
+@serviceman_required
+def api_admin_schedule_exception(request):
+    # Add holidays, sick days and extra shifts
+
+    from .forms import ScheduleExceptionForm
+    answer = api_admin_add_staff(request, ScheduleExceptionForm, 'schedule exception')
+    return answer
+
+@idempotent
 @api_view(['GET', 'POST'])
 @login_required(login_url='login')
 @admin_required
@@ -200,19 +334,147 @@ def api_admin_appointments(request):
             pass
     except Exception as err:
         return JsonResponse({'error':str(err)})
+    from .forms import AppointmentsForm
     answer = api_admin_add_staff(request, AppointmentsForm, 'appointments', initial={'creator': id[0]})
     return answer
 
 
+@idempotent
+@api_view(['POST'])
+@login_required(login_url='login')
+@admin_required
+def api_admin_solver(request):
+    '''
+    Place the batch of booking requests into free time of workers and rooms
+
+            Parameters:
+                    request (Request): JSON with 'requests' (list of objects with 'speciality'
+                                or 'worker', 'day', 'time_from', 'time_to', 'duration', 
+                                'title') and optional 'dry_run'
+
+            Returns:
+                   JSON with number of placed requests, indexes of not placed ones 
+                   and time of the solving
+    '''
+    from .solver import Solver
+    try:
+        solver = Solver(request.data['requests'])
+        solver.solve()
+        if not request.data.get('dry_run'): 
+            solver.save(creator=Users.objects.filter(username = request.user.username).first())
+        return JsonResponse(solver.report())
+    except Exception as err:
+        return JsonResponse({'error':str(err)})
+
+@idempotent
+@api_view(['POST'])
+@login_required(login_url='login')
+@admin_required
+def api_admin_hold(request):
+    '''
+    Hold the time while the booking form is filled, or release the hold
+
+            Parameters:
+                    request (Request): Request with 'worker', 'place', 'day', 'time_in'
+                                and 'time_out' parameters, or with 'release' (token)
+
+            Returns:
+                   JSON with the token of the hold and its expiry time
+    '''
+    from .forms import HoldForm
+    from .holds import place_hold, release_hold
+    try:
+        if 'release' in request.POST: 
+            return JsonResponse({'released': release_hold(request.POST['release'])})
+        form = HoldForm(data=request.POST)
+        if not form.is_valid(): return JsonResponse({'error': form.errors})
+        creator = Users.objects.filter(username = request.user.username).first()
+        hold = place_hold(holder=creator, **form.cleaned_data)
+        return JsonResponse({'token': hold.token, 'expires_at': hold.expires_at.isoformat()})
+    except Exception as err:
+        return JsonResponse({'error':str(err)})
+
+@idempotent
+@api_view(['POST'])
+@login_required(login_url='login')
+@admin_required
+def api_admin_hold_confirm(request):
+    '''
+    Book the held time
+
+            Parameters:
+                    request (Request): Request with 'token' and 'title' parameters
+
+            Returns:
+                   JSON with the id and the number of the appointment
+    '''
+    from .holds import confirm_hold
+    try:
+        creator = Users.objects.filter(username = request.user.username).first()
+        appointment = confirm_hold(request.POST['token'], request.POST.get('title', ''), creator)
+        return JsonResponse({'id': appointment.pk, 'number': appointment.number})
+    except Exception as err:
+        return JsonResponse({'error':str(err)})
+
+@idempotent
+@api_view(['GET', 'POST'])
+@login_required(login_url='login')
+@admin_required
+def api_admin_waitlist(request):
+    # Add requests to the waitlist, they are booked when the time gets free
+
+    creator = Users.objects.filter(username = request.user.username).first()
+    from .forms import WaitlistForm
+    answer = api_admin_add_staff(request, WaitlistForm, 'waitlist request', initial={'creator': creator})
+    return answer
+
+
+@idempotent
+@api_view(['GET', 'POST'])
+@login_required(login_url='login')
+@admin_required
+def api_admin_series(request):
+    # Add recurring appointments, occurrences after the booking horizon are created later
+
+    creator = Users.objects.filter(username = request.user.username).first()
+    from .forms import SeriesForm
+    answer = api_admin_add_staff(request, SeriesForm, 'appointment series', initial={'creator': creator})
+    return answer
+
+@api_view(['GET'])
+@login_required(login_url='login')
+@admin_required
+def api_admin_feed(request):
+    '''
+    URL of the iCalendar feed with its secret token
+
+            Parameters:
+                    request (Request): Request with 'kind' ('worker', 'place' or 
+                                'speciality') and 'id' parameters
+
+            Returns:
+                   JSON with the URL
+    '''
+    from .feeds import token, KINDS
+    kind, pk = request.GET.get('kind'), request.GET.get('id', '')
+    if kind not in KINDS or not pk.isdigit() or refcache.instance(KINDS[kind], pk) is None:
+        return JsonResponse({'error': 'No such feed'}, status=404)
+    url = reverse('feed_' + kind, args=[int(pk), token(kind, int(pk))])
+    return JsonResponse({'url': request.build_absolute_uri(url)})
+
+
 @method_decorator([serviceman_required], name='dispatch')
 class SignUpView(CreateView):
     '''
     Form for adding users
     '''
     model = Users
-    form_class = SignUpForm
     template_name = 'signup_form.html'
 
+    def get_form_class(self):
+        from .forms import SignUpForm
+        return SignUpForm
+
     def form_valid(self, form):
         user = form.save()
         # login(self.request, user) # login mmediately in new user
@@ -223,7 +485,11 @@ class LogInView(View):
     Form for Login
     '''
     template_name = 'login_form.html'
-    form_class = LogInForm
+
+    @property
+    def form_class(self):
+        from .forms import LogInForm
+        return LogInForm
     
     def get(self, request):
         form = self.form_class()
@@ -248,6 +514,37 @@ class LogInView(View):
         except Exception as err:
             return JsonResponse({'error':str(err)})
 
+@replica_reads
+def api_feed(request, kind, pk, token):
+    '''
+    iCalendar feed of working hours and appointments for calendar apps
+
+            Parameters:
+                    request (Request): Request, the If-None-Match header is checked
+                    kind (str): 'worker', 'place' or 'speciality'
+                    pk (int): id of the object
+                    token (str): secret token of the feed
+
+            Returns:
+                   text/calendar from the cache, or streamed while it is built
+    '''
+    from .feeds import feed, etag, check_token, CONTENT_TYPE
+    if not check_token(kind, pk, token): raise Http404('No such ' + kind)
+    content, chunks = feed(kind, pk)
+    if content is None and chunks is None: raise Http404('No such ' + kind)
+    if content is None: return StreamingHttpResponse(chunks, content_type=CONTENT_TYPE)
+    tag = etag(content)
+    # the tag of the compressed response is weak
+    matched = request.META.get('HTTP_IF_NONE_MATCH', '').replace('W/', '') == tag
+    response = HttpResponseNotModified() if matched else \
+        HttpResponse(content, content_type=CONTENT_TYPE)
+    response['ETag'] = tag
+    return response
+
+def api_metrics(request):
+    # metrics in the Prometheus text format
+    return HttpResponse(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
 def log_out(request):
     # logout
     logout(request)
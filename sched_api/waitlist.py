@@ -0,0 +1,161 @@
+'''
+Automatic booking of waitlist requests into freed time.
+
+When an appointment is cancelled, only the requests for its worker or its
+speciality whose windows contain the freed interval are read (indexed by
+worker/speciality, status, day and time), so the cost depends on the freed
+window and not on the length of the waitlist: windows are limited to
+WaitlistRequest.MAX_DAYS, so the day of the request is a bounded range.
+'''
+
+import datetime
+
+from django.core.exceptions import ValidationError
+from django.db import transaction
+from django.db.models import Q
+
+from .models import Appointments, Schedule, WaitlistRequest, Worker
+from .availability import free_intervals
+
+CANDIDATES = 20 # waiting requests checked for one freed interval
+HORIZON = 62 # days ahead checked after changes of the schedule
+
+
+def add_minutes(time, minutes):
+    # None if the result is on the next day
+    moment = datetime.datetime.combine(datetime.date.min, time) + datetime.timedelta(minutes=minutes)
+    return moment.time() if moment.date() == datetime.date.min else None
+
+
+def fit(request, start, end):
+    '''
+    Place the request into the free interval
+
+            Parameters:
+                    request (WaitlistRequest): waiting request
+                    start, end (time): free interval
+
+            Returns:
+                    (time_in, time_out) of the booking or None if it does not fit
+    '''
+    time_in = max(start, request.time_from)
+    time_out = add_minutes(time_in, request.duration)
+    if time_out is None or time_out > min(end, request.time_to): return None
+    return time_in, time_out
+
+
+def book(request, worker_id, place_id, day, time_in, time_out):
+    '''
+    Book the request in one transaction, None if the time is taken already;
+    without place_id the appointment is made in the room of the shift
+    '''
+    try:
+        with transaction.atomic():
+            # compare-and-set, so the request is never booked twice
+            if not WaitlistRequest.objects.filter(pk=request.pk, status=WaitlistRequest.WAITING
+                    ).update(status=WaitlistRequest.BOOKED):
+                return None
+            appointment = Appointments(number=Appointments.next_number(), worker_id=worker_id,
+                                       place_id=place_id, day=day, time_in=time_in,
+                                       time_out=time_out, title=request.title,
+                                       creator_id=request.creator_id)
+            appointment.clean()
+            appointment.save()
+            WaitlistRequest.objects.filter(pk=request.pk).update(appointment=appointment)
+            return appointment
+    except ValidationError:
+        return None
+
+
+def candidates(worker, day, start, end):
+    # waiting requests whose windows contain the day and cross the interval,
+    # windows are not longer than MAX_DAYS, so day_from is a bounded range of the index
+    return WaitlistRequest.objects.filter(
+        Q(worker_id=worker.pk) | Q(speciality_id=worker.speciality_id),
+        status=WaitlistRequest.WAITING, 
+        day_from__range=(day - datetime.timedelta(days=WaitlistRequest.MAX_DAYS), day), day_to__gte=day,
+        time_from__lt=end, time_to__gt=start).order_by('created', 'id')[:CANDIDATES]
+
+
+def match_freed_interval(worker_id, place_id, day, start, end):
+    '''
+    Fill the freed time of the worker with the best waiting requests
+    (the oldest ones first)
+
+            Parameters:
+                    worker_id, place_id (int): ids of Worker and Location of the cancelled appointment
+                    day (date): day of the cancelled appointment
+                    start, end (time): freed interval
+
+            Returns:
+                    list of created Appointments
+    '''
+    worker = Worker.objects.filter(pk=worker_id).first()
+    if worker is None or day < datetime.date.today(): return []
+    free = {(worker_id, day): [(start, end)]}
+    booked = [first_fit(request, free, worker_id, place_id, day, day) 
+              for request in candidates(worker, day, start, end)]
+    return [x for x in booked if x is not None]
+
+
+def first_fit(request, free, worker_id, place_id, day_from, day_to):
+    '''
+    Book the request into the first suitable free interval
+
+            Parameters:
+                    request (WaitlistRequest): waiting request
+                    free (dict): {(worker id, date): free intervals}, updated after booking
+                    worker_id, place_id (int): ids of Worker and Location for the booking,
+                                    None for the room of the shift
+                    day_from, day_to (date): days to check
+
+            Returns:
+                    created Appointments or None
+    '''
+    day = day_from
+    while day <= day_to:
+        intervals = free.get((worker_id, day), [])
+        for i, (x, y) in enumerate(intervals):
+            slot = fit(request, x, y)
+            if slot is None: continue
+            appointment = book(request, worker_id, place_id, day, *slot)
+            if appointment is None: continue # e.g. held or booked meanwhile, the next interval may fit
+            intervals[i:i + 1] = [z for z in ((x, slot[0]), (slot[1], y)) if z[0] < z[1]]
+            return appointment
+        day += datetime.timedelta(days=1)
+    return None
+
+
+def match_worker_schedule(worker_id, place_id=None):
+    '''
+    Try to book waiting requests of the worker after changes of the schedule
+
+            Parameters:
+                    worker_id (int): id of Worker
+                    place_id (int): room for new bookings, by default the room of the
+                                    shift covering each booking (see Appointments.clean),
+                                    for shifts without rooms the place of the last appointment
+
+            Returns:
+                    list of created Appointments
+    '''
+    worker = Worker.objects.filter(pk=worker_id).first()
+    if worker is None: return []
+    if place_id is None and not Schedule.objects.filter(worker_id=worker_id, place__isnull=False).exists():
+        place_id = Appointments.objects.filter(worker_id=worker_id).order_by('-day', '-time_in'
+                                    ).values_list('place_id', flat=True).first()
+
+    today = datetime.date.today()
+    requests = list(WaitlistRequest.objects.filter(
+        Q(worker_id=worker.pk) | Q(speciality_id=worker.speciality_id),
+        status=WaitlistRequest.WAITING, day_to__gte=today,
+        day_from__gte=today - datetime.timedelta(days=WaitlistRequest.MAX_DAYS)).order_by('created', 'id')[:CANDIDATES])
+    if not requests: return []
+
+    date_from = max(today, min(x.day_from for x in requests))
+    date_to = min(max(x.day_to for x in requests), today + datetime.timedelta(days=HORIZON))
+    if date_to < date_from: return []
+    free = free_intervals([worker_id], date_from, date_to)
+    booked = [first_fit(request, free, worker_id, place_id, max(date_from, request.day_from), 
+                        request.day_to) for request in requests]
+    return [x for x in booked if x is not None]
@@ -0,0 +1,173 @@
+'''
+Group commit of new appointments (settings.SCHED_GROUP_COMMIT).
+
+SQLite has one writer at a time, so bookings committed one by one wait for
+the database lock and for the disk sync of every commit. With group commit
+the validated appointments of all threads of the process are put into one
+queue; a single writer thread takes all bookings queued while it wrote the
+previous group and those coming within SCHED_GROUP_COMMIT_WAIT_MS (up to
+SCHED_GROUP_COMMIT_SIZE bookings), checks them
+again for the whole group with a few queries (appointments of other
+processes and of the same group, holds, series and shift rooms, see
+conflicts.Occupancy), inserts the accepted ones in one transaction and
+gives every caller its own result. A caller which stops waiting gets its
+booking cancelled if it is still queued, or waits for the group being
+written, so it never sees an error for a saved booking.
+'''
+
+import queue
+import threading
+import time
+from collections import defaultdict
+from concurrent import futures
+from concurrent.futures import Future
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db import close_old_connections, router, transaction
+from django.db.models import Max
+
+from .conflicts import MESSAGES, Occupancy
+from .events import broadcaster, appointment_event
+from .listing import refresh_rows
+from .models import Appointments, SlotHold
+from . import metrics
+
+
+def write_group(appointments, using='default'):
+    '''
+    Insert the appointments in one transaction, the overlapping ones are rejected
+
+            Parameters:
+                    appointments (list): validated unsaved Appointments, in the order of arrival
+                    using (str): database alias
+
+            Returns:
+                    list with the saved Appointments or ValidationError for every appointment
+    '''
+    with transaction.atomic(using=using):
+        # appointments, holds, series and shift rooms of the whole group, then the group itself
+        occupancy = Occupancy({x.day for x in appointments}, {x.worker_id for x in appointments},
+                              {x.place_id for x in appointments}, using)
+        numbers = set(Appointments.objects.using(using).filter(
+            number__in=[x.number for x in appointments if x.number is not None]).values_list('number', flat=True))
+        number = Appointments.objects.using(using).aggregate(max_number=Max('number'))['max_number'] or 0
+
+        results, accepted = [], []
+        for appointment in appointments:
+            reason = occupancy.conflict(appointment.worker_id, appointment.place_id, appointment.day,
+                                        appointment.time_in, appointment.time_out, appointment.creator_id)
+            if reason is not None:
+                metrics.inc('sched_booking_rejections_total', reason='group_' + reason)
+                results.append(ValidationError(MESSAGES[reason]))
+                continue
+            occupancy.add(appointment.worker_id, appointment.place_id, appointment.day, 
+                          appointment.time_in, appointment.time_out)
+            if appointment.number is None or appointment.number in numbers: # taken by a concurrent booking
+                number += 1
+                while number in numbers: number += 1
+                appointment.number = number
+            numbers.add(appointment.number)
+            accepted.append(appointment)
+            results.append(appointment)
+
+        Appointments.objects.using(using).bulk_create(accepted)
+        ids = dict(Appointments.objects.using(using).filter(number__in=[x.number for x in accepted]
+                                                            ).values_list('number', 'pk'))
+        for appointment in accepted: appointment.pk = ids[appointment.number]
+        refresh_rows(ids.values(), using)
+        release_holds(accepted, using)
+        events = [appointment_event(x, 'created') for x in accepted]
+        transaction.on_commit(lambda: [broadcaster.publish(x) for x in events], using=using)
+    metrics.observe('sched_group_commit_size', len(appointments))
+    return results
+
+
+def release_holds(appointments, using='default'):
+    # the holds of the creators for the booked time, as holds.release_own for the group
+    holds = SlotHold.objects.using(using).filter(
+        worker_id__in={x.worker_id for x in appointments}, day__in={x.day for x in appointments},
+        holder_id__in={x.creator_id for x in appointments if x.creator_id is not None})
+    used = [hold.pk for hold in holds for x in appointments 
+            if (hold.worker_id, hold.day, hold.holder_id) == (x.worker_id, x.day, x.creator_id) and
+            hold.time_in < x.time_out and x.time_in < hold.time_out]
+    if used: SlotHold.objects.using(using).filter(pk__in=used).delete()
+
+
+class GroupWriter:
+    '''
+    Queue of new appointments and the thread which writes them by groups
+    '''
+
+    def __init__(self, wait=None, size=None):
+        self.wait = (wait if wait is not None else getattr(settings, 'SCHED_GROUP_COMMIT_WAIT_MS', 0)) / 1000
+        self.size = size or getattr(settings, 'SCHED_GROUP_COMMIT_SIZE', 100)
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def submit(self, appointment):
+        '''
+        Put the appointment into the queue
+
+                Returns:
+                        Future with the saved Appointments or ValidationError
+        '''
+        future = Future()
+        # the database of the facility of the request, the writer thread does not know it
+        self.queue.put((appointment, router.db_for_write(Appointments), future))
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.run, name='sched-group-writer', daemon=True)
+                self.thread.start()
+        return future
+
+    def book(self, appointment, timeout=30):
+        # saved appointment, ValidationError if it overlaps another one
+        future = self.submit(appointment)
+        try:
+            return future.result(timeout)
+        except futures.TimeoutError: # not the builtin TimeoutError before Python 3.11
+            # not taken by the writer yet: cancelled, it will be skipped
+            if future.cancel(): raise ValidationError('The booking is not saved in time, try again')
+        return future.result() # the group is being written, its result is final
+
+    def take(self):
+        # the first waiting booking and all which come within the wait time
+        group = [self.queue.get()]
+        deadline = time.monotonic() + self.wait
+        while len(group) < self.size:
+            try:
+                group.append(self.queue.get(timeout=max(deadline - time.monotonic(), 0)))
+            except queue.Empty:
+                break
+        return group
+
+    def run(self):
+        while True:
+            group = self.take()
+            close_old_connections()
+            by_database = defaultdict(list)
+            for appointment, using, future in group:
+                # False for bookings cancelled by their callers
+                if future.set_running_or_notify_cancel(): by_database[using].append((appointment, future))
+            for using, items in by_database.items():
+                try:
+                    results = write_group([x[0] for x in items], using)
+                except Exception as err: # the whole group is rolled back
+                    results = [err] * len(items)
+                for (appointment, future), result in zip(items, results):
+                    if isinstance(result, Exception): future.set_exception(result)
+                    else: future.set_result(result)
+
+
+_writer = None
+_writer_lock = threading.Lock()
+
+
+def writer():
+    # writer of the process
+    global _writer
+    with _writer_lock:
+        if _writer is None: _writer = GroupWriter()
+        return _writer